@@ -8,7 +8,7 @@ import numpy as np
 import nibabel as nib
 import scipy.optimize
 import scipy.ndimage
-from scipy.integrate import trapz
+from scipy.integrate import trapz, cumtrapz
 import matplotlib.pyplot as plt
 import math
 import random
@@ -21,27 +21,43 @@ from Queue import Queue
 from threading import Thread
 from multiprocessing.pool import Pool
 
+from qtim_tools.qtim_utilities import nifti_util
+from qtim_tools.qtim_dce import dce_util
+
 def nifti_2_numpy(filepath):
 
     """ Utility function run through nibabel for loading nifti volumes into float numpy arrays."""
 
-    img = nib.load(filepath).get_data().astype(float)
-    return img
+    return nifti_util.nifti_2_numpy(filepath)
+
+def label_2_numpy(filepath):
+
+    """ Label-maps are kept in their on-disk dtype (and memory-mapped, if uncompressed),
+        rather than copied into a float array the size of the whole volume.
+    """
+
+    return nifti_util.nifti_2_numpy(filepath, dtype=None)
 
 def save_numpy_2_nifti(image_numpy, reference_nifti_filepath, output_path):
 
     """ Rather than constructing a nifti header from scratch, it is usually easiest to just
-        copy one from a nearby reference header.
+        copy one from a nearby reference header. The reference's affine is cached by
+        nifti_util, so saving several maps against one reference only reads it once.
     """
 
-    nifti_image = nib.load(reference_nifti_filepath)
-    image_affine = nifti_image.affine
-    output_nifti = nib.Nifti1Image(image_numpy, image_affine)
-    nib.save(output_nifti, output_path)
+    nifti_util.save_numpy_2_nifti(image_numpy, reference_nifti_filepath, output_path)
 
-def calc_DCE_properties_single(filepath, T1_tissue=1000, T1_blood=1440, relaxivity=.0045, TR=5, TE=2.1, scan_time_seconds=(11*60), hematocrit=0.45, injection_start_time_seconds=60, flip_angle_degrees=30, label_file=[], label_suffix=[], label_value=1, mask_value=0, mask_threshold=0, T1_map_file=[], T1_map_suffix='-T1Map', AIF_label_file=[],  AIF_value_data=[], AIF_value_suffix=[], convert_AIF_values=True, AIF_mode='label_average', AIF_label_suffix=[], AIF_label_value=1, label_mode='separate', param_file=[], default_population_AIF=False, initial_fitting_function_parameters=[.01,.1], outputs=['ktrans','ve','auc'], outfile_prefix='', processes=1, gaussian_blur=.65, gaussian_blur_axis=2):
+def calc_DCE_properties_single(filepath, T1_tissue=1000, T1_blood=1440, relaxivity=.0045, TR=5, TE=2.1, scan_time_seconds=(11*60), hematocrit=0.45, injection_start_time_seconds=60, flip_angle_degrees=30, label_file=[], label_suffix=[], label_value=1, mask_value=0, mask_threshold=0, T1_map_file=[], T1_map_suffix='-T1Map', AIF_label_file=[],  AIF_value_data=[], AIF_value_suffix=[], convert_AIF_values=True, AIF_mode='label_average', AIF_label_suffix=[], AIF_label_value=1, label_mode='separate', param_file=[], default_population_AIF=False, initial_fitting_function_parameters=[.01,.1], outputs=['ktrans','ve','auc'], outfile_prefix='', processes=1, gaussian_blur=.65, gaussian_blur_axis=2, fitting_method='simplex', initialization='fixed', convolution_backend='auto'):
 
     """ This is a master function that creates ktrans, ve, and auc values from raw intensity 1D-4D volumes.
+        fitting_method is 'simplex' (Nelder-Mead, voxel by voxel), 'levenberg_marquardt' (all voxels
+        at once), 'dictionary' (the closest of a grid of precomputed curves, a fast low-resolution
+        map), or 'linear' and 'linear_extended' (non-iterative least squares on the integral form of
+        the Tofts and extended Tofts models, for quick screening). 'linear_extended' adds a vp map
+        after auc, saved if a fourth name is given in outputs. With initialization='dictionary', the iterative fitters start each voxel from its
+        closest dictionary curve rather than from initial_fitting_function_parameters. convolution_backend
+        picks how the simplex fitter convolves the AIF ('auto', 'recursive', 'direct' or 'fft'); see
+        dce_util.build_tofts_model.
     """
 
     print '\n'
@@ -91,11 +107,10 @@ def calc_DCE_properties_single(filepath, T1_tissue=1000, T1_blood=1440, relaxivi
         contrast_AIF = convert_intensity_to_concentration(AIF, T1_tissue, TR, flip_angle_degrees, injection_start_time_seconds, relaxivity, time_interval_seconds, hematocrit, T1_blood=T1_blood)
 
     # The optimization portion of the program is run here.
-    parameter_maps = simplex_optimize(contrast_image, contrast_AIF, time_interval_seconds, bolus_time, image, label_image, mask_value, mask_threshold, initial_fitting_function_parameters, outputs, processes)
+    parameter_maps = simplex_optimize(contrast_image, contrast_AIF, time_interval_seconds, bolus_time, image, label_image, mask_value, mask_threshold, initial_fitting_function_parameters, outputs, processes, fitting_method, initialization, convolution_backend)
 
-    # Outputs are saved, and then returned.
-    for param_idx, param in enumerate(outputs):
-        save_numpy_2_nifti(parameter_maps[...,param_idx], filepath, outfile_prefix + param + '.nii.gz')
+    # Outputs are saved, and then returned. float32 is plenty for parameter maps, and half the size.
+    nifti_util.save_numpy_2_nifti_batch([parameter_maps[...,param_idx] for param_idx in xrange(len(outputs))], filepath, [outfile_prefix + param + '.nii.gz' for param in outputs], dtype=np.float32)
     return outputs
 
 def retreive_data_from_files(filepath, label_file, label_mode, label_suffix, label_value, AIF_label_file, AIF_label_value, AIF_mode, AIF_label_suffix, T1_map_file, T1_map_suffix, AIF_value_data, AIF_value_suffix, image=[]):
@@ -109,13 +124,13 @@ def retreive_data_from_files(filepath, label_file, label_mode, label_suffix, lab
     if label_mode == 'none':
         label_image = []
     elif label_file != []:
-        label_image = nifti_2_numpy(label_file)
+        label_image = label_2_numpy(label_file)
     elif label_suffix != []:
         split_path = str.split(filepath, '.nii')
         if os.path.isfile(split_path[0] + label_suffix + '.nii' + split_path[1]):
-            label_image = nifti_2_numpy(split_path[0] + label_suffix + '.nii' + split_path[1])
+            label_image = label_2_numpy(split_path[0] + label_suffix + '.nii' + split_path[1])
         elif os.path.isfile(split_path[0] + AIF_label_suffix + '.nii.gz'):
-            label_image = nifti_2_numpy(split_path[0] + label_suffix + '.nii.gz')
+            label_image = label_2_numpy(split_path[0] + label_suffix + '.nii.gz')
         else:
             print "No labelmap found at provided label suffix. Continuing without..."
             label_image = []
@@ -125,13 +140,13 @@ def retreive_data_from_files(filepath, label_file, label_mode, label_suffix, lab
     # Check for a provided region of interest for determining an AIF.
     if AIF_mode == 'label_average':
         if AIF_label_file != []:
-            AIF_label_image = nifti_2_numpy(AIF_label_file)
+            AIF_label_image = label_2_numpy(AIF_label_file)
         elif AIF_label_suffix != []:
             split_path = str.split(filepath, '.nii')
             if os.path.isfile(split_path[0] + AIF_label_suffix + '.nii' + split_path[1]):
-                AIF_label_image = nifti_2_numpy(split_path[0] + AIF_label_suffix + '.nii' + split_path[1])
+                AIF_label_image = label_2_numpy(split_path[0] + AIF_label_suffix + '.nii' + split_path[1])
             elif os.path.isfile(split_path[0] + AIF_label_suffix + '.nii.gz'):
-                AIF_label_image = nifti_2_numpy(split_path[0] + AIF_label_suffix + '.nii.gz')
+                AIF_label_image = label_2_numpy(split_path[0] + AIF_label_suffix + '.nii.gz')
             else:
                 print "No AIF labelmap found at provided label suffix. Continuing without..."
                 AIF_label_image = []
@@ -385,15 +400,25 @@ def convert_intensity_to_concentration(data_numpy, T1_tissue, TR, flip_angle_deg
         output_numpy = output_numpy / (1-hematocrit)
         return output_numpy
 
-def simplex_optimize(contrast_image_numpy, contrast_AIF_numpy, time_interval_seconds, bolus_time, image=[], label_image=[], mask_value=0, mask_threshold=0, initial_fitting_function_parameters=[.01,.1], outputs=['ktrans','ve'], processes=1):
+def simplex_optimize(contrast_image_numpy, contrast_AIF_numpy, time_interval_seconds, bolus_time, image=[], label_image=[], mask_value=0, mask_threshold=0, initial_fitting_function_parameters=[.01,.1], outputs=['ktrans','ve'], processes=1, fitting_method='simplex', initialization='fixed', convolution_backend='auto'):
 
     """ This function sets up parallel processing. Until this function is reimplemented in Cython, paralell processing
-        may be required to get semi-normal processing speeds.
+        may be required to get semi-normal processing speeds. The Levenberg-Marquardt fitter works on all voxels
+        at once, and rarely needs more than one process.
     """
 
-    print contrast_image_numpy.shape
-    integration_test(contrast_image_numpy[25, 65, :], contrast_AIF_numpy, time_interval_seconds, bolus_time, mask_value)
-    fd = gd
+    if fitting_method == 'simplex':
+        optimize_loop = partial(simplex_optimize_loop, convolution_backend=convolution_backend)
+    elif fitting_method == 'levenberg_marquardt':
+        optimize_loop = levenberg_marquardt_optimize_loop
+    elif fitting_method == 'dictionary':
+        optimize_loop = dictionary_optimize_loop
+    elif fitting_method == 'linear':
+        optimize_loop = linear_optimize_loop
+    elif fitting_method == 'linear_extended':
+        optimize_loop = linear_extended_optimize_loop
+    else:
+        raise ValueError('Unknown fitting_method ' + str(fitting_method) + '. Choose \'simplex\', \'levenberg_marquardt\', \'dictionary\', \'linear\' or \'linear_extended\'.')
 
     # I am extremely skeptical about this broken masking method.
     if label_image != []:
@@ -414,19 +439,19 @@ def simplex_optimize(contrast_image_numpy, contrast_AIF_numpy, time_interval_sec
 
         subunits += [contrast_image_numpy[int((processes - 1)*sublength):,...]]
 
-        subprocess = partial(simplex_optimize_loop, contrast_AIF_numpy=contrast_AIF_numpy, time_interval_seconds=time_interval_seconds, bolus_time=bolus_time, mask_value=mask_value, mask_threshold=mask_threshold, initial_fitting_function_parameters=initial_fitting_function_parameters)
+        subprocess = partial(optimize_loop, contrast_AIF_numpy=contrast_AIF_numpy, time_interval_seconds=time_interval_seconds, bolus_time=bolus_time, mask_value=mask_value, mask_threshold=mask_threshold, initial_fitting_function_parameters=initial_fitting_function_parameters, initialization=initialization)
 
         optimization_pool = Pool(processes)
         results = optimization_pool.map(subprocess, subunits)
 
-        output_image = np.zeros((contrast_image_numpy.shape[0:-1] + (3,)), dtype=float)
+        output_image = np.zeros((contrast_image_numpy.shape[0:-1] + (results[0].shape[-1],)), dtype=float)
         stitch_index = 0
         for result in results:
             output_image[stitch_index:stitch_index+result.shape[0],...] = result
             stitch_index += result.shape[0]
 
     else:
-        output_image = simplex_optimize_loop(contrast_image_numpy, contrast_AIF_numpy, time_interval_seconds, bolus_time, mask_value, mask_threshold, initial_fitting_function_parameters)
+        output_image = optimize_loop(contrast_image_numpy, contrast_AIF_numpy, time_interval_seconds, bolus_time, mask_value, mask_threshold, initial_fitting_function_parameters, initialization)
 
     return output_image
 
@@ -523,7 +548,7 @@ def integration_test(contrast_sample_numpy, contrast_AIF_numpy, time_interval_se
     plt.plot(time_series, good_estimated_concentration, 'r--', time_series, bad_estimated_concentration, 'g--', time_series, observed_concentration, 'b--')
     plt.show()
 
-def simplex_optimize_loop(contrast_image_numpy, contrast_AIF_numpy, time_interval_seconds, bolus_time, mask_value=0, mask_threshold=0, initial_fitting_function_parameters=[1,1]):
+def simplex_optimize_loop(contrast_image_numpy, contrast_AIF_numpy, time_interval_seconds, bolus_time, mask_value=0, mask_threshold=0, initial_fitting_function_parameters=[1,1], initialization='fixed', convolution_backend='auto'):
 
     contrast_AIF_numpy = contrast_AIF_numpy[bolus_time:]
 
@@ -537,39 +562,14 @@ def simplex_optimize_loop(contrast_image_numpy, contrast_AIF_numpy, time_interva
 
     ktransmax = 1
 
-    def cost_function(params):
-
-        # The estimate concentration function is repeated locally to eke out every last bit of efficiency
-        # from this massively looping program. As much as possible is calculated outside the loop for
-        # performance reasons. Appending is faster than pre-allocating space in this case - who knew.
-
-        estimated_concentration = [0]
+    # One voxel is fitted at a time, so the model is set up for single curves. See dce_util.build_tofts_model.
+    tofts_model = dce_util.build_tofts_model(contrast_AIF_numpy, time_interval, backend=convolution_backend, voxels=1)
 
-        append = estimated_concentration.append
-
-        ktrans = params[0]
-        ve = params[1]
-        kep = ktrans / ve
-
-        log_e = -1 * kep * time_interval
-        capital_E = e**log_e
-        log_e_2 = log_e**2
-
-        block_A = (capital_E - log_e - 1)
-        block_B = (capital_E - (capital_E * log_e) - 1)
-        block_ktrans = ktrans * time_interval / log_e_2
-
-        # for i in xrange(1, np.size(contrast_AIF_numpy)):
-        #     term_A = contrast_AIF_numpy[i] * block_A
-        #     term_B = contrast_AIF_numpy[i-1] * block_B
-        #     append(estimated_concentration[-1]*capital_E + block_ktrans * (term_A - term_B))
+    def cost_function(params):
 
-        # This is a much faster, but less accurate curve generation method
-        res = np.exp(-1*kep*time_series)
-        estimated_concentration = ktrans * np.convolve(contrast_AIF_numpy, res) * time_series[1]
-        estimated_concentration = estimated_concentration[0:np.size(res)]        
+        estimated_concentration = tofts_model(params[0], params[1])
 
-        difference_term = observed_concentration- estimated_concentration
+        difference_term = observed_concentration - estimated_concentration
         difference_term = power(difference_term, 2)
 
         return sum(difference_term)
@@ -592,6 +592,11 @@ def simplex_optimize_loop(contrast_image_numpy, contrast_AIF_numpy, time_interva
 
     space_dims = contrast_image_numpy.shape[0:-1]
 
+    if initialization == 'dictionary':
+        unmasked, observed_curves = unmasked_voxel_curves(contrast_image_numpy, bolus_time, mask_value)
+        starting_params = np.zeros(space_dims + (2,), dtype=float)
+        starting_params[unmasked] = match_tofts_dictionary(observed_curves, build_tofts_dictionary(contrast_AIF_numpy, time_interval))
+
     for index in np.ndindex(space_dims):
 
         # Need to think about how to implement masking. Maybe np.ma involved. Will likely require
@@ -612,8 +617,12 @@ def simplex_optimize_loop(contrast_image_numpy, contrast_AIF_numpy, time_interva
         auc = trapz(observed_concentration)
 
         # with timewith('concentration estimator') as timer:
-        initial_fitting_function_parameters = [.3,.1]        
-        result_params, fopt, iterations, funcalls, warnflag, allvecs = scipy.optimize.fmin(cost_function, initial_fitting_function_parameters, disp=0, ftol=1e-14, xtol=1e-8, full_output = True, retall=True)
+        if initialization == 'dictionary':
+            initial_params = starting_params[index]
+        else:
+            initial_params = initial_fitting_function_parameters
+
+        result_params, fopt, iterations, funcalls, warnflag = scipy.optimize.fmin(cost_function, initial_params, disp=0, ftol=1e-14, xtol=1e-8, full_output = True)
 
         ktrans = result_params[0]
         ve = result_params[1]
@@ -633,7 +642,291 @@ def simplex_optimize_loop(contrast_image_numpy, contrast_AIF_numpy, time_interva
 
     return output_image
 
-def calc_DCE_properties_batch(folder, regex='', recursive=False, T1_tissue=1000, T1_blood=1440, relaxivity=.0045, TR=5, TE=2.1, scan_time_seconds=(11*60), hematocrit=0.45, injection_start_time_seconds=60, flip_angle_degrees=30, label_file=[], label_suffix=[], label_value=1, mask_value=0, mask_threshold=0, T1_map_file=[], T1_map_suffix='-T1Map', AIF_label_file=[],  AIF_value_data=[], convert_AIF_values=True, AIF_mode='label_average', AIF_label_suffix=[], AIF_label_value=1, label_mode='separate', param_file=[], default_population_AIF=False, initial_fitting_function_parameters=[.01,.1], outputs=['ktrans','ve','auc'], outfile_prefix='', processes=1, gaussian_blur=.65, gaussian_blur_axis=2):
+def levenberg_marquardt_fit(observed_concentration, contrast_AIF_numpy, time_interval, initial_fitting_function_parameters, lower_bounds, upper_bounds, max_iterations=100, ftol=1e-10, xtol=1e-8):
+
+    """ Fits [ktrans, ve] to every row of observed_concentration at once, starting from
+        initial_fitting_function_parameters, either one [ktrans, ve] pair or one per row, with damped Gauss-Newton
+        (Levenberg-Marquardt) steps on the recursive Tofts model and its exact derivatives. Steps are
+        clipped to the bounds, and each voxel's damping goes up or down depending on whether its last
+        step lowered its squared error. Voxels stop, and leave the set being iterated on, once a step
+        changes their error by less than ftol (relatively) or their parameters by less than xtol.
+    """
+
+    voxel_count = observed_concentration.shape[0]
+    lower_bounds = np.array(lower_bounds, dtype=float)
+    upper_bounds = np.array(upper_bounds, dtype=float)
+
+    # Starting parameters can be shared by every voxel, or given per voxel.
+    fitted_params = np.clip(np.array(initial_fitting_function_parameters, dtype=float), lower_bounds, upper_bounds) * np.ones((voxel_count, 1))
+
+    active = np.arange(voxel_count)
+    observed = observed_concentration
+    params = np.copy(fitted_params)
+    damping = np.full(voxel_count, 1e-3)
+
+    estimated, d_ktrans, d_ve = dce_util.estimate_concentration_batch_jacobian(params[:,0], params[:,1], contrast_AIF_numpy, time_interval)
+    residual = observed - estimated
+    cost = np.sum(residual**2, axis=1)
+
+    for iteration in xrange(max_iterations):
+
+        if active.size == 0:
+            break
+
+        # Normal equations, J'J * step = J'r, with J'J's diagonal scaled up by the damping.
+        jtj_00 = np.sum(d_ktrans**2, axis=1)
+        jtj_01 = np.sum(d_ktrans * d_ve, axis=1)
+        jtj_11 = np.sum(d_ve**2, axis=1)
+        jtr_0 = np.sum(d_ktrans * residual, axis=1)
+        jtr_1 = np.sum(d_ve * residual, axis=1)
+
+        a_00 = jtj_00 + damping * np.maximum(jtj_00, 1e-12)
+        a_11 = jtj_11 + damping * np.maximum(jtj_11, 1e-12)
+        determinant = a_00 * a_11 - jtj_01**2
+
+        step = np.empty_like(params)
+        step[:,0] = (a_11 * jtr_0 - jtj_01 * jtr_1) / determinant
+        step[:,1] = (a_00 * jtr_1 - jtj_01 * jtr_0) / determinant
+
+        trial_params = np.clip(params + np.nan_to_num(step), lower_bounds, upper_bounds)
+
+        trial_estimated, trial_d_ktrans, trial_d_ve = dce_util.estimate_concentration_batch_jacobian(trial_params[:,0], trial_params[:,1], contrast_AIF_numpy, time_interval)
+        trial_residual = observed - trial_estimated
+        trial_cost = np.sum(trial_residual**2, axis=1)
+
+        improved = trial_cost < cost
+        small_step = np.all(np.abs(trial_params - params) <= xtol * (np.abs(params) + xtol), axis=1)
+        converged = small_step | (improved & (cost - trial_cost <= ftol * cost)) | (damping > 1e10)
+
+        params[improved] = trial_params[improved]
+        cost[improved] = trial_cost[improved]
+        residual[improved] = trial_residual[improved]
+        d_ktrans[improved] = trial_d_ktrans[improved]
+        d_ve[improved] = trial_d_ve[improved]
+        damping = np.where(improved, damping / 10, damping * 10)
+
+        fitted_params[active[converged]] = params[converged]
+
+        remaining = ~converged
+        active, observed, params, damping, cost, residual, d_ktrans, d_ve = [x[remaining] for x in [active, observed, params, damping, cost, residual, d_ktrans, d_ve]]
+
+    fitted_params[active] = params
+
+    return fitted_params
+
+def unmasked_voxel_curves(contrast_image_numpy, bolus_time, mask_value=0):
+
+    """ Returns [unmasked, observed_concentration], a boolean map of the voxels to be fitted and
+        their concentration curves from bolus_time onwards, one voxel per row.
+    """
+
+    unmasked = contrast_image_numpy[...,0] != mask_value
+    return [unmasked, contrast_image_numpy[unmasked][:, bolus_time:].astype(float)]
+
+def assemble_parameter_maps(space_dims, unmasked, fitted_params, observed_concentration, ktransmax=1):
+
+    """ Builds the ktrans, ve and auc maps that simplex_optimize_loop returns from the parameters
+        fitted to the unmasked voxels, with the same values for masked voxels and the same
+        filtering. Any parameters after ktrans and ve (such as vp) are added as maps after auc.
+    """
+
+    output_image = np.zeros((space_dims + (fitted_params.shape[1] + 1,)), dtype=float)
+    output_image[~unmasked] = -.01
+
+    output_image[...,0][unmasked] = fitted_params[:,0]
+    output_image[...,1][unmasked] = fitted_params[:,1]
+    output_image[...,2][unmasked] = trapz(observed_concentration, axis=-1)
+
+    for param_idx in xrange(2, fitted_params.shape[1]):
+        output_image[...,param_idx+1][unmasked] = fitted_params[:,param_idx]
+
+    output_image[...,2][abs(output_image[...,2]) > 1e6] = 0
+    output_image[...,0][output_image[...,0] > .95*ktransmax] = 0
+
+    return output_image
+
+def build_tofts_dictionary(contrast_AIF_numpy, time_interval, ktrans_values=[], ve_values=[]):
+
+    """ Computes model curves for every combination of ktrans_values and ve_values, to be matched
+        against voxels with match_tofts_dictionary. By default both run from 1e-3 to 1, spaced
+        logarithmically, as most tissue sits at the low end. The curves only depend on the AIF,
+        so one dictionary serves a whole volume.
+    """
+
+    if len(ktrans_values) == 0:
+        ktrans_values = np.logspace(-3, 0, 64)
+    if len(ve_values) == 0:
+        ve_values = np.logspace(-3, 0, 48)
+
+    ktrans_grid, ve_grid = np.meshgrid(ktrans_values, ve_values, indexing='ij')
+    dictionary_params = np.column_stack([ktrans_grid.ravel(), ve_grid.ravel()])
+    dictionary_curves = dce_util.build_tofts_model(contrast_AIF_numpy, time_interval, voxels=dictionary_params.shape[0])(dictionary_params[:,0], dictionary_params[:,1])
+
+    return {'params': dictionary_params, 'curves': dictionary_curves, 'curve_norms': np.sum(dictionary_curves**2, axis=1)}
+
+def match_tofts_dictionary(observed_concentration, tofts_dictionary, block_size=4096):
+
+    """ Returns the [ktrans, ve] of the dictionary curve closest to each row of
+        observed_concentration, in block_size rows at a time. The squared distance to a curve d
+        is |y|^2 - 2 y.d + |d|^2, and |y|^2 is the same for every curve, so one matrix product
+        ranks the whole dictionary for a block of voxels. Curves are not normalized before
+        matching: curves with the same kep only differ in scale, and the scale is what sets ktrans.
+    """
+
+    matched_params = np.zeros((observed_concentration.shape[0], 2), dtype=float)
+
+    for block_start in xrange(0, observed_concentration.shape[0], block_size):
+        block = slice(block_start, block_start + block_size)
+        distances = tofts_dictionary['curve_norms'] - 2 * np.dot(observed_concentration[block], tofts_dictionary['curves'].T)
+        matched_params[block] = tofts_dictionary['params'][np.argmin(distances, axis=1)]
+
+    return matched_params
+
+def dictionary_optimize_loop(contrast_image_numpy, contrast_AIF_numpy, time_interval_seconds, bolus_time, mask_value=0, mask_threshold=0, initial_fitting_function_parameters=[.3,.1], initialization='fixed'):
+
+    """ Maps ktrans and ve to the closest curve in a dictionary from build_tofts_dictionary, without
+        any further fitting. Precision is limited to the grid's spacing, which makes this a quick
+        first look at a volume. initial_fitting_function_parameters and initialization are
+        accepted so that it can be swapped for the other loops, and are ignored.
+    """
+
+    contrast_AIF_numpy = contrast_AIF_numpy[bolus_time:]
+
+    time_series = np.arange(0, contrast_AIF_numpy.size) / (60 / time_interval_seconds)
+    time_interval = time_series[1]
+
+    unmasked, observed_concentration = unmasked_voxel_curves(contrast_image_numpy, bolus_time, mask_value)
+    fitted_params = match_tofts_dictionary(observed_concentration, build_tofts_dictionary(contrast_AIF_numpy, time_interval))
+
+    print 'Matched ' + str(observed_concentration.shape[0]) + ' voxels.'
+
+    return assemble_parameter_maps(contrast_image_numpy.shape[0:-1], unmasked, fitted_params, observed_concentration)
+
+def levenberg_marquardt_optimize_loop(contrast_image_numpy, contrast_AIF_numpy, time_interval_seconds, bolus_time, mask_value=0, mask_threshold=0, initial_fitting_function_parameters=[.3,.1], initialization='fixed', block_size=10000):
+
+    """ Fits every unmasked voxel with levenberg_marquardt_fit, block_size voxels at a time, and returns
+        the same ktrans, ve and auc maps as simplex_optimize_loop. Unlike the simplex fitter, the bounds
+        ve in [1e-3, 1] and ktrans in [1e-3, ktransmax] are enforced. With initialization='dictionary',
+        each voxel starts from its closest dictionary curve.
+    """
+
+    contrast_AIF_numpy = contrast_AIF_numpy[bolus_time:]
+
+    time_series = np.arange(0, contrast_AIF_numpy.size) / (60 / time_interval_seconds)
+    time_interval = time_series[1]
+
+    ktransmax = 1
+    lower_bounds = [1e-3, 1e-3]
+    upper_bounds = [ktransmax, 1]
+
+    unmasked, observed_concentration = unmasked_voxel_curves(contrast_image_numpy, bolus_time, mask_value)
+
+    if initialization == 'dictionary':
+        initial_params = match_tofts_dictionary(observed_concentration, build_tofts_dictionary(contrast_AIF_numpy, time_interval))
+    else:
+        initial_params = np.array(initial_fitting_function_parameters, dtype=float) * np.ones((observed_concentration.shape[0], 1))
+
+    fitted_params = np.zeros((observed_concentration.shape[0], 2), dtype=float)
+
+    for block_start in xrange(0, observed_concentration.shape[0], block_size):
+        block = slice(block_start, block_start + block_size)
+        fitted_params[block] = levenberg_marquardt_fit(observed_concentration[block], contrast_AIF_numpy, time_interval, initial_params[block], lower_bounds, upper_bounds)
+
+    print 'Fitted ' + str(observed_concentration.shape[0]) + ' voxels.'
+
+    return assemble_parameter_maps(contrast_image_numpy.shape[0:-1], unmasked, fitted_params, observed_concentration, ktransmax)
+
+def solve_normal_equations(xtx, xty):
+
+    """ Solves a stack of small linear systems xtx * solution = xty by Cramer's rule, which unlike
+        np.linalg.solve does not fail on the whole stack when one system is singular. Singular
+        systems get NaNs.
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        determinant = np.linalg.det(xtx)
+        solution = np.empty(xty.shape, dtype=float)
+        for param_idx in xrange(xty.shape[-1]):
+            replaced = np.copy(xtx)
+            replaced[..., param_idx] = xty
+            solution[..., param_idx] = np.linalg.det(replaced) / determinant
+
+    return solution
+
+def linear_tofts_fit(observed_concentration, contrast_AIF_numpy, time_interval, extended=False):
+
+    """ Fits every row of observed_concentration at once by linear least squares on the integral
+        form of the Tofts model,
+            C(t) = ktrans * integral(Cp) - kep * integral(C),
+        or, with extended set, of the extended Tofts model,
+            C(t) = vp * Cp(t) + (ktrans + kep * vp) * integral(Cp) - kep * integral(C),
+        with integrals taken by the cumulative trapezoid rule from the first timepoint. Returns
+        [ktrans, ve] per row, plus vp if extended. Noise in C also enters the integral of C, so
+        estimates are somewhat biased on noisy data; this is meant for screening, or for a
+        starting point.
+    """
+
+    contrast_AIF_numpy = np.asarray(contrast_AIF_numpy, dtype=float)
+    AIF_integral = cumtrapz(contrast_AIF_numpy, dx=time_interval, initial=0)
+    concentration_integral = cumtrapz(observed_concentration, dx=time_interval, axis=-1, initial=0)
+
+    if extended:
+        regressors = [np.broadcast_to(contrast_AIF_numpy, observed_concentration.shape), np.broadcast_to(AIF_integral, observed_concentration.shape), -1 * concentration_integral]
+    else:
+        regressors = [np.broadcast_to(AIF_integral, observed_concentration.shape), -1 * concentration_integral]
+
+    # Normal equations for all voxels at once: xtx is (voxels, params, params) and xty is (voxels, params).
+    xtx = np.empty((observed_concentration.shape[0], len(regressors), len(regressors)), dtype=float)
+    xty = np.empty((observed_concentration.shape[0], len(regressors)), dtype=float)
+    for row_idx, row_regressor in enumerate(regressors):
+        xty[:, row_idx] = np.sum(row_regressor * observed_concentration, axis=-1)
+        for column_idx, column_regressor in enumerate(regressors):
+            xtx[:, row_idx, column_idx] = np.sum(row_regressor * column_regressor, axis=-1)
+
+    solution = solve_normal_equations(xtx, xty)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if extended:
+            vp, ktrans_plus, kep = solution[:,0], solution[:,1], solution[:,2]
+            ktrans = ktrans_plus - kep * vp
+            return np.column_stack([ktrans, ktrans / kep, vp])
+        else:
+            ktrans, kep = solution[:,0], solution[:,1]
+            return np.column_stack([ktrans, ktrans / kep])
+
+def linear_optimize_loop(contrast_image_numpy, contrast_AIF_numpy, time_interval_seconds, bolus_time, mask_value=0, mask_threshold=0, initial_fitting_function_parameters=[.3,.1], initialization='fixed', extended=False):
+
+    """ Maps ktrans and ve (and vp, if extended) with linear_tofts_fit, without iterating.
+        Parameters are clipped to the bounds the iterative fitters use, with voxels that cannot
+        be solved at all set to 0. initial_fitting_function_parameters and initialization are
+        accepted so that it can be swapped for the other loops, and are ignored.
+    """
+
+    contrast_AIF_numpy = contrast_AIF_numpy[bolus_time:]
+
+    time_series = np.arange(0, contrast_AIF_numpy.size) / (60 / time_interval_seconds)
+    time_interval = time_series[1]
+
+    ktransmax = 1
+
+    unmasked, observed_concentration = unmasked_voxel_curves(contrast_image_numpy, bolus_time, mask_value)
+    fitted_params = linear_tofts_fit(observed_concentration, contrast_AIF_numpy, time_interval, extended)
+
+    solved = np.all(np.isfinite(fitted_params), axis=1)
+    fitted_params[:,0] = np.clip(fitted_params[:,0], 1e-3, ktransmax)
+    fitted_params[:,1] = np.clip(fitted_params[:,1], 1e-3, 1)
+    if extended:
+        fitted_params[:,2] = np.clip(fitted_params[:,2], 0, 1)
+    fitted_params[~solved] = 0
+
+    print 'Fitted ' + str(observed_concentration.shape[0]) + ' voxels.'
+
+    return assemble_parameter_maps(contrast_image_numpy.shape[0:-1], unmasked, fitted_params, observed_concentration, ktransmax)
+
+def linear_extended_optimize_loop(contrast_image_numpy, contrast_AIF_numpy, time_interval_seconds, bolus_time, mask_value=0, mask_threshold=0, initial_fitting_function_parameters=[.3,.1], initialization='fixed'):
+    return linear_optimize_loop(contrast_image_numpy, contrast_AIF_numpy, time_interval_seconds, bolus_time, mask_value, mask_threshold, initial_fitting_function_parameters, initialization, extended=True)
+
+def calc_DCE_properties_batch(folder, regex='', recursive=False, T1_tissue=1000, T1_blood=1440, relaxivity=.0045, TR=5, TE=2.1, scan_time_seconds=(11*60), hematocrit=0.45, injection_start_time_seconds=60, flip_angle_degrees=30, label_file=[], label_suffix=[], label_value=1, mask_value=0, mask_threshold=0, T1_map_file=[], T1_map_suffix='-T1Map', AIF_label_file=[],  AIF_value_data=[], AIF_value_suffix=[], convert_AIF_values=True, AIF_mode='label_average', AIF_label_suffix=[], AIF_label_value=1, label_mode='separate', param_file=[], default_population_AIF=False, initial_fitting_function_parameters=[.01,.1], outputs=['ktrans','ve','auc'], outfile_prefix='', processes=1, gaussian_blur=.65, gaussian_blur_axis=2, fitting_method='simplex', initialization='fixed', convolution_backend='auto'):
 
 
     suffix_exclusion_regex = []
@@ -657,7 +950,8 @@ def calc_DCE_properties_batch(folder, regex='', recursive=False, T1_tissue=1000,
 
                 print 'Working on volume located at... ' + volume
 
-                calc_DCE_properties_single(volume, T1_tissue, T1_blood, relaxivity, TR, TE, scan_time_seconds, hematocrit, injection_start_time_seconds, flip_angle_degrees, label_file, label_suffix, label_value, mask_value, mask_threshold, T1_map_file, T1_map_suffix, AIF_label_file,  AIF_value_data, convert_AIF_values, AIF_mode, AIF_label_suffix, AIF_label_value, label_mode, param_file, default_population_AIF, initial_fitting_function_parameters, outputs, outfile_prefix, processes, gaussian_blur, gaussian_blur_axis)
+                # Passed by keyword, so that the two signatures cannot drift out of step.
+                calc_DCE_properties_single(volume, T1_tissue=T1_tissue, T1_blood=T1_blood, relaxivity=relaxivity, TR=TR, TE=TE, scan_time_seconds=scan_time_seconds, hematocrit=hematocrit, injection_start_time_seconds=injection_start_time_seconds, flip_angle_degrees=flip_angle_degrees, label_file=label_file, label_suffix=label_suffix, label_value=label_value, mask_value=mask_value, mask_threshold=mask_threshold, T1_map_file=T1_map_file, T1_map_suffix=T1_map_suffix, AIF_label_file=AIF_label_file, AIF_value_data=AIF_value_data, AIF_value_suffix=AIF_value_suffix, convert_AIF_values=convert_AIF_values, AIF_mode=AIF_mode, AIF_label_suffix=AIF_label_suffix, AIF_label_value=AIF_label_value, label_mode=label_mode, param_file=param_file, default_population_AIF=default_population_AIF, initial_fitting_function_parameters=initial_fitting_function_parameters, outputs=outputs, outfile_prefix=outfile_prefix, processes=processes, gaussian_blur=gaussian_blur, gaussian_blur_axis=gaussian_blur_axis, fitting_method=fitting_method, initialization=initialization, convolution_backend=convolution_backend)
 
 def test_method_2d():
     # print 'hello'
@@ -417,12 +417,21 @@ def glcm_features(image, distances=[1,2,3,4,5], angles=[0, np.pi/4, np.pi/2, 3*n
     else:
         return glcm_feats
 
+intermediates = ['quantized_roi']
+
+def features_from_intermediates(intermediates, distances=[1,2,3,4,5], angles=[0, np.pi/4, np.pi/2, 3*np.pi/4], props=['contrast', 'dissimilarity', 'homogeneity', 'ASM','energy','correlation']):
+
+    # Quantized images hold levels 1 through 'levels', with 0 reserved for masked voxels.
+    return glcm_features(intermediates['quantized_roi'], distances=distances, angles=angles, props=props, levels=intermediates['levels'] + 1)
+
 def feature_count(distances=[1,2,3,4,5], angles=[0, np.pi/4, np.pi/2, 3*np.pi/4], props=['contrast', 'dissimilarity', 'homogeneity', 'ASM','energy','correlation']):
     if isinstance(props, basestring):
         props = [props,]
     return len(distances) * len(angles) * len(props)
 
 def featurename_strings(distances=[1,2,3,4,5], angles=[0, np.pi/4, np.pi/2, 3*np.pi/4], props=['contrast', 'dissimilarity', 'homogeneity', 'ASM','energy','correlation']):
+    if isinstance(props, basestring):
+        props = [props,]
     featurename_list = np.zeros((len(props) * len(distances) * len(angles)), dtype=object)
     featurename_id = 0
     for d_idx in distances:
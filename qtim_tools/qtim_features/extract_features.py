@@ -10,6 +10,9 @@
 import GLCM
 import morphology
 import statistics
+import intermediates
+import image_manifest
+import shards
 
 
 from qtim_tools.qtim_utilities import nifti_util
@@ -17,20 +20,67 @@ from qtim_tools.qtim_utilities import nifti_util
 import sys, getopt
 import glob
 import os
+import time
 import numpy as np
 import nibabel as nib
 import csv
 import fnmatch
 from shutil import copy, move
-from multiprocessing.pool import Pool
+from multiprocessing.pool import Pool, ThreadPool
 from multiprocessing import freeze_support
 from functools import partial
+from collections import deque
 
+# Each feature family module declares the ROI intermediates it needs in a module-level 'intermediates'
+# list, and computes its features from them in features_from_intermediates. See intermediates.py.
 feature_dictionary = {'GLCM': GLCM, 'morphology': morphology, 'statistics': statistics}
 
-def generate_feature_list_batch(folder, features=['GLCM', 'morphology', 'statistics'], recursive=False, labels=False, label_suffix="-label", universal_label='', decisions=False, levels=255, normalize_intensities=True,mask_value=0, use_labels=[-1], erode=[0,0,0], filenames=True, featurenames=True, outfile='', overwrite=True, clear_file=True, write_empty=True, return_output=False, test=False):
+# How long shards other than the first wait for it to save the cohort's bin edges.
+bin_edges_wait_seconds = 24 * 60 * 60
 
-    total_features, feature_indexes, label_output = generate_feature_indices(features, featurenames)
+def generate_feature_list_batch(folder, features=['GLCM', 'morphology', 'statistics'], recursive=False, labels=False, label_suffix="-label", universal_label='', decisions=False, levels=255, normalize_intensities=True,mask_value=0, use_labels=[-1], erode=[0,0,0], filenames=True, featurenames=True, outfile='', overwrite=True, clear_file=True, write_empty=True, return_output=False, test=False, feature_parameters={}, prefetch=0, loader_threads=2, manifest_cache='', shard='', shard_method='hash', quantization='divide', bin_width=None, bin_edges=[], intensity_reference={}, erode_statistics=False):
+
+    """ If prefetch is greater than zero, up to that many upcoming images and labels are
+        loaded (and decompressed) by background threads while features are calculated
+        on the current one. This helps most when data lives on slow or network disks.
+
+        If manifest_cache is a filepath, the list of images and label-maps found in
+        folder is cached there and reused until a directory in folder changes.
+
+        If shard is 'i/N', only the i-th of N deterministic slices of the images in
+        folder is processed, and output goes to outfile with '_shard_i_of_N' added
+        before the extension. See shards.py for how to merge the shards afterwards.
+
+        quantization chooses how intensities are binned into levels for texture
+        features: 'divide' (the default, scaled to each image's maximum), 'z_score',
+        'fixed_width' (bin_width intensity units per level, capped at levels), or
+        'reference_edges'. For 'reference_edges', bin_edges can be an array of edges
+        or a filepath to load them from; if none are given, edges are computed once
+        over the whole cohort with 'levels' bins (or bins of bin_width, if
+        bin_width is set). The edges are saved next to outfile as
+        [outfile]_bin_edges.csv, and reused from there on later runs, so that
+        reruns and newly added images are quantized identically. When sharding, only
+        the first shard computes and saves them; the other shards wait for the file.
+
+        intensity_reference is a cohort-wide reference for 'divide' and 'z_score'
+        quantization in place of each image's own intensities. Build one with
+        qtim_utilities.intensity_sketch.create_cohort_intensity_sketch and
+        create_intensity_reference. It is applied once, to raw intensities, when they
+        are quantized; statistics features are still calculated on the voxels
+        statistics would otherwise use (quantized levels with normalize_intensities).
+
+        erode only shrinks the ROI used for texture features, unless erode_statistics
+        is set, in which case raw intensity statistics use the same eroded ROI.
+    """
+
+    total_features, feature_indexes, label_output = generate_feature_indices(features, featurenames, feature_parameters)
+
+    # Shards share one set of bin edges, so name the edges file before the outfile is renamed.
+    bin_edges_file = os.path.splitext(outfile)[0] + '_bin_edges.csv'
+
+    if shard != '':
+        shard_index, shard_count = shards.parse_shard(shard)
+        outfile = shards.shard_outfile_name(outfile, shard_index, shard_count)
 
     # This needs to be restructured, probably with a new method to iterate through images. Currently, this will not work
     # wtihout an output file. The conflict is between retaining the ability to append to files in real-time (to prevent
@@ -46,51 +96,78 @@ def generate_feature_list_batch(folder, features=['GLCM', 'morphology', 'statist
             csvfile = csv.writer(writefile, delimiter=',')
             csvfile.writerow(label_output[0,:])
 
-            imagepaths, label_images = generate_filename_list(folder, labels, label_suffix, recursive)
+            imagepaths, label_images = generate_filename_list(folder, labels, label_suffix, recursive, manifest_cache)
+
+            level_lookup = []
+            if quantization == 'fixed_width' and bin_width is None:
+                raise ValueError('Fixed-width quantization needs a bin_width.')
+            if quantization == 'reference_edges':
+                # Only one shard computes and saves the cohort's edges; the others wait for them.
+                if shard == '' or shard_index == 1:
+                    bin_edges = prepare_bin_edges(bin_edges, bin_edges_file, imagepaths, label_images, levels, bin_width, mask_value)
+                else:
+                    bin_edges = prepare_bin_edges(bin_edges, bin_edges_file, imagepaths, label_images, levels, bin_width, mask_value, compute=False, wait_seconds=bin_edges_wait_seconds)
+                level_lookup = nifti_util.build_level_lookup_table(bin_edges)
+                levels = len(bin_edges) - 1
+                print 'Quantizing against ' + str(levels) + ' cohort levels from ' + bin_edges_file
+
+            if shard != '':
+                imagepaths = shards.select_shard(imagepaths, folder, shard_index, shard_count, shard_method, label_images)
+                shard_parameters = {'features': features, 'labels': labels, 'label_suffix': label_suffix, 'recursive': recursive, 'levels': levels, 'normalize_intensities': normalize_intensities, 'mask_value': mask_value, 'use_labels': use_labels, 'erode': erode, 'filenames': filenames, 'feature_parameters': feature_parameters, 'shard_method': shard_method, 'quantization': quantization, 'bin_width': bin_width, 'bin_edges': list(bin_edges), 'intensity_reference': intensity_reference, 'erode_statistics': erode_statistics}
+                shard_record = shards.create_shard_record(shard_index, shard_count, imagepaths, shard_parameters)
+                shards.update_shard_record(shard_record, outfile)
             
             numerical_output = np.zeros((1, total_features), dtype=float)
             index_output = np.zeros((1, 1), dtype=object)
 
-            for imagepath in imagepaths:
+            if prefetch > 0:
+                image_iterator = prefetch_numpy_image_pairs(imagepaths, labels=labels, label_suffix=label_suffix, label_images=label_images, prefetch=prefetch, loader_threads=loader_threads)
+            else:
+                image_iterator = ((imagepath, []) for imagepath in imagepaths)
+
+            for imagepath, preloaded in image_iterator:
 
                 print '\n'
                 print 'Pre-processing data...'
 
-                image_list, unmodified_image_list, imagename_list, attributes_list = generate_numpy_images(imagepath, labels=labels, label_suffix=label_suffix, label_images=label_images, levels=levels, mask_value=mask_value, use_labels=use_labels, erode=erode)
-                
-                if image_list == []:
-                    if write_empty:
-                        empty_output = np.zeros((1, total_features + 1), dtype=object)
-                        empty_output[0,0] = imagepath
-                        csvfile.writerow(empty_output[0,:])
-                        continue
+                # ROIs are prepared one at a time, so only one is held in memory at once.
+                imagename_list = []
 
-                print 'Pre-processing complete!'
+                for image, unmodified_image, imagename, attributes in iterate_numpy_images(imagepath, labels=labels, label_suffix=label_suffix, label_images=label_images, levels=levels, mask_value=mask_value, use_labels=use_labels, erode=erode, preloaded=preloaded, quantization=quantization, bin_width=bin_width, bin_edges=bin_edges, level_lookup=level_lookup, intensity_reference=intensity_reference):
 
-                for image_idx, image in enumerate(image_list):
+                    imagename_list += [imagename]
 
                     print ''
                     print 'Working on image...'
-                    print imagename_list[image_idx]
+                    print imagename
                     print 'Voxel sum...'
                     print np.sum(image)
                     print 'Image shape...'
                     print image.shape
 
                     if filenames:
-                        index = imagename_list[image_idx]
+                        index = imagename
                     else:
                         index = numerical_output.shape[0]
 
                     if numerical_output[0,0] == 0:
-                        numerical_output[0, :] = generate_feature_list_method(image, unmodified_image_list[image_idx], attributes_list[image_idx], features, feature_indexes, total_features, levels, mask_value=mask_value, normalize_intensities=normalize_intensities)
+                        numerical_output[0, :] = generate_feature_list_method(image, unmodified_image, attributes, features, feature_indexes, total_features, levels, mask_value=mask_value, normalize_intensities=normalize_intensities, feature_parameters=feature_parameters, erode_statistics=erode_statistics)
                         index_output[0,:] = index
                     else:
-                        numerical_output = np.vstack((numerical_output, generate_feature_list_method(image, unmodified_image_list[image_idx], attributes_list[image_idx], features, feature_indexes, total_features, levels, mask_value=mask_value, normalize_intensities=normalize_intensities)))
+                        numerical_output = np.vstack((numerical_output, generate_feature_list_method(image, unmodified_image, attributes, features, feature_indexes, total_features, levels, mask_value=mask_value, normalize_intensities=normalize_intensities, feature_parameters=feature_parameters, erode_statistics=erode_statistics)))
                         index_output = np.vstack((index_output, index))
 
                     csvfile.writerow(np.hstack((index_output[-1,:], numerical_output[-1,:])))
 
+                if imagename_list == [] and write_empty:
+                    empty_output = np.zeros((1, total_features + 1), dtype=object)
+                    empty_output[0,0] = imagepath
+                    csvfile.writerow(empty_output[0,:])
+
+                if shard != '':
+                    writefile.flush()
+                    shards.update_shard_record(shard_record, outfile, imagepath, imagename_list)
+
     final_output = np.hstack((index_output, numerical_output))
 
     print 'Feature writing complete, writing output...'
@@ -102,9 +179,9 @@ def generate_feature_list_batch(folder, features=['GLCM', 'morphology', 'statist
     if return_output:
         return final_output
 
-def generate_feature_list_single(vol_filename, features=['GLCM', 'morphology', 'statistics'], labels=False, label_filename='',label_suffix="-label", decisions=False, levels=255, filenames=True, featurenames=True, outfile='', overwrite=True, write_empty=True, mask_value=0, test=False, use_labels=[-1], erode=0):
+def generate_feature_list_single(vol_filename, features=['GLCM', 'morphology', 'statistics'], labels=False, label_filename='',label_suffix="-label", decisions=False, levels=255, filenames=True, featurenames=True, outfile='', overwrite=True, write_empty=True, mask_value=0, test=False, use_labels=[-1], erode=0, feature_parameters={}):
     
-    total_features, feature_indexes, label_output = generate_feature_indices(features, featurenames)
+    total_features, feature_indexes, label_output = generate_feature_indices(features, featurenames, feature_parameters)
 
     if outfile != '':
         outfile = determine_outfile_name(outfile, overwrite)
@@ -116,7 +193,7 @@ def generate_feature_list_single(vol_filename, features=['GLCM', 'morphology', '
             numerical_output = np.zeros((1, total_features), dtype=float)
             index_output = np.zeros((1, 1), dtype=object)
 
-            final_output = write_image_method(vol_filename, label_filename, csvfile, total_features, features, feature_indexes, numerical_output, index_output, labels=False, label_suffix='-label', levels=100, mask_value=0, use_labels=[-1], erode=0, write_empty=False)
+            final_output = write_image_method(vol_filename, label_filename, csvfile, total_features, features, feature_indexes, numerical_output, index_output, labels=False, label_suffix='-label', levels=100, mask_value=0, use_labels=[-1], erode=0, write_empty=False, feature_parameters=feature_parameters)
 
     print 'Feature writing complete, writing output...'
     print '\n'
@@ -125,9 +202,9 @@ def generate_feature_list_single(vol_filename, features=['GLCM', 'morphology', '
 
     return final_output
 
-def generate_feature_list_parallel(folder, features=['GLCM', 'morphology', 'statistics'], recursive=False, labels=False, label_suffix="-label", decisions=False, levels=255, mask_value=0, use_labels=[-1], erode=[0,0,0], filenames=True, featurenames=True, outfile='', overwrite=True, clear_file=True, write_empty=True, return_output=False, test=False, processes=1):
+def generate_feature_list_parallel(folder, features=['GLCM', 'morphology', 'statistics'], recursive=False, labels=False, label_suffix="-label", decisions=False, levels=255, mask_value=0, use_labels=[-1], erode=[0,0,0], filenames=True, featurenames=True, outfile='', overwrite=True, clear_file=True, write_empty=True, return_output=False, test=False, processes=1, feature_parameters={}, manifest_cache=''):
 
-    total_features, feature_indexes, label_output = generate_feature_indices(features, featurenames)
+    total_features, feature_indexes, label_output = generate_feature_indices(features, featurenames, feature_parameters)
 
     if outfile != '':
         outfile = determine_outfile_name(outfile, overwrite)
@@ -135,7 +212,7 @@ def generate_feature_list_parallel(folder, features=['GLCM', 'morphology', 'stat
         if clear_file:
             open(outfile, 'w').close()
 
-        imagepaths, label_images = generate_filename_list(folder, labels, label_suffix, recursive)
+        imagepaths, label_images = generate_filename_list(folder, labels, label_suffix, recursive, manifest_cache)
         
         numerical_output = np.zeros((1, total_features), dtype=float)
         index_output = np.zeros((1, 1), dtype=object)
@@ -146,11 +223,11 @@ def generate_feature_list_parallel(folder, features=['GLCM', 'morphology', 'stat
         print 'Dividing data into ' + str(processes) + ' subgroups of length.. ' + str(int(sublength)) + ' units.'
 
         for i in xrange(processes - 1):
-            subunits += [[imagepaths[int(i*sublength):int((i+1)*sublength)], label_images[int(i*sublength):int((i+1)*sublength)]]]
+            subunits += [[imagepaths[int(i*sublength):int((i+1)*sublength)], label_images]]
 
-        subunits += [[imagepaths[int((processes - 1)*sublength):], label_images[int((processes - 1)*sublength):]]]
+        subunits += [[imagepaths[int((processes - 1)*sublength):], label_images]]
 
-        subprocess = partial(generate_feature_list_chunk, total_features=total_features, feature_indexes=feature_indexes, label_output=label_output, features=features, labels=labels, label_suffix=label_suffix, levels=levels, mask_value=mask_value, use_labels=use_labels, erode=erode, write_empty=write_empty, filenames=filenames)
+        subprocess = partial(generate_feature_list_chunk, total_features=total_features, feature_indexes=feature_indexes, label_output=label_output, features=features, labels=labels, label_suffix=label_suffix, levels=levels, mask_value=mask_value, use_labels=use_labels, erode=erode, write_empty=write_empty, filenames=filenames, feature_parameters=feature_parameters)
 
         optimization_pool = Pool(processes)
         results = optimization_pool.map(subprocess, subunits)
@@ -176,7 +253,7 @@ def generate_feature_list_parallel(folder, features=['GLCM', 'morphology', 'stat
     if return_output:
         return final_output
 
-def generate_feature_list_chunk(data, total_features, feature_indexes, label_output, features=['GLCM', 'morphology', 'statistics'], labels=False, label_suffix="-label", levels=255, mask_value=0, use_labels=[-1], erode=[0,0,0], write_empty=True, filenames=True):
+def generate_feature_list_chunk(data, total_features, feature_indexes, label_output, features=['GLCM', 'morphology', 'statistics'], labels=False, label_suffix="-label", levels=255, mask_value=0, use_labels=[-1], erode=[0,0,0], write_empty=True, filenames=True, feature_parameters={}):
 
     imagepaths = data[0]
     label_images = data[1]
@@ -191,86 +268,81 @@ def generate_feature_list_chunk(data, total_features, feature_indexes, label_out
         print '\n'
         print 'Pre-processing data...'
 
-        image_list, unmodified_image_list, imagename_list, attributes_list = generate_numpy_images(imagepath, labels=labels, label_suffix=label_suffix, label_images=label_images, levels=levels, mask_value=mask_value, use_labels=use_labels, erode=erode)
-        
-        if image_list == []:
-            if write_empty:
-                empty_output = np.zeros((1, total_features + 1), dtype=object)
-                empty_output[0,0] = imagepath
-                output_data = np.vstack(output_data, empty_output)
-                continue
+        roi_count = 0
 
-        print 'Pre-processing complete!'
+        for image, unmodified_image, imagename, attributes in iterate_numpy_images(imagepath, labels=labels, label_suffix=label_suffix, label_images=label_images, levels=levels, mask_value=mask_value, use_labels=use_labels, erode=erode):
 
-        for image_idx, image in enumerate(image_list):
+            roi_count += 1
 
             print ''
             print 'Working on image...'
-            print imagename_list[image_idx]
+            print imagename
             print 'Voxel sum...'
             print np.sum(image)
             print 'Image shape...'
             print image.shape
 
             if filenames:
-                index = imagename_list[image_idx]
+                index = imagename
             else:
                 index = numerical_output.shape[0]
 
             if numerical_output[0,0] == 0:
-                numerical_output[0, :] = generate_feature_list_method(image, unmodified_image_list[image_idx], attributes_list[image_idx], features, feature_indexes, total_features, levels, mask_value=0)
+                numerical_output[0, :] = generate_feature_list_method(image, unmodified_image, attributes, features, feature_indexes, total_features, levels, mask_value=0, feature_parameters=feature_parameters)
                 index_output[0,:] = index
             else:
-                numerical_output = np.vstack((numerical_output, generate_feature_list_method(image, unmodified_image_list[image_idx], attributes_list[image_idx], features, feature_indexes, total_features, levels, mask_value=0)))
+                numerical_output = np.vstack((numerical_output, generate_feature_list_method(image, unmodified_image, attributes, features, feature_indexes, total_features, levels, mask_value=0, feature_parameters=feature_parameters)))
                 index_output = np.vstack((index_output, index))
 
             output_data = np.vstack((output_data, (np.hstack((index_output[-1,:], numerical_output[-1,:])))))
 
+        if roi_count == 0 and write_empty:
+            empty_output = np.zeros((1, total_features + 1), dtype=object)
+            empty_output[0,0] = imagepath
+            output_data = np.vstack((output_data, empty_output))
+
     return output_data
 
-def write_image_method(imagepath, label_images, csvfile, total_features, features, feature_indexes, numerical_output, index_output, labels=False, label_suffix='-label', levels=100, mask_value=0, use_labels=[-1], erode=0, write_empty=False):
+def write_image_method(imagepath, label_images, csvfile, total_features, features, feature_indexes, numerical_output, index_output, labels=False, label_suffix='-label', levels=100, mask_value=0, use_labels=[-1], erode=0, write_empty=False, feature_parameters={}):
 
     # This function is a bit clumsy. So many parameters..
 
     print '\n'
     print 'Pre-processing data...'
 
-    image_list, unmodified_image_list, imagename_list, attributes_list = generate_numpy_images(imagepath, labels=labels, label_suffix=label_suffix, label_images=label_images, levels=levels, mask_value=mask_value, use_labels=use_labels, erode=erode)
-    
-    if image_list == []:
-        if write_empty:
-            empty_output = np.zeros((1, total_features + 1), dtype=object)
-            empty_output[0,0] = imagepath
-            print 'Writing empty row in place of missing data...'
-            csvfile.writerow(empty_output[0,:])
+    roi_count = 0
 
-    else:
+    for image, unmodified_image, imagename, attributes in iterate_numpy_images(imagepath, labels=labels, label_suffix=label_suffix, label_images=label_images, levels=levels, mask_value=mask_value, use_labels=use_labels, erode=erode):
 
-        print 'Pre-processing complete!'
+        roi_count += 1
 
-        for image_idx, image in enumerate(image_list):
+        print ''
+        print 'Working on image...'
+        print imagename
+        print 'Voxel sum...'
+        print np.sum(image)
+        print 'Image shape...'
+        print image.shape
 
-            print ''
-            print 'Working on image...'
-            print imagename_list[image_idx]
-            print 'Voxel sum...'
-            print np.sum(image)
-            print 'Image shape...'
-            print image.shape
+        if filenames:
+            index = imagename
+        else:
+            index = numerical_output.shape[0]
 
-            if filenames:
-                index = imagename_list[image_idx]
-            else:
-                index = numerical_output.shape[0]
+        if numerical_output[0,0] == 0:
+            numerical_output[0, :] = generate_feature_list_method(image, unmodified_image, attributes, features, feature_indexes, total_features, levels, mask_value=0, feature_parameters=feature_parameters)
+            index_output[0,:] = index
+        else:
+            numerical_output = np.vstack((numerical_output, generate_feature_list_method(image, unmodified_image, attributes, features, feature_indexes, total_features, levels, mask_value=0, feature_parameters=feature_parameters)))
+            index_output = np.vstack((index_output, index))
 
-            if numerical_output[0,0] == 0:
-                numerical_output[0, :] = generate_feature_list_method(image, unmodified_image_list[image_idx], attributes_list[image_idx], features, feature_indexes, total_features, levels, mask_value=0)
-                index_output[0,:] = index
-            else:
-                numerical_output = np.vstack((numerical_output, generate_feature_list_method(image, unmodified_image_list[image_idx], attributes_list[image_idx], features, feature_indexes, total_features, levels, mask_value=0)))
-                index_output = np.vstack((index_output, index))
+        csvfile.writerow(np.hstack((index_output[-1,:], numerical_output[-1,:])))
 
-            csvfile.writerow(np.hstack((index_output[-1,:], numerical_output[-1,:])))
+    if roi_count == 0 and write_empty:
+        empty_output = np.zeros((1, total_features + 1), dtype=object)
+        empty_output[0,0] = imagepath
+        print 'Writing empty row in place of missing data...'
+        csvfile.writerow(empty_output[0,:])
     
     return np.hstack((index_output, numerical_output))
 
@@ -292,160 +364,283 @@ def determine_outfile_name(outfile, overwrite=True):
 
     return outfile
 
-def generate_feature_indices(features=['GLCM', 'morphology', 'statistics'], featurenames=True):
+def generate_feature_indices(features=['GLCM', 'morphology', 'statistics'], featurenames=True, feature_parameters={}):
+
+    """ feature_parameters maps a feature family to the keyword arguments for that
+        family's feature_count, featurename_strings and features_from_intermediates
+        functions. For example, {'GLCM': {'distances': [1], 'props': ['contrast']},
+        'statistics': {'features': ['mean', 'median']}} will only calculate and
+        label those features. Families missing from the dictionary use their defaults.
+    """
 
     total_features = 0
     feature_indexes = [0]
+    label_output = []
 
     for feature in features:
-        total_features += feature_dictionary[feature].feature_count()
+        feature_count = feature_dictionary[feature].feature_count(**feature_parameters.get(feature, {}))
+        total_features += feature_count
         if feature_indexes == [0]:
-            feature_indexes = [0, feature_dictionary[feature].feature_count()]
+            feature_indexes = [0, feature_count]
         else:
-            feature_indexes += [feature_indexes[-1] + feature_dictionary[feature].feature_count()]
+            feature_indexes += [feature_indexes[-1] + feature_count]
     
     if featurenames:
         label_output = np.zeros((1, total_features+1), dtype=object)
         for feature_idx, feature in enumerate(features):
-            label_output[0, (1+feature_indexes[feature_idx]):(1+feature_indexes[feature_idx+1])] = feature_dictionary[feature].featurename_strings()
+            label_output[0, (1+feature_indexes[feature_idx]):(1+feature_indexes[feature_idx+1])] = feature_dictionary[feature].featurename_strings(**feature_parameters.get(feature, {}))
         label_output[0,0] = 'index'
 
     return [total_features, feature_indexes, label_output]
 
-def generate_filename_list(folder, labels=False, label_suffix='-label', recursive=False):
+def generate_filename_list(folder, labels=False, label_suffix='-label', recursive=False, manifest_cache=''):
 
-    if recursive:
-        imagepaths = []
-        for root, dirnames, filenames in os.walk(folder):
-            for filename in fnmatch.filter(filenames, '*.nii*'):
-                imagepaths.append(os.path.join(root, filename))
-    else:
-        imagepaths = glob.glob(os.path.join(folder, "*.nii*"))
+    """ Returns [imagepaths, label_images]. If labels are used, label_images is a
+        dictionary from each image path to its label-map path, built in one pass by
+        image_manifest; images without a label-map are left out of it. Files count as
+        label-maps if their name (before the extension) ends in label_suffix.
+    """
+
+    manifest = image_manifest.build_image_manifest(folder, label_suffix, recursive, manifest_cache)
+    image_manifest.report_image_manifest(manifest, labels)
 
-    # A bit redundant; this step and the previous step could probably be combined.
-    imagepaths = [x for x in imagepaths if (x.endswith('.nii') or x.endswith('.nii.gz'))]
+    imagepaths = manifest['imagepaths']
 
     if labels:
-        label_images = [ x for x in imagepaths if label_suffix in x ]
+        label_images = manifest['label_paths']
     else:
         label_images = []
 
-    imagepaths = [ x for x in imagepaths if label_suffix not in x ]
-
     if imagepaths == []:
         raise ValueError("There are no .nii or .nii.gz images in the provided folder.")
-    if labels and label_images == []:
+    if labels and not label_images:
         raise ValueError("There are no labels with the provided suffix in this folder. If you do not want to use labels, set the \'labels\' flag to \'False\'. If you want to change the label file suffix (default: \'-label\'), then change the \'label_suffix\' flag.")
 
     return [imagepaths, label_images]
 
-def generate_numpy_images(imagepath, labels=False, label_suffix='-label', label_images=[], mask_value=0, levels=255, use_labels=[-1], erode=0):
+def find_label_path(imagepath, label_suffix='-label', label_images=[]):
+
+    if isinstance(label_images, dict):
+        label_path = label_images.get(imagepath, '')
+    elif label_suffix == '':
+        label_path = label_images
+    else:
+        head, tail = os.path.split(imagepath)
+        split_path = str.split(tail, '.')
+        label_path = split_path[0] + label_suffix + '.' + '.'.join(split_path[1:])
+        label_path = os.path.join(head, label_path)
+
+    return label_path
+
+def load_numpy_image_pair(imagepath, labels=False, label_suffix='-label', label_images=[]):
+
+    """ Loads an image and, if labels are used, its label-map. This is kept apart
+        from generate_numpy_images so that loading can happen ahead of time in
+        another thread. Returns [image, label_image, label_path], where label_image
+        is [] if there is no label-map to load.
+    """
 
-    image_list = []
-    unmodified_image_list = []
-    imagename_list = []
-    attributes_list = []
-    
     # nifti_util.save_alternate_nifti(imagepath, levels, mask_value=mask_value)
-    image = nifti_util.nifti_2_numpy(imagepath)
+    # Both are kept in their on-disk dtypes, and memory-mapped if uncompressed;
+    # ROIs are cast to float once cropped in iterate_numpy_images.
+    image = nifti_util.nifti_2_numpy(imagepath, dtype=None)
+    label_image = []
+    label_path = ''
+
+    if labels:
+        label_path = find_label_path(imagepath, label_suffix, label_images)
+
+        # Label-maps from a manifest are known to exist, so skip checking the disk again.
+        if isinstance(label_images, dict):
+            label_exists = label_path != ''
+        else:
+            label_exists = os.path.isfile(label_path)
+
+        if label_exists:
+            label_image = nifti_util.nifti_2_numpy(label_path, dtype=None)
+
+    return [image, label_image, label_path]
+
+def prefetch_numpy_image_pairs(imagepaths, labels=False, label_suffix='-label', label_images=[], prefetch=2, loader_threads=2):
+
+    """ Yields [imagepath, preloaded] in the order of imagepaths, where preloaded is
+        the output of load_numpy_image_pair. Up to 'prefetch' pairs are kept loading
+        in a pool of 'loader_threads' threads while the caller works on the current
+        pair, so at most prefetch + 1 pairs are held in memory at once. Decompression
+        and disk reads release the GIL, so threads are enough to overlap them with
+        feature calculation.
+    """
+
+    loader = partial(load_numpy_image_pair, labels=labels, label_suffix=label_suffix, label_images=label_images)
+    loader_pool = ThreadPool(loader_threads)
+    pending_loads = deque()
+    remaining_paths = iter(imagepaths)
+
+    try:
+        for imagepath in remaining_paths:
+            pending_loads.append([imagepath, loader_pool.apply_async(loader, (imagepath,))])
+            if len(pending_loads) >= prefetch:
+                break
+
+        while len(pending_loads) > 0:
+            imagepath, pending_load = pending_loads.popleft()
+
+            next_imagepath = next(remaining_paths, None)
+            if next_imagepath is not None:
+                pending_loads.append([next_imagepath, loader_pool.apply_async(loader, (next_imagepath,))])
+
+            yield [imagepath, pending_load.get()]
+
+    finally:
+        loader_pool.terminate()
+
+def prepare_bin_edges(bin_edges, bin_edges_file, imagepaths, label_images=[], levels=255, bin_width=None, mask_value=0, compute=True, wait_seconds=0):
+
+    """ Returns cohort bin edges for 'reference_edges' quantization. bin_edges may
+        be an array or a filepath to load. If it is empty, edges already saved at
+        bin_edges_file are reused, and if there are none, they are computed over
+        imagepaths. Whatever edges are used get saved to bin_edges_file.
+
+        With compute set to False (as for every shard but the first), nothing is
+        computed or saved: edges are read from bin_edges_file, waiting up to
+        wait_seconds for another process to write them.
+    """
+
+    if isinstance(bin_edges, basestring):
+        bin_edges = nifti_util.load_bin_edges(bin_edges)
+    elif len(bin_edges) == 0:
+        if not compute:
+            waited = 0
+            if not os.path.isfile(bin_edges_file):
+                print 'Waiting for cohort bin edges at ' + bin_edges_file + '...'
+            while not os.path.isfile(bin_edges_file):
+                if waited >= wait_seconds:
+                    raise ValueError('No cohort bin edges were found at ' + bin_edges_file + '. They are computed by the first shard, or can be passed in as bin_edges.')
+                time.sleep(10)
+                waited += 10
+        if os.path.isfile(bin_edges_file):
+            return nifti_util.load_bin_edges(bin_edges_file)
+        if not isinstance(label_images, dict):
+            label_images = {}
+        print 'Computing cohort bin edges over ' + str(len(imagepaths)) + ' images...'
+        bin_edges = nifti_util.compute_cohort_bin_edges(imagepaths, label_images, levels, bin_width, mask_value)
+
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    if compute:
+        nifti_util.save_bin_edges(bin_edges, bin_edges_file)
+
+    return bin_edges
+
+def iterate_numpy_images(imagepath, labels=False, label_suffix='-label', label_images=[], mask_value=0, levels=255, use_labels=[-1], erode=0, preloaded=[], quantization='divide', bin_width=None, bin_edges=[], level_lookup=[], intensity_reference={}):
+
+    """ Yields [image, unmodified_image, imagename, attributes] for each ROI in an
+        image, preparing each ROI only when it is asked for. This way only one ROI
+        is held in memory at a time, rather than two copies of every ROI in the image.
+        Images that will be skipped yield nothing.
+    """
+
+    if preloaded == []:
+        preloaded = load_numpy_image_pair(imagepath, labels, label_suffix, label_images)
+
+    image, label_image, label_path = preloaded
 
     # This is likely redundant with the basic assert function in nifti_util
     if not nifti_util.assert_3D(image):
         print 'Warning: image at path ' + imagepath + ' has multiple time points or otherwise greater than 3 dimensions, and will be skipped.'
-        return [[],[],[],[]]
+        return
 
     if labels:
 
-        if label_suffix == '':
-            label_path = label_images
-        else:
-            head, tail = os.path.split(imagepath)
-            split_path = str.split(tail, '.')
-            label_path = split_path[0] + label_suffix + '.' + '.'.join(split_path[1:])
-            label_path = os.path.join(head, label_path)
-
-        if os.path.isfile(label_path):
-            label_image = nifti_util.nifti_2_numpy(label_path)
+        # load_numpy_image_pair leaves label_image as [] if there is no label-map.
+        if isinstance(label_image, list):
+            print 'Warning: image at path ' + imagepath + ' has no label-map, and will be skipped.'
+            return
 
-            if label_image.shape != image.shape:
-                print 'Warning: image and label do not have the same dimensions. Imaging padding support has not yet been added. This image will be skipped.'
-                return [[],[],[],[]]
+        if label_image.shape != image.shape:
+            print 'Warning: image and label do not have the same dimensions. Imaging padding support has not yet been added. This image will be skipped.'
+            return
 
-            # In the future: create an option to analyze each frame separately.
-            if not nifti_util.assert_3D(label_image):
-                print 'Warning: image at path ' + imagepath + ' has multiple time points or otherwise greater than 3 dimensions, and will be skipped.'
-                return [[],[],[],[]]
+        # In the future: create an option to analyze each frame separately.
+        if not nifti_util.assert_3D(label_image):
+            print 'Warning: image at path ' + imagepath + ' has multiple time points or otherwise greater than 3 dimensions, and will be skipped.'
+            return
 
+        # Integer label-maps are used as loaded, so a memory-mapped map is never copied whole.
+        if label_image.dtype.kind not in 'iu':
             label_image = label_image.astype(int)
-            label_indices = np.unique(label_image)
-
-            if label_indices.size == 1:
-                print 'Warning: image at path ' + imagepath + ' has an empty label-map, and will be skipped.'
-                return[[],[],[],[]]
+        label_indices = np.unique(label_image)
 
-            # Will break if someone puts in '0' as a label to use.
-            if use_labels[0] != -1:
-                label_indices = np.array([0] + [x for x in label_indices if x in use_labels])
+        if label_indices.size == 1:
+            print 'Warning: image at path ' + imagepath + ' has an empty label-map, and will be skipped.'
+            return
 
-            masked_images = nifti_util.mask_nifti(image, label_image, label_indices, mask_value=mask_value)
+        # Will break if someone puts in '0' as a label to use.
+        if use_labels[0] != -1:
+            label_indices = np.array([0] + [x for x in label_indices if x in use_labels])
 
-            for masked_image in masked_images:
+        filename = str.split(label_path, '\\')[-1]
 
-                # nifti_util.check_tumor_histogram(masked_image, second_image_numpy=image, mask_value=mask_value, image_name = str.split(imagepath, '\\')[-1])
-                # nifti_util.check_image(masked_image, mode="maximal_slice")
+        if label_indices.size == 2:
+            imagename_list = [filename]
+        else:
+            split_filename = str.split(filename, '.')
+            imagename_list = [split_filename[0] + '_' + str(int(labelval)) + '.' + split_filename[1] for labelval in label_indices[1:]]
 
-                unmodified_image_list += [np.copy(masked_image)]
+        attributes = nifti_util.return_nifti_attributes(imagepath)
 
-                masked_image = nifti_util.coerce_levels(masked_image, levels=levels, reference_image=image, method="divide", mask_value=mask_value)
+        for label_idx, masked_image in enumerate(nifti_util.iterate_masked_niftis(image, label_image, label_indices, mask_value=mask_value)):
 
-                # nifti_util.check_image(masked_image, mode="maximal_slice")
+            # nifti_util.check_tumor_histogram(masked_image, second_image_numpy=image, mask_value=mask_value, image_name = str.split(imagepath, '\\')[-1])
+            # nifti_util.check_image(masked_image, mode="maximal_slice")
 
-                # It would be nice in the future to check if an image is too small to erode. Maybe a minimum-size parameter?
-                # Or maybe a "maximum volume reduction by erosion?" Hmm..
-                masked_image = nifti_util.erode_label(masked_image, iterations=erode)
+            unmodified_image = masked_image.astype(float)
 
-                # nifti_util.check_image(masked_image, mode="maximal_slice")
+            # Level lookup tables only work on integers, so integer ROIs are quantized before they are cast to float.
+            if quantization == 'reference_edges' and level_lookup != [] and masked_image.dtype.kind in 'iu':
+                masked_image = nifti_util.coerce_levels(masked_image.astype(int), levels=levels, method=quantization, mask_value=mask_value, bin_edges=bin_edges, level_lookup=level_lookup).astype(float)
+            else:
+                masked_image = nifti_util.coerce_levels(np.copy(unmodified_image), levels=levels, reference_image=image, method=quantization, mask_value=mask_value, bin_width=bin_width, bin_edges=bin_edges, level_lookup=level_lookup, intensity_reference=intensity_reference)
 
-                image_list += [masked_image]
+            # nifti_util.check_image(masked_image, mode="maximal_slice")
 
-            filename = str.split(label_path, '\\')[-1]
+            # It would be nice in the future to check if an image is too small to erode. Maybe a minimum-size parameter?
+            # Or maybe a "maximum volume reduction by erosion?" Hmm..
+            masked_image = nifti_util.erode_label(masked_image, iterations=erode)
 
-            if label_indices.size == 2:
-                imagename_list += [filename]
-            else:
-                split_filename = str.split(filename, '.')
-                for labelval in label_indices[1:]:
-                    filename = split_filename[0] + '_' + str(int(labelval)) + '.' + split_filename[1]
-                    imagename_list += [filename]
+            # nifti_util.check_image(masked_image, mode="maximal_slice")
 
-            attributes_list += [nifti_util.return_nifti_attributes(imagepath)] * (label_indices.size - 1)
-            print 'Finished... ' + str.split(imagepath, '\\')[-1]
+            yield [masked_image, unmodified_image, imagename_list[label_idx], attributes]
 
-        else:
-            print 'Warning: image at path ' + imagepath + ' has no label-map, and will be skipped.'
-            return[[],[],[],[]]
+        print 'Finished... ' + str.split(imagepath, '\\')[-1]
 
     else:
-        image = nifti_util.coerce_levels(image, levels=levels, reference_image=image, method="divide", mask_value=mask_value)
+        image = nifti_util.coerce_levels(np.array(image, dtype=float), levels=levels, reference_image=image, method=quantization, mask_value=mask_value, bin_width=bin_width, bin_edges=bin_edges, level_lookup=level_lookup, intensity_reference=intensity_reference)
+        yield [image, image, imagepath, nifti_util.return_nifti_attributes(imagepath)]
+
+def generate_numpy_images(imagepath, labels=False, label_suffix='-label', label_images=[], mask_value=0, levels=255, use_labels=[-1], erode=0, preloaded=[], quantization='divide', bin_width=None, bin_edges=[], level_lookup=[], intensity_reference={}):
+
+    """ Returns every ROI from iterate_numpy_images at once, as
+        [image_list, unmodified_image_list, imagename_list, attributes_list].
+        Images with many labels are better processed with iterate_numpy_images.
+    """
+
+    image_list = []
+    unmodified_image_list = []
+    imagename_list = []
+    attributes_list = []
+
+    for image, unmodified_image, imagename, attributes in iterate_numpy_images(imagepath, labels, label_suffix, label_images, mask_value, levels, use_labels, erode, preloaded, quantization, bin_width, bin_edges, level_lookup, intensity_reference):
         image_list += [image]
-        unmodified_image_list += [image]
-        imagename_list += [imagepath]
-        attributes_list += [nifti_util.return_nifti_attributes(imagepath)]
+        unmodified_image_list += [unmodified_image]
+        imagename_list += [imagename]
+        attributes_list += [attributes]
 
     return [image_list, unmodified_image_list, imagename_list, attributes_list]
 
-def generate_feature_list_method(image, unmodified_image, attributes, features, feature_indexes='', total_features='', levels=-1, mask_value=0, normalize_intensities=False):
+def generate_feature_list_method(image, unmodified_image, attributes, features, feature_indexes='', total_features='', levels=-1, mask_value=0, normalize_intensities=False, feature_parameters={}, erode_statistics=False):
 
     if feature_indexes == '' or total_features == '':
-        total_features = 0
-        feature_indexes = [0]
-
-        for feature in features:
-            total_features += feature_dictionary[feature].feature_count()
-            if feature_indexes == [0]:
-                feature_indexes = [0, feature_dictionary[feature].feature_count()]
-            else:
-                feature_indexes += [feature_indexes[-1] + feature_dictionary[feature].feature_count()]
+        total_features, feature_indexes, label_output = generate_feature_indices(features, False, feature_parameters)
 
     numerical_output = np.zeros((1, total_features), dtype=float)
 
@@ -453,33 +648,18 @@ def generate_feature_list_method(image, unmodified_image, attributes, features,
         print 'Warning: image is empty, either because it could not survive erosion or because of another error. It will be skipped.'
         return numerical_output
 
-    for feature_idx, feature in enumerate(features):
-
-        if feature == 'GLCM':
-
-            # nifti_util.check_tumor_histogram(image, mask_value)
-            # nifti_util.check_image(image, mode="maximal_slice")
+    # Intermediates shared between feature families (masks, voxel lists, etc.) are built once per ROI.
+    roi_intermediates = intermediates.create_intermediates(image, unmodified_image, attributes, levels=levels, mask_value=mask_value, normalize_intensities=normalize_intensities, erode_statistics=erode_statistics)
 
-            glcm_image = np.copy(image)
-            glcm_image = glcm_image.astype(int)
-            levels += 1
-            print 'Calculating GLCM...'
-            numerical_output[0, feature_indexes[feature_idx]:feature_indexes[feature_idx+1]] = GLCM.glcm_features(glcm_image, levels=levels)
-
-        if feature == 'morphology':
-
-            print 'Calculating morphology features...'
-            numerical_output[0, feature_indexes[feature_idx]:feature_indexes[feature_idx+1]] = morphology.morphology_features(unmodified_image, attributes)
-
-        if feature == 'statistics':
+    for feature_idx, feature in enumerate(features):
 
-            # Should intensity statistics be eroded? Currently, they are not, as indicated by the "unmodified image" parameter.
+        # nifti_util.check_tumor_histogram(image, mask_value)
+        # nifti_util.check_image(image, mode="maximal_slice")
 
-            print 'Calculating statistical features...'
-            if normalize_intensities:
-                numerical_output[0, feature_indexes[feature_idx]:feature_indexes[feature_idx+1]] = statistics.statistics_features(glcm_image)
-            else:
-                numerical_output[0, feature_indexes[feature_idx]:feature_indexes[feature_idx+1]] = statistics.statistics_features(unmodified_image)
+        print 'Calculating ' + feature + ' features...'
+        feature_module = feature_dictionary[feature]
+        intermediates.resolve_intermediates(roi_intermediates, feature_module.intermediates)
+        numerical_output[0, feature_indexes[feature_idx]:feature_indexes[feature_idx+1]] = feature_module.features_from_intermediates(roi_intermediates, **feature_parameters.get(feature, {}))
 
     print '\n'
 
@@ -562,8 +742,8 @@ def test():
 
     generate_feature_list_batch(folder=test_folder, features=features, labels=labels, levels=levels, outfile=outfile, mask_value=mask_value, erode=erode, overwrite=overwrite)
 
-def extract_features(folder, outfile, labels=True, features=['GLCM','morphology', 'statistics'], levels = 100, mask_value = 0, erode = [0,0,0], overwrite = True, label_suffix='-label', universal_label=''):
-    generate_feature_list_batch(folder=folder, outfile=outfile, labels=labels, features=features, levels=levels, mask_value=mask_value, erode=erode, overwrite=overwrite, label_suffix=label_suffix, universal_label=universal_label)
+def extract_features(folder, outfile, labels=True, features=['GLCM','morphology', 'statistics'], levels = 100, mask_value = 0, erode = [0,0,0], overwrite = True, label_suffix='-label', universal_label='', feature_parameters={}, quantization='divide', bin_width=None, bin_edges=[]):
+    generate_feature_list_batch(folder=folder, outfile=outfile, labels=labels, features=features, levels=levels, mask_value=mask_value, erode=erode, overwrite=overwrite, label_suffix=label_suffix, universal_label=universal_label, feature_parameters=feature_parameters, quantization=quantization, bin_width=bin_width, bin_edges=bin_edges)
 
 if __name__ == "__main__":
 
@@ -0,0 +1,215 @@
+""" Finding images and their label-maps used to mean globbing every file,
+    filtering the list several times for the label suffix, and then checking
+    for each image's label on disk. On trees with hundreds of thousands of
+    files that takes minutes. This module walks the tree once with scandir,
+    pairs images with labels in a single dictionary pass, and can cache the
+    result so that later runs only have to stat each directory to confirm
+    that nothing has been added, removed, or renamed.
+
+    A manifest is a dictionary with the keys 'imagepaths' (sorted image
+    paths), 'label_paths' (image path to label path, for labeled images),
+    'unlabeled_images', 'orphan_labels' (labels with no matching image), and
+    'directories' (directory path to modification time, used to invalidate
+    the cache).
+"""
+
+import os
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# os.scandir only exists from Python 3.5 on. The 'scandir' package backports it,
+# and if neither is around we fall back to listdir and isdir, which is slower but
+# gives the same result.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+nifti_extensions = ['nii', 'nii.gz']
+
+# Bumped whenever scanning changes, so that caches from older scans are rebuilt.
+manifest_version = 2
+
+def list_directory(directory):
+
+    """ Returns [filenames, subdirectories] for a directory. With scandir, whether an
+        entry is a directory usually comes from the directory listing itself, so no
+        file has to be stat-ed.
+    """
+
+    filenames = []
+    subdirectories = []
+
+    if scandir is not None:
+        for entry in scandir(directory):
+            if entry.is_dir():
+                subdirectories += [entry.name]
+            else:
+                filenames += [entry.name]
+    else:
+        for name in os.listdir(directory):
+            if os.path.isdir(os.path.join(directory, name)):
+                subdirectories += [name]
+            else:
+                filenames += [name]
+
+    return [filenames, subdirectories]
+
+def scan_nifti_files(folder, recursive=False):
+
+    """ Returns [nifti_files, directories], where nifti_files is a list of
+        [directory, stem, extension] for every .nii or .nii.gz file, and directories
+        maps every directory visited to its modification time.
+    """
+
+    nifti_files = []
+    directories = {}
+    unvisited = [folder]
+
+    while unvisited:
+
+        directory = unvisited.pop()
+        directories[directory] = os.stat(directory).st_mtime
+
+        filenames, subdirectories = list_directory(directory)
+
+        # Stems can have dots of their own (e.g. sub-01.T1.nii.gz), so only the suffix is matched.
+        for filename in filenames:
+            for extension in nifti_extensions:
+                if filename.endswith('.' + extension):
+                    nifti_files += [[directory, filename[:-len(extension) - 1], extension]]
+                    break
+
+        if recursive:
+            unvisited += [os.path.join(directory, subdirectory) for subdirectory in subdirectories]
+
+    return [nifti_files, directories]
+
+def pair_nifti_files(nifti_files, label_suffix='-label'):
+
+    """ Sorts scanned files into images and labels in one pass. An image 'scan.nii.gz'
+        is paired with 'scan' + label_suffix + '.nii.gz' in the same directory, which
+        is the same naming rule generate_numpy_images has always used.
+    """
+
+    images = {}
+    labels = {}
+
+    for directory, stem, extension in nifti_files:
+
+        filepath = os.path.join(directory, stem + '.' + extension)
+
+        if label_suffix != '' and stem.endswith(label_suffix):
+            labels[(directory, stem[:-len(label_suffix)], extension)] = filepath
+        else:
+            images[(directory, stem, extension)] = filepath
+
+    label_paths = {}
+    unlabeled_images = []
+
+    for key, imagepath in images.iteritems():
+        if key in labels:
+            label_paths[imagepath] = labels[key]
+        else:
+            unlabeled_images += [imagepath]
+
+    orphan_labels = [label_path for key, label_path in labels.iteritems() if key not in images]
+
+    return {'imagepaths': sorted(images.values()), 'label_paths': label_paths, 'unlabeled_images': sorted(unlabeled_images), 'orphan_labels': sorted(orphan_labels)}
+
+def manifest_is_current(manifest, folder, label_suffix='-label', recursive=False):
+
+    """ A cached manifest is reused if it was built with the same settings and
+        none of the directories it covers have been modified since. Adding,
+        removing, or renaming a file or subdirectory changes the modification
+        time of the directory that holds it.
+    """
+
+    if manifest.get('version') != manifest_version or manifest.get('folder') != folder or manifest.get('label_suffix') != label_suffix or manifest.get('recursive') != recursive:
+        return False
+
+    for directory, mtime in manifest['directories'].iteritems():
+        try:
+            if os.stat(directory).st_mtime != mtime:
+                return False
+        except OSError:
+            return False
+
+    return True
+
+def load_image_manifest(cache_file):
+
+    try:
+        with open(cache_file, 'rb') as readfile:
+            return pickle.load(readfile)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return {}
+
+def save_image_manifest(manifest, cache_file):
+
+    try:
+        with open(cache_file, 'wb') as writefile:
+            pickle.dump(manifest, writefile, pickle.HIGHEST_PROTOCOL)
+
+        # Creating the cache file inside a scanned directory changes that directory's
+        # modification time, so record it again or the cache would never be reused.
+        cache_directory = os.path.dirname(os.path.abspath(cache_file))
+        for directory in manifest['directories']:
+            if os.path.abspath(directory) == cache_directory:
+                manifest['directories'][directory] = os.stat(directory).st_mtime
+                with open(cache_file, 'wb') as writefile:
+                    pickle.dump(manifest, writefile, pickle.HIGHEST_PROTOCOL)
+                break
+
+    except (IOError, OSError):
+        print 'Warning: could not write image manifest cache to ' + cache_file + '.'
+
+def build_image_manifest(folder, label_suffix='-label', recursive=False, cache_file=''):
+
+    """ Returns a manifest of the images and label-maps in folder. If cache_file is
+        given, a still-current manifest is read from it instead of scanning, and a
+        freshly scanned manifest is written to it.
+    """
+
+    if cache_file != '' and os.path.isfile(cache_file):
+        manifest = load_image_manifest(cache_file)
+        if manifest and manifest_is_current(manifest, folder, label_suffix, recursive):
+            return manifest
+
+    nifti_files, directories = scan_nifti_files(folder, recursive)
+
+    manifest = pair_nifti_files(nifti_files, label_suffix)
+    manifest['version'] = manifest_version
+    manifest['folder'] = folder
+    manifest['label_suffix'] = label_suffix
+    manifest['recursive'] = recursive
+    manifest['directories'] = directories
+
+    if cache_file != '':
+        save_image_manifest(manifest, cache_file)
+
+    return manifest
+
+def report_image_manifest(manifest, labels=True):
+
+    """ Prints images without label-maps and label-maps without images, so that
+        naming mistakes show up before a long run rather than in the middle of it.
+    """
+
+    print 'Found ' + str(len(manifest['imagepaths'])) + ' images in ' + manifest['folder'] + '.'
+
+    if labels:
+        if manifest['unlabeled_images']:
+            print 'Warning: ' + str(len(manifest['unlabeled_images'])) + ' images have no label-map, and will be skipped:'
+            for imagepath in manifest['unlabeled_images']:
+                print '    ' + imagepath
+        if manifest['orphan_labels']:
+            print 'Warning: ' + str(len(manifest['orphan_labels'])) + ' label-maps have no matching image:'
+            for label_path in manifest['orphan_labels']:
+                print '    ' + label_path
@@ -0,0 +1,118 @@
+""" Several feature families need the same preliminary arrays from an ROI:
+    a binary mask, a voxel count, a bounding box, the voxel values inside
+    the mask, and so on. Instead of every family rebuilding these, each
+    family module declares the intermediates it needs in a module-level
+    'intermediates' list, and resolve_intermediates builds each of them at
+    most once per ROI. Intermediates ask for the intermediates they depend
+    on through the 'get' function they are handed, so dependencies are
+    resolved lazily and only when something actually asks for them.
+
+    To add a new intermediate, write a function that takes 'get' and add
+    it to intermediate_dictionary. To add a new feature family, give its
+    module an 'intermediates' list and a features_from_intermediates
+    function, and add it to feature_dictionary in extract_features.
+"""
+
+from __future__ import division
+
+import numpy as np
+
+def intermediate_binary_mask(get):
+    return get('unmodified_image') != get('mask_value')
+
+def intermediate_voxel_count(get):
+    return int(np.sum(get('binary_mask')))
+
+def intermediate_bounding_box(get):
+
+    """ Slices covering every non-masked voxel. Empty ROIs get empty slices.
+    """
+
+    binary_mask = get('binary_mask')
+    bounding_box = []
+
+    for axis in xrange(binary_mask.ndim):
+        other_axes = tuple([k for k in xrange(binary_mask.ndim) if k != axis])
+        occupied = np.where(np.any(binary_mask, axis=other_axes))[0]
+        if occupied.size == 0:
+            bounding_box += [slice(0, 0)]
+        else:
+            bounding_box += [slice(occupied[0], occupied[-1] + 1)]
+
+    return tuple(bounding_box)
+
+def intermediate_cropped_roi(get):
+    return get('unmodified_image')[get('bounding_box')]
+
+def intermediate_cropped_mask(get):
+    return get('binary_mask')[get('bounding_box')]
+
+def intermediate_voxel_list(get):
+    return np.ravel(get('unmodified_image')[get('binary_mask')])
+
+def intermediate_quantized_roi(get):
+    return np.copy(get('image')).astype(int)
+
+def intermediate_quantized_voxel_list(get):
+
+    """ Quantized levels inside the ROI. coerce_levels marks masked voxels with
+        0 whatever the mask_value, and real levels start at 1.
+    """
+
+    quantized_roi = get('quantized_roi')
+    return np.ravel(quantized_roi[quantized_roi != 0])
+
+def intermediate_eroded_voxel_list(get):
+
+    """ Raw intensities inside the eroded ROI. Quantized ROIs mark masked and
+        eroded voxels with 0, so they double as the eroded mask.
+    """
+
+    return np.ravel(get('unmodified_image')[get('quantized_roi') != 0])
+
+def intermediate_statistics_voxel_list(get):
+
+    """ Intensity statistics are calculated either on raw intensities or,
+        if normalize_intensities is set, on the quantized levels. With
+        erode_statistics, raw intensities are limited to the eroded ROI.
+    """
+
+    if get('normalize_intensities'):
+        return get('quantized_voxel_list')
+    elif get('erode_statistics'):
+        return get('eroded_voxel_list')
+    else:
+        return get('voxel_list')
+
+intermediate_dictionary = {'binary_mask': intermediate_binary_mask,
+                            'voxel_count': intermediate_voxel_count,
+                            'bounding_box': intermediate_bounding_box,
+                            'cropped_roi': intermediate_cropped_roi,
+                            'cropped_mask': intermediate_cropped_mask,
+                            'voxel_list': intermediate_voxel_list,
+                            'quantized_roi': intermediate_quantized_roi,
+                            'quantized_voxel_list': intermediate_quantized_voxel_list,
+                            'eroded_voxel_list': intermediate_eroded_voxel_list,
+                            'statistics_voxel_list': intermediate_statistics_voxel_list}
+
+def create_intermediates(image, unmodified_image, attributes, levels=255, mask_value=0, normalize_intensities=False, erode_statistics=False):
+
+    """ Returns the per-ROI cache that resolve_intermediates fills in. The
+        entries here are the inputs every other intermediate is built from.
+    """
+
+    return {'image': image, 'unmodified_image': unmodified_image, 'attributes': attributes, 'levels': levels, 'mask_value': mask_value, 'normalize_intensities': normalize_intensities, 'erode_statistics': erode_statistics}
+
+def resolve_intermediates(intermediates, names):
+
+    def get(name):
+        if name not in intermediates:
+            if name not in intermediate_dictionary:
+                raise ValueError('%s is not a known feature intermediate.' % (name))
+            intermediates[name] = intermediate_dictionary[name](get)
+        return intermediates[name]
+
+    for name in names:
+        get(name)
+
+    return intermediates
@@ -46,7 +46,19 @@ def calc_surface_area(image_numpy, pixdims, mask_value=0):
         it is counting cubes instead of, say, triangular
         surfaces
     """
-    
+
+    label_numpy = np.copy(image_numpy)
+    label_numpy[label_numpy != mask_value] = 1
+    label_numpy[label_numpy == mask_value] = 0
+
+    return calc_surface_area_from_mask(label_numpy, pixdims)
+
+def calc_surface_area_from_mask(binary_mask, pixdims):
+
+    """ Same as calc_surface_area, for callers that already have a
+        binarized ROI on hand.
+    """
+
     edges_kernel = np.zeros((3,3,3),dtype=float)
     edges_kernel[1,1,0] = -1*pixdims[0]*pixdims[1]
     edges_kernel[0,1,1] = -1*pixdims[1]*pixdims[2]
@@ -56,11 +68,7 @@ def calc_surface_area(image_numpy, pixdims, mask_value=0):
     edges_kernel[1,1,2] = -1*pixdims[0]*pixdims[1]
     edges_kernel[1,1,1] = 1 * (2*pixdims[0]*pixdims[1] + 2*pixdims[0]*pixdims[2] + 2*pixdims[1]*pixdims[2])
 
-    label_numpy = np.copy(image_numpy)
-    label_numpy[label_numpy != mask_value] = 1
-    label_numpy[label_numpy == mask_value] = 0
-
-    edge_image = signal.convolve(label_numpy, edges_kernel,mode='same')
+    edge_image = signal.convolve(binary_mask.astype(float), edges_kernel,mode='same')
     edge_image[edge_image < 0] = 0
 
     # nifti_util.check_image(edge_image)
@@ -85,6 +93,9 @@ def sphericity(surface_area, volume):
     return (np.pi**(1/3)) * ((6 * volume)**(2/3)) / surface_area
 
 def morphology_features(image, attributes, features=['voxel_count','volume','surface_area','volume_surface_area_ratio','compactness','compactness_alternate','spherical_disproportion','sphericity'], mask_value=0):
+    return morphology_features_from_mask(image != mask_value, calc_voxel_count(image, mask_value), attributes, features)
+
+def morphology_features_from_mask(binary_mask, voxel_count, attributes, features=['voxel_count','volume','surface_area','volume_surface_area_ratio','compactness','compactness_alternate','spherical_disproportion','sphericity']):
 
     if isinstance(features, basestring):
         features = [features,]
@@ -92,13 +103,16 @@ def morphology_features(image, attributes, features=['voxel_count','volume','sur
     results = np.zeros(len(features), dtype=float)
     pixdims = attributes['pixdim'][1:4]
 
-    volume = calc_volume(image, pixdims, mask_value)
-    surface_area = calc_surface_area(image, pixdims, mask_value)
+    volume = pixdims[0] * pixdims[1] * pixdims[2] * voxel_count
+
+    # Surface area is by far the most expensive calculation here, so skip it if no requested feature needs it.
+    if [f for f in features if f not in ['voxel_count', 'volume']] != []:
+        surface_area = calc_surface_area_from_mask(binary_mask, pixdims)
 
     for f_idx, current_feature in enumerate(features):
 
         if current_feature == 'voxel_count':
-            output = calc_voxel_count(image, mask_value)
+            output = voxel_count
         if current_feature == 'volume':
             output = volume
         if current_feature == 'surface_area':
@@ -118,7 +132,14 @@ def morphology_features(image, attributes, features=['voxel_count','volume','sur
 
     return results
 
+intermediates = ['cropped_mask', 'voxel_count']
+
+def features_from_intermediates(intermediates, features=['voxel_count','volume','surface_area','volume_surface_area_ratio','compactness','compactness_alternate','spherical_disproportion','sphericity']):
+    return morphology_features_from_mask(intermediates['cropped_mask'], intermediates['voxel_count'], intermediates['attributes'], features)
+
 def featurename_strings(features=['voxel_count','volume','surface_area','volume_surface_area_ratio','compactness','compactness_alternate','spherical_disproportion','sphericity']):
+    if isinstance(features, basestring):
+        features = [features,]
     return features
 
 def feature_count(features=['voxel_count','volume','surface_area','volume_surface_area_ratio','compactness','compactness_alternate','spherical_disproportion','sphericity']):
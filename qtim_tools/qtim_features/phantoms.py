@@ -17,8 +17,8 @@ def size_cube_phantom(reference_image, output_folder):
 	for size_ratio in np.arange(.1, 1, .1):
 		phantom_3d = np.zeros((image_3d.shape[0], image_3d.shape[1], 1))
 		phantom_3d[(phantom_3d.shape[0]*(size_ratio/2)):(phantom_3d.shape[0] - (phantom_3d.shape[0]*(size_ratio/2))), (phantom_3d.shape[1]*(size_ratio/2)):(phantom_3d.shape[1] - (phantom_3d.shape[1]*(size_ratio/2))),0] = 1
-		nifti_util.save_numpy_2_nifti(phantom_3d, reference_image, os.path.join(output_folder, 'Size_' + str(int(10*(1-size_ratio))) + '_Phantom.nii.gz'))
-		nifti_util.save_numpy_2_nifti(phantom_3d, reference_image, os.path.join(output_folder, 'Size_' + str(int(10*(1-size_ratio))) + '_Phantom-label.nii.gz'))
+		nifti_util.save_numpy_2_nifti(phantom_3d, reference_image, os.path.join(output_folder, 'Size_' + str(int(10*(1-size_ratio))) + '_Phantom.nii.gz'), dtype=np.float32)
+		nifti_util.save_numpy_2_nifti(phantom_3d, reference_image, os.path.join(output_folder, 'Size_' + str(int(10*(1-size_ratio))) + '_Phantom-label.nii.gz'), dtype=np.uint8, scale_integers=False)
 
 def glcm_cube_phantom(reference_image, output_folder):
 
@@ -51,8 +51,8 @@ def glcm_cube_phantom(reference_image, output_folder):
 				for indice in indice_list:
 					phantom_3d[indice, indice_list, :] += 100
 
-			nifti_util.save_numpy_2_nifti(phantom_3d, reference_image, os.path.join(output_folder, 'GLCM_' + direction + '_' + str(alternation_rate) + '_Phantom.nii.gz'))
-			nifti_util.save_numpy_2_nifti(label_3d, reference_image, os.path.join(output_folder, 'GLCM_' + direction + '_' + str(alternation_rate) + '_Phantom-label.nii.gz'))
+			nifti_util.save_numpy_2_nifti(phantom_3d, reference_image, os.path.join(output_folder, 'GLCM_' + direction + '_' + str(alternation_rate) + '_Phantom.nii.gz'), dtype=np.float32)
+			nifti_util.save_numpy_2_nifti(label_3d, reference_image, os.path.join(output_folder, 'GLCM_' + direction + '_' + str(alternation_rate) + '_Phantom-label.nii.gz'), dtype=np.uint8, scale_integers=False)
 
 			print [direction, alternation_rate]
 
@@ -91,8 +91,8 @@ def intensity_cube_phantom(reference_image, output_folder):
 			phantom_3d[:,:,:] = 100
 			phantom_3d[80:100, 80:100, :] = 150
 
-		nifti_util.save_numpy_2_nifti(phantom_3d, reference_image, os.path.join(output_folder, 'Intensity_' + phantom_type + '_Phantom.nii.gz'))
-		nifti_util.save_numpy_2_nifti(label_3d, reference_image, os.path.join(output_folder, 'Intensity_' + phantom_type + '_Phantom-label.nii.gz'))
+		nifti_util.save_numpy_2_nifti(phantom_3d, reference_image, os.path.join(output_folder, 'Intensity_' + phantom_type + '_Phantom.nii.gz'), dtype=np.float32)
+		nifti_util.save_numpy_2_nifti(label_3d, reference_image, os.path.join(output_folder, 'Intensity_' + phantom_type + '_Phantom-label.nii.gz'), dtype=np.uint8, scale_integers=False)
 
 		print [phantom_type]
 
@@ -0,0 +1,51 @@
+import argparse
+
+from qtim_tools.qtim_features import extract_features
+from qtim_tools.qtim_features import shards
+
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser(description='qtim_tools.qtim_features.process_features extracts features from every .nii or .nii.gz image (and, optionally, label-map) in a folder. To spread one job over several machines that share a filesystem, run it once per machine with -shard 1/N through -shard N/N and the same other options, and then run it once more with -merge.')
+
+    parser.add_argument('-folder', required=False, help = 'Folder of images to be processed. Not needed with -merge.')
+    parser.add_argument('-outfile', required=True, help = 'CSV file to write features to. Shards write to this name with \"_shard_i_of_N\" added before the extension.')
+
+    parser.add_argument('-features', required=False, nargs='+', default=['GLCM', 'morphology', 'statistics'], help = 'Feature types to calculate. GLCM, morphology and statistics are calculated by default.')
+    parser.add_argument('-labels', required=False, action='store_true', help = 'Calculate features within label-maps, rather than on the whole image.')
+    parser.add_argument('-label_suffix', required=False, default='-label', help = 'Suffix identifying label-maps. An image \"scan.nii.gz\" is paired with \"scan-label.nii.gz\" by default.')
+    parser.add_argument('-recursive', required=False, action='store_true', help = 'Search for images in subfolders as well.')
+    parser.add_argument('-levels', required=False, type=int, default=255, help = 'Number of gray-levels to reduce images to for GLCM features. Default is 255.')
+    parser.add_argument('-mask_value', required=False, type=float, default=0, help = 'Background value of label-maps. Default is 0.')
+    parser.add_argument('-quantization', required=False, default='divide', choices=['divide', 'z_score', 'fixed_width', 'reference_edges'], help = 'How to bin intensities into levels for texture features. "reference_edges" uses one set of bin edges for the whole cohort, saved next to -outfile. Default is "divide".')
+    parser.add_argument('-bin_width', required=False, type=float, help = 'Intensity units per level, for "fixed_width" quantization or for computing cohort bin edges.')
+    parser.add_argument('-bin_edges', required=False, default=[], help = 'Filepath of bin edges to quantize against with "reference_edges" quantization.')
+    parser.add_argument('-erode', required=False, type=int, nargs=3, default=[0,0,0], help = 'Voxels to erode from each label in the x, y and z dimensions.')
+    parser.add_argument('-erode_statistics', required=False, action='store_true', help = 'Calculate intensity statistics within the eroded label as well, rather than only texture features.')
+
+    parser.add_argument('-prefetch', required=False, type=int, default=0, help = 'Number of upcoming images to load in the background while the current one is processed.')
+    parser.add_argument('-manifest_cache', required=False, default='', help = 'Filepath to cache the list of images and label-maps in. Shards on different machines can share one cache.')
+
+    parser.add_argument('-shard', required=False, default='', help = 'Process only shard i of N, given as \"i/N\" and counting from 1.')
+    parser.add_argument('-shard_method', required=False, default='hash', choices=['hash', 'cost'], help = 'How to split images between shards: \"hash\" on each image\'s path (default), or \"cost\" to balance shards by file size.')
+
+    parser.add_argument('-merge', required=False, action='store_true', help = 'Merge the shards of -outfile into -outfile instead of extracting features.')
+    parser.add_argument('-shard_count', required=False, type=int, help = 'With -merge, the number of shards to expect. Read from the shard filenames if not given.')
+    parser.add_argument('-allow_incomplete', required=False, action='store_true', help = 'With -merge, merge even if shards or images are missing.')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+
+    args = parse_args(argv)
+
+    if args.merge:
+        shards.merge_feature_shards(args.outfile, shard_count=args.shard_count, allow_incomplete=args.allow_incomplete)
+        return
+
+    if args.folder is None:
+        raise ValueError('A -folder of images is needed to extract features.')
+
+    extract_features.generate_feature_list_batch(folder=args.folder, features=args.features, recursive=args.recursive, labels=args.labels, label_suffix=args.label_suffix, levels=args.levels, mask_value=args.mask_value, erode=args.erode, outfile=args.outfile, prefetch=args.prefetch, manifest_cache=args.manifest_cache, shard=args.shard, shard_method=args.shard_method, quantization=args.quantization, bin_width=args.bin_width, bin_edges=args.bin_edges, erode_statistics=args.erode_statistics)
+
+if __name__ == "__main__":
+    main()
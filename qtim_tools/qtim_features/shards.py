@@ -0,0 +1,256 @@
+""" Splitting one feature extraction job across several machines. Every
+    machine runs the same batch extraction with a different shard ('i/N',
+    counting from 1) and picks its images out of the same manifest. Shards
+    are chosen deterministically, so no machine has to know which others are
+    running. Each shard writes its own csv (e.g. features_shard_2_of_4.csv)
+    and a record next to it in JSON lines: a first line with the extraction
+    parameters and the images it was given, and then one line with the ROIs
+    written for each image as it finishes.
+    merge_feature_shards then concatenates the shards into one csv, after
+    checking that headers and parameters agree, and reports what is missing.
+
+    Two ways of splitting are available. 'hash' puts each image in the shard
+    given by the md5 of its path relative to the input folder, so the split
+    does not depend on where the shared filesystem is mounted and does not
+    move existing images when new ones are added. 'cost' balances shards by
+    the size on disk of each image and its label-map, assigning the largest
+    images first to whichever shard has the least work so far.
+"""
+
+import os
+import glob
+import csv
+import json
+import hashlib
+
+def parse_shard(shard):
+
+    """ Turns 'i/N' into [i, N], checking that 1 <= i <= N.
+    """
+
+    try:
+        shard_index, shard_count = [int(x) for x in str.split(str(shard), '/')]
+    except ValueError:
+        raise ValueError('Shards must be given as \'i/N\', e.g. \'2/4\' for the second of four shards.')
+
+    if shard_count < 1 or shard_index < 1 or shard_index > shard_count:
+        raise ValueError('Shard ' + str(shard) + ' is out of range. Shards are counted from 1 to N.')
+
+    return [shard_index, shard_count]
+
+def shard_outfile_name(outfile, shard_index, shard_count):
+
+    split_outfile = os.path.splitext(outfile)
+    return split_outfile[0] + '_shard_' + str(shard_index) + '_of_' + str(shard_count) + split_outfile[1]
+
+def shard_record_name(shard_outfile):
+    return shard_outfile + '.jsonl'
+
+def hash_shard(imagepath, folder, shard_count):
+
+    relative_path = os.path.relpath(imagepath, folder).replace('\\', '/')
+    return int(hashlib.md5(relative_path).hexdigest(), 16) % shard_count + 1
+
+def partition_by_hash(imagepaths, folder, shard_count):
+
+    partitions = [[] for i in xrange(shard_count)]
+    for imagepath in imagepaths:
+        partitions[hash_shard(imagepath, folder, shard_count) - 1] += [imagepath]
+    return partitions
+
+def estimate_image_cost(imagepath, label_images=[]):
+
+    """ Size on disk is a rough stand-in for how long an image takes. Compressed
+        sizes undercount large, mostly empty volumes, but the label-map size goes
+        some way towards making up for that.
+    """
+
+    cost = os.path.getsize(imagepath)
+    if isinstance(label_images, dict) and imagepath in label_images:
+        cost += os.path.getsize(label_images[imagepath])
+    return cost
+
+def partition_by_cost(imagepaths, shard_count, label_images=[]):
+
+    costs = [[estimate_image_cost(imagepath, label_images), imagepath] for imagepath in imagepaths]
+    costs.sort(key=lambda x: (-x[0], x[1]))
+
+    partitions = [[] for i in xrange(shard_count)]
+    shard_costs = [0] * shard_count
+
+    for cost, imagepath in costs:
+        cheapest_shard = shard_costs.index(min(shard_costs))
+        partitions[cheapest_shard] += [imagepath]
+        shard_costs[cheapest_shard] += cost
+
+    # Keep the original (sorted) image order within each shard.
+    image_order = dict([[imagepath, idx] for idx, imagepath in enumerate(imagepaths)])
+    return [sorted(partition, key=image_order.get) for partition in partitions]
+
+def select_shard(imagepaths, folder, shard_index, shard_count, method='hash', label_images=[]):
+
+    if method == 'hash':
+        partitions = partition_by_hash(imagepaths, folder, shard_count)
+    elif method == 'cost':
+        partitions = partition_by_cost(imagepaths, shard_count, label_images)
+    else:
+        raise ValueError('Shard method ' + str(method) + ' is not available. Choose \'hash\' or \'cost\'.')
+
+    print 'Shard ' + str(shard_index) + ' of ' + str(shard_count) + ' has ' + str(len(partitions[shard_index - 1])) + ' of ' + str(len(imagepaths)) + ' images.'
+
+    return partitions[shard_index - 1]
+
+def create_shard_record(shard_index, shard_count, imagepaths, parameters):
+
+    """ parameters should hold everything that changes feature values or columns,
+        so that merge_feature_shards can refuse to mix incompatible shards.
+    """
+
+    return {'shard_index': shard_index, 'shard_count': shard_count, 'parameters': parameters, 'imagepaths': list(imagepaths), 'rois': {}}
+
+def update_shard_record(record, shard_outfile, imagepath=None, roi_names=[]):
+
+    """ Without an imagepath, (re)writes the whole record. With one, marks
+        imagepath as finished with the given ROI names (an empty list for skipped
+        images) by appending a single line, so an interrupted shard still leaves
+        an accurate account of what it finished without rewriting the record
+        after every image.
+    """
+
+    if imagepath is None:
+        header = dict([[key, value] for key, value in record.iteritems() if key != 'rois'])
+        with open(shard_record_name(shard_outfile), 'w') as writefile:
+            writefile.write(json.dumps(header, sort_keys=True) + '\n')
+            for finished_imagepath in sorted(record['rois']):
+                writefile.write(json.dumps({'imagepath': finished_imagepath, 'rois': record['rois'][finished_imagepath]}) + '\n')
+        return
+
+    record['rois'][imagepath] = list(roi_names)
+
+    with open(shard_record_name(shard_outfile), 'a') as writefile:
+        writefile.write(json.dumps({'imagepath': imagepath, 'rois': record['rois'][imagepath]}) + '\n')
+
+def read_shard_record(shard_outfile):
+
+    """ Rebuilds a record from its lines. A last line cut off by an interrupted
+        shard is ignored.
+    """
+
+    with open(shard_record_name(shard_outfile), 'r') as readfile:
+        lines = readfile.read().splitlines()
+
+    record = json.loads(lines[0])
+    record['rois'] = {}
+
+    for line in lines[1:]:
+        try:
+            finished = json.loads(line)
+        except ValueError:
+            continue
+        record['rois'][finished['imagepath']] = finished['rois']
+
+    return record
+
+def find_shard_outfiles(outfile, shard_count=None):
+
+    """ Returns a dictionary from shard index to shard csv path. If shard_count is
+        not given, it is read off of the shard files present.
+    """
+
+    split_outfile = os.path.splitext(outfile)
+    candidates = glob.glob(split_outfile[0] + '_shard_*_of_*' + split_outfile[1])
+
+    found_counts = set()
+    shard_outfiles = {}
+    for candidate in candidates:
+        suffix = candidate[len(split_outfile[0] + '_shard_'):len(candidate) - len(split_outfile[1])]
+        try:
+            shard_index, found_count = [int(x) for x in str.split(suffix, '_of_')]
+        except ValueError:
+            continue
+        if shard_count is not None and found_count != shard_count:
+            continue
+        found_counts.add(found_count)
+        shard_outfiles[shard_index] = candidate
+
+    if len(found_counts) > 1:
+        raise ValueError('Shards from different shard counts (' + ', '.join([str(x) for x in sorted(found_counts)]) + ') were found for ' + outfile + '. Pass shard_count to choose one.')
+
+    if shard_count is None:
+        if not found_counts:
+            raise ValueError('No shards were found for ' + outfile + '.')
+        shard_count = found_counts.pop()
+
+    return [shard_outfiles, shard_count]
+
+def merge_feature_shards(outfile, shard_count=None, allow_incomplete=False):
+
+    """ Concatenates the shards of outfile into outfile. Raises a ValueError if
+        shard headers or parameters disagree, or, unless allow_incomplete is set,
+        if any shard or image is missing. Returns a report dictionary with the
+        keys 'missing_shards', 'missing_images', 'empty_images', and 'rows'.
+    """
+
+    shard_outfiles, shard_count = find_shard_outfiles(outfile, shard_count)
+
+    missing_shards = [i for i in xrange(1, shard_count + 1) if i not in shard_outfiles]
+    missing_images = []
+    empty_images = []
+
+    header = None
+    parameters = None
+    rows = []
+
+    for shard_index in sorted(shard_outfiles.keys()):
+
+        shard_outfile = shard_outfiles[shard_index]
+
+        with open(shard_outfile, 'rb') as readfile:
+            shard_rows = [row for row in csv.reader(readfile, delimiter=',')]
+
+        if not shard_rows:
+            raise ValueError('Shard ' + shard_outfile + ' is empty.')
+
+        if header is None:
+            header = shard_rows[0]
+        elif shard_rows[0] != header:
+            raise ValueError('The header of ' + shard_outfile + ' does not match the other shards. Were they run with the same features?')
+
+        if os.path.isfile(shard_record_name(shard_outfile)):
+            record = read_shard_record(shard_outfile)
+            if parameters is None:
+                parameters = record['parameters']
+            elif record['parameters'] != parameters:
+                raise ValueError('Shard ' + shard_outfile + ' was run with different parameters than the other shards.')
+            missing_images += [imagepath for imagepath in record['imagepaths'] if imagepath not in record['rois']]
+            empty_images += [imagepath for imagepath in record['imagepaths'] if record['rois'].get(imagepath) == []]
+        else:
+            print 'Warning: shard ' + shard_outfile + ' has no record, so its parameters and images cannot be checked.'
+
+        rows += shard_rows[1:]
+
+    report = {'missing_shards': missing_shards, 'missing_images': missing_images, 'empty_images': empty_images, 'rows': len(rows)}
+
+    if missing_shards:
+        print 'Warning: shards ' + ', '.join([str(x) for x in missing_shards]) + ' of ' + str(shard_count) + ' are missing.'
+    if missing_images:
+        print 'Warning: ' + str(len(missing_images)) + ' images were assigned to a shard but never finished:'
+        for imagepath in missing_images:
+            print '    ' + imagepath
+    if empty_images:
+        print 'Warning: ' + str(len(empty_images)) + ' images produced no ROIs (no label-map, empty label-map, or unreadable):'
+        for imagepath in empty_images:
+            print '    ' + imagepath
+
+    if (missing_shards or missing_images) and not allow_incomplete:
+        raise ValueError('Shards for ' + outfile + ' are incomplete. Set allow_incomplete to merge anyway.')
+
+    with open(outfile, 'wb') as writefile:
+        csvfile = csv.writer(writefile, delimiter=',')
+        csvfile.writerow(header)
+        for row in rows:
+            csvfile.writerow(row)
+
+    print 'Merged ' + str(len(rows)) + ' rows from ' + str(len(shard_outfiles)) + ' shards into ' + outfile + '.'
+
+    return report
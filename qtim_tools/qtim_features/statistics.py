@@ -78,12 +78,22 @@ def calc_intensity_histogram(image_numpy, bins, mask_value=0):
 
 def statistics_features(image, features=standard_features, mask_value=0):
 
+    stats_image = np.ravel(image[image != mask_value])
+    # nifti_util.check_image(image)
+
+    return voxel_statistics_features(stats_image, features, mask_value)
+
+def voxel_statistics_features(stats_image, features=standard_features, mask_value=0):
+
+    """ Same as statistics_features, for a flat list of voxel values that
+        has already had masked voxels removed.
+    """
+
     if isinstance(features, basestring):
         features = [features,]
 
     results = np.zeros(len(features), dtype=float)
-    stats_image = np.ravel(image[image != mask_value])
-    # nifti_util.check_image(image)
+    histogram = []
 
     for f_idx, current_feature in enumerate(features):
 
@@ -112,17 +122,24 @@ def statistics_features(image, features=standard_features, mask_value=0):
         if current_feature == 'COV':
             output = calc_COV(stats_image)
 
-        # This histogram method is very fragile.
+        # The histogram is calculated once for all bins, and then each requested bin is looked up.
         if 'histogram_percent' in current_feature:
-            output = calc_intensity_histogram(stats_image, f_idx, mask_value)
-            results[f_idx:] = output
-            break
+            if histogram == []:
+                histogram = calc_intensity_histogram(stats_image, f_idx, mask_value)
+            output = histogram[standard_bin_labels.index(current_feature)]
 
         results[f_idx] = output
 
     return results
 
+intermediates = ['statistics_voxel_list']
+
+def features_from_intermediates(intermediates, features=standard_features):
+    return voxel_statistics_features(intermediates['statistics_voxel_list'], features, intermediates['mask_value'])
+
 def featurename_strings(features=standard_features):
+    if isinstance(features, basestring):
+        features = [features,]
     return features
 
 def feature_count(features=standard_features):
@@ -1 +1,5 @@
-import nifti_util
\ No newline at end of file
+import nifti_util
+import intensity_sketch
+import nifti_slab
+import dicom_util
+import dicom_catalog
\ No newline at end of file
@@ -0,0 +1,261 @@
+""" An on-disk index of DICOM metadata, for archives too big to walk every time
+    a series is needed. Each file's header is read once (without pixel data,
+    across a pool of processes) and stored in a SQLite database with its
+    patient, study, series and instance identifiers. Updating the catalog
+    later only reads files that are new or whose modification time or size has
+    changed, and drops files that have disappeared.
+
+    Files that turn out not to be DICOM are recorded too, with is_dicom = 0, so
+    they are not read again on every update.
+
+    Catalogs can be queried by patient, study, series or modality, and
+    series_filepaths gives a series' files in slice order, ready for
+    dicom_util.load_dicom_series.
+"""
+
+from __future__ import division
+
+import os
+import fnmatch
+import sqlite3
+import numpy as np
+from multiprocessing.pool import Pool
+
+import dicom_util
+
+catalog_columns = ['path', 'mtime', 'size', 'is_dicom', 'patient_id', 'study_instance_uid', 'series_instance_uid', 'sop_instance_uid', 'instance_number', 'slice_position', 'modality', 'study_date', 'series_description', 'rows', 'columns']
+
+catalog_schema = """
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        mtime REAL,
+        size INTEGER,
+        is_dicom INTEGER,
+        patient_id TEXT,
+        study_instance_uid TEXT,
+        series_instance_uid TEXT,
+        sop_instance_uid TEXT,
+        instance_number INTEGER,
+        slice_position REAL,
+        modality TEXT,
+        study_date TEXT,
+        series_description TEXT,
+        rows INTEGER,
+        columns INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS files_patient ON files (patient_id, study_instance_uid);
+    CREATE INDEX IF NOT EXISTS files_study ON files (study_instance_uid, series_instance_uid);
+    CREATE INDEX IF NOT EXISTS files_series ON files (series_instance_uid, slice_position, instance_number);
+    CREATE INDEX IF NOT EXISTS files_instance ON files (sop_instance_uid);
+"""
+
+def connect_dicom_catalog(catalog):
+
+    """ Opens (and if need be creates) a catalog. catalog can be a filepath, or
+        an open sqlite3 connection, which is used as it is.
+    """
+
+    if isinstance(catalog, sqlite3.Connection):
+        connection = catalog
+    else:
+        connection = sqlite3.connect(catalog)
+
+    # Paths and tag values are stored as the byte strings they come as. Without
+    # this, sqlite3 refuses any str with a non-ASCII byte in it, and with it
+    # the rest of the batch it came in.
+    connection.text_factory = str
+
+    connection.executescript(catalog_schema)
+    return connection
+
+def close_dicom_catalog(connection, catalog):
+
+    """ Closes connections opened from a filepath, but not ones passed in.
+    """
+
+    if connection is not catalog:
+        connection.close()
+
+def catalog_text(header, attribute):
+
+    value = getattr(header, attribute, None)
+    if value is None:
+        return None
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def catalog_int(header, attribute):
+
+    try:
+        return int(getattr(header, attribute))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def read_catalog_entry(file_entry):
+
+    """ Pool worker: turns [path, mtime, size] into a catalog row.
+    """
+
+    path, mtime, size = file_entry
+    header = dicom_util.read_dicom_header(path)
+
+    if header is None:
+        return [path, mtime, size, 0] + [None] * (len(catalog_columns) - 4)
+
+    try:
+        slice_position = float(np.dot(dicom_util.slice_normal(header), np.array(header.ImagePositionPatient, dtype=float)))
+    except (AttributeError, TypeError, ValueError):
+        slice_position = None
+
+    return [path, mtime, size, 1, catalog_text(header, 'PatientID'), catalog_text(header, 'StudyInstanceUID'), catalog_text(header, 'SeriesInstanceUID'), catalog_text(header, 'SOPInstanceUID'), catalog_int(header, 'InstanceNumber'), slice_position, catalog_text(header, 'Modality'), catalog_text(header, 'StudyDate'), catalog_text(header, 'SeriesDescription'), catalog_int(header, 'Rows'), catalog_int(header, 'Columns')]
+
+def scan_catalog_folder(folder, recursive=True, file_regex='*'):
+
+    """ Returns [path, mtime, size] for every file under folder matching file_regex.
+    """
+
+    file_entries = []
+    for root, dirnames, filenames in os.walk(folder):
+        for filename in fnmatch.filter(filenames, file_regex):
+            path = os.path.abspath(os.path.join(root, filename))
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                continue
+            file_entries += [[path, file_stat.st_mtime, file_stat.st_size]]
+        if not recursive:
+            break
+    return file_entries
+
+def update_dicom_catalog(folder, catalog, recursive=True, file_regex='*', processes=4, batch_size=1000, prune=True):
+
+    """ Brings the catalog up to date with folder. Only files that are not in the
+        catalog, or whose modification time or size differ from it, are read;
+        with prune set, catalogued files under folder that no longer exist are
+        removed. Rows are written in transactions of batch_size files, so an
+        interrupted update keeps what it has done. Returns a dictionary counting
+        'added', 'updated', 'unchanged' and 'removed' files.
+    """
+
+    connection = connect_dicom_catalog(catalog)
+    folder_prefix = os.path.join(os.path.abspath(folder), '')
+
+    # A range on the primary key, rather than a LIKE, so that the index is used.
+    folder_range = (folder_prefix, folder_prefix[:-1] + chr(ord(folder_prefix[-1]) + 1))
+    catalogued = dict([[row[0], [row[1], row[2]]] for row in connection.execute('SELECT path, mtime, size FROM files WHERE path >= ? AND path < ?', folder_range)])
+
+    file_entries = scan_catalog_folder(folder, recursive, file_regex)
+    changed_entries = [file_entry for file_entry in file_entries if catalogued.get(file_entry[0]) != [file_entry[1], file_entry[2]]]
+
+    report = {'added': len([file_entry for file_entry in changed_entries if file_entry[0] not in catalogued]), 'updated': len([file_entry for file_entry in changed_entries if file_entry[0] in catalogued]), 'unchanged': len(file_entries) - len(changed_entries), 'removed': 0}
+
+    insert_statement = 'INSERT OR REPLACE INTO files (' + ', '.join(catalog_columns) + ') VALUES (' + ', '.join(['?'] * len(catalog_columns)) + ')'
+
+    if processes > 1:
+        catalog_pool = Pool(processes)
+        catalog_rows = catalog_pool.imap_unordered(read_catalog_entry, changed_entries, chunksize=64)
+    else:
+        catalog_pool = None
+        catalog_rows = (read_catalog_entry(file_entry) for file_entry in changed_entries)
+
+    try:
+        row_batch = []
+        for catalog_row in catalog_rows:
+            row_batch += [catalog_row]
+            if len(row_batch) >= batch_size:
+                with connection:
+                    connection.executemany(insert_statement, row_batch)
+                row_batch = []
+        if row_batch:
+            with connection:
+                connection.executemany(insert_statement, row_batch)
+    finally:
+        if catalog_pool is not None:
+            catalog_pool.terminate()
+
+    if prune:
+        existing_paths = set([file_entry[0] for file_entry in file_entries])
+
+        # Files outside the current file_regex or recursion depth were not scanned, so only drop those that are really gone.
+        missing_paths = [[path] for path in catalogued if path not in existing_paths and not os.path.exists(path)]
+
+        with connection:
+            connection.executemany('DELETE FROM files WHERE path = ?', missing_paths)
+        report['removed'] = len(missing_paths)
+
+    close_dicom_catalog(connection, catalog)
+
+    print 'Catalogued ' + folder + ': ' + ', '.join([str(report[key]) + ' ' + key for key in ['added', 'updated', 'unchanged', 'removed']]) + '.'
+
+    return report
+
+def catalog_filters(patient_id=None, study_instance_uid=None, series_instance_uid=None, modality=None):
+
+    conditions = ['is_dicom = 1']
+    values = []
+    for column, value in [['patient_id', patient_id], ['study_instance_uid', study_instance_uid], ['series_instance_uid', series_instance_uid], ['modality', modality]]:
+        if value is not None:
+            conditions += [column + ' = ?']
+            values += [value]
+    return [' AND '.join(conditions), values]
+
+def query_dicom_catalog(catalog, patient_id=None, study_instance_uid=None, series_instance_uid=None, modality=None):
+
+    """ Returns a dictionary per catalogued DICOM file matching the filters.
+    """
+
+    connection = connect_dicom_catalog(catalog)
+    conditions, values = catalog_filters(patient_id, study_instance_uid, series_instance_uid, modality)
+
+    rows = connection.execute('SELECT ' + ', '.join(catalog_columns) + ' FROM files WHERE ' + conditions + ' ORDER BY patient_id, study_instance_uid, series_instance_uid, slice_position, instance_number', values).fetchall()
+    close_dicom_catalog(connection, catalog)
+
+    return [dict(zip(catalog_columns, row)) for row in rows]
+
+def list_catalog_series(catalog, patient_id=None, study_instance_uid=None, modality=None):
+
+    """ Returns a dictionary per series matching the filters, with its patient,
+        study, modality, description and number of files.
+    """
+
+    connection = connect_dicom_catalog(catalog)
+    conditions, values = catalog_filters(patient_id, study_instance_uid, None, modality)
+
+    series_columns = ['patient_id', 'study_instance_uid', 'series_instance_uid', 'modality', 'study_date', 'series_description', 'file_count']
+    rows = connection.execute('SELECT patient_id, study_instance_uid, series_instance_uid, MIN(modality), MIN(study_date), MIN(series_description), COUNT(*) FROM files WHERE ' + conditions + ' GROUP BY patient_id, study_instance_uid, series_instance_uid ORDER BY patient_id, study_date, study_instance_uid, series_instance_uid', values).fetchall()
+    close_dicom_catalog(connection, catalog)
+
+    return [dict(zip(series_columns, row)) for row in rows]
+
+def series_filepaths(catalog, series_instance_uid):
+
+    """ Returns the files of a series in slice order.
+    """
+
+    connection = connect_dicom_catalog(catalog)
+    rows = connection.execute('SELECT path FROM files WHERE is_dicom = 1 AND series_instance_uid = ? ORDER BY slice_position, instance_number', (series_instance_uid,)).fetchall()
+    close_dicom_catalog(connection, catalog)
+
+    return [row[0] for row in rows]
+
+def convert_catalog_series(catalog, output_folder, threads=8, patient_id=None, study_instance_uid=None, modality=None):
+
+    """ Converts every catalogued series matching the filters into a NIfTI file in
+        output_folder, named by patient and series. Returns a list of
+        [series_instance_uid, output path or failure message].
+    """
+
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    results = []
+    for series in list_catalog_series(catalog, patient_id, study_instance_uid, modality):
+        output_path = os.path.join(output_folder, str(series['patient_id']) + '_' + str(series['series_instance_uid']) + '.nii.gz')
+        try:
+            dicom_util.dicom_series_2_nifti(series_filepaths(catalog, series['series_instance_uid']), output_path, series['series_instance_uid'], threads)
+            results += [[series['series_instance_uid'], output_path]]
+        except Exception as error:
+            results += [[series['series_instance_uid'], 'failure to convert: ' + str(error)]]
+
+    return results
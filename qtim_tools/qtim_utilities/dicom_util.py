@@ -0,0 +1,215 @@
+""" Loading DICOM series into numpy volumes. Reading every slice in full and
+    then sorting means holding every slice's pixel data, plus a copy for the
+    stacked volume, and decoding them one at a time. Here, headers are read
+    first with pixel data skipped, slices are put in order along the slice
+    normal, and pixel data are then decoded across a pool of threads straight
+    into their place in a preallocated volume. Rescale slopes and intercepts
+    are applied to the whole volume at once.
+
+    Volumes are indexed [column, row, slice], like NIfTI volumes converted from
+    DICOM, and come with a NIfTI-style (RAS) affine, so they can be saved with
+    nibabel and passed to the feature pipeline like any other image.
+"""
+
+from __future__ import division
+
+import os
+import numpy as np
+import nibabel as nib
+import dicom
+from dicom.errors import InvalidDicomError
+from multiprocessing.pool import ThreadPool
+
+def read_dicom_header(filepath):
+
+    """ Reads a file's DICOM header without its pixel data. Returns None for files
+        that are not DICOM.
+    """
+
+    try:
+        return dicom.read_file(filepath, stop_before_pixels=True)
+    except (InvalidDicomError, IOError):
+        return None
+
+def list_dicom_files(folder, recursive=False):
+
+    filepaths = []
+    for root, dirnames, filenames in os.walk(folder):
+        filepaths += [os.path.join(root, filename) for filename in sorted(filenames)]
+        if not recursive:
+            break
+    return filepaths
+
+def read_dicom_headers(filepaths, threads=8):
+
+    """ Returns [filepath, header] for every file that turns out to be a DICOM
+        image.
+    """
+
+    header_pool = ThreadPool(threads)
+    try:
+        headers = header_pool.map(read_dicom_header, filepaths)
+    finally:
+        header_pool.terminate()
+
+    return [[filepath, header] for filepath, header in zip(filepaths, headers) if header is not None and hasattr(header, 'Rows')]
+
+def select_dicom_series(dicom_headers, series_instance_uid=None):
+
+    """ Keeps the slices of one series. If series_instance_uid is not given, the
+        files must all belong to the same series.
+    """
+
+    series_uids = sorted(set([str(header.SeriesInstanceUID) for filepath, header in dicom_headers]))
+
+    if series_instance_uid is None:
+        if len(series_uids) > 1:
+            raise ValueError('Found ' + str(len(series_uids)) + ' series (' + ', '.join(series_uids) + '). Choose one with series_instance_uid.')
+        return dicom_headers
+
+    return [[filepath, header] for filepath, header in dicom_headers if str(header.SeriesInstanceUID) == str(series_instance_uid)]
+
+def slice_normal(header):
+    orientation = np.array(header.ImageOrientationPatient, dtype=float)
+    return np.cross(orientation[0:3], orientation[3:6])
+
+def sort_dicom_slices(dicom_headers):
+
+    """ Orders slices by their position along the slice normal. Sorting on the
+        third coordinate of ImagePositionPatient alone only works for axial
+        slices; slices without a position fall back to InstanceNumber.
+    """
+
+    try:
+        normal = slice_normal(dicom_headers[0][1])
+        positions = [np.dot(normal, np.array(header.ImagePositionPatient, dtype=float)) for filepath, header in dicom_headers]
+    except AttributeError:
+        positions = [int(header.InstanceNumber) for filepath, header in dicom_headers]
+
+    return [dicom_headers[idx] for idx in np.argsort(positions, kind='mergesort')]
+
+def dicom_series_affine(sorted_headers):
+
+    """ Returns the RAS affine for a volume indexed [column, row, slice]. DICOM
+        positions are in LPS, hence the sign flip on the first two axes. Series
+        without orientation or positions (the ones sort_dicom_slices orders by
+        InstanceNumber) get an identity orientation at the origin, spaced by
+        PixelSpacing and SliceThickness where present and 1 otherwise.
+    """
+
+    first_header = sorted_headers[0][1]
+    row_spacing, column_spacing = [float(x) for x in getattr(first_header, 'PixelSpacing', [1, 1])]
+    slice_thickness = float(getattr(first_header, 'SliceThickness', 1) or 1)
+
+    if not hasattr(first_header, 'ImageOrientationPatient') or not all([hasattr(header, 'ImagePositionPatient') for filepath, header in sorted_headers]):
+        affine = np.diag([column_spacing, row_spacing, slice_thickness, 1])
+        return np.dot(np.diag([-1, -1, 1, 1]), affine)
+
+    orientation = np.array(first_header.ImageOrientationPatient, dtype=float)
+    first_position = np.array(first_header.ImagePositionPatient, dtype=float)
+
+    if len(sorted_headers) > 1:
+        last_position = np.array(sorted_headers[-1][1].ImagePositionPatient, dtype=float)
+        slice_step = (last_position - first_position) / (len(sorted_headers) - 1)
+    else:
+        slice_step = slice_normal(first_header) * slice_thickness
+
+    affine = np.eye(4)
+    affine[0:3, 0] = orientation[0:3] * column_spacing
+    affine[0:3, 1] = orientation[3:6] * row_spacing
+    affine[0:3, 2] = slice_step
+    affine[0:3, 3] = first_position
+
+    return np.dot(np.diag([-1, -1, 1, 1]), affine)
+
+def volume_dtype(header):
+
+    """ Picks the smallest signed-friendly dtype that holds the stored pixels:
+        int16 for nearly all CT and MR data, int32 for unsigned 16-bit data, and
+        int64 for unsigned 32-bit data. 8-bit data stay 8-bit.
+    """
+
+    bits_allocated = int(getattr(header, 'BitsAllocated', 16))
+    signed = int(getattr(header, 'PixelRepresentation', 0)) == 1
+
+    if bits_allocated <= 8:
+        return np.int8 if signed else np.uint8
+    elif bits_allocated <= 16:
+        return np.int16 if signed else np.int32
+    else:
+        return np.int32 if signed else np.int64
+
+def decode_dicom_slice(slice_job):
+
+    """ Thread worker: reads one slice's pixel data into its place in the volume.
+    """
+
+    volume, slice_idx, filepath = slice_job
+    volume[:, :, slice_idx] = dicom.read_file(filepath).pixel_array.T
+
+def rescale_dicom_volume(volume, sorted_headers):
+
+    """ Applies each slice's RescaleSlope and RescaleIntercept. Integer rescales
+        keep an integer volume (int16 if it still fits, as for CT in Hounsfield
+        units); anything else gives float32.
+    """
+
+    slopes = np.array([float(getattr(header, 'RescaleSlope', 1)) for filepath, header in sorted_headers])
+    intercepts = np.array([float(getattr(header, 'RescaleIntercept', 0)) for filepath, header in sorted_headers])
+
+    if np.all(slopes == 1) and np.all(intercepts == 0):
+        return volume
+
+    if np.all(slopes == np.round(slopes)) and np.all(intercepts == np.round(intercepts)):
+        rescaled_dtype = np.result_type(volume.dtype, np.int32)
+        rescaled_volume = volume.astype(rescaled_dtype)
+        rescaled_volume *= slopes.astype(rescaled_dtype)
+        rescaled_volume += intercepts.astype(rescaled_dtype)
+        if rescaled_volume.size == 0 or (rescaled_volume.min() >= np.iinfo(np.int16).min and rescaled_volume.max() <= np.iinfo(np.int16).max):
+            return rescaled_volume.astype(np.int16)
+        return rescaled_volume
+
+    return volume * slopes.astype(np.float32) + intercepts.astype(np.float32)
+
+def load_dicom_series(folder_or_filepaths, series_instance_uid=None, threads=8, apply_rescale=True, recursive=False):
+
+    """ Loads a DICOM series from a folder (or a list of files) and returns
+        [volume, affine], with the volume indexed [column, row, slice]. If the
+        files hold more than one series, pick one with series_instance_uid.
+    """
+
+    if isinstance(folder_or_filepaths, basestring):
+        filepaths = list_dicom_files(folder_or_filepaths, recursive)
+    else:
+        filepaths = list(folder_or_filepaths)
+
+    dicom_headers = select_dicom_series(read_dicom_headers(filepaths, threads), series_instance_uid)
+
+    if not dicom_headers:
+        raise ValueError('No DICOM images were found in ' + str(folder_or_filepaths) + '.')
+
+    sorted_headers = sort_dicom_slices(dicom_headers)
+    first_header = sorted_headers[0][1]
+
+    volume = np.zeros((int(first_header.Columns), int(first_header.Rows), len(sorted_headers)), dtype=volume_dtype(first_header))
+
+    decode_pool = ThreadPool(threads)
+    try:
+        decode_pool.map(decode_dicom_slice, [[volume, slice_idx, filepath] for slice_idx, (filepath, header) in enumerate(sorted_headers)])
+    finally:
+        decode_pool.terminate()
+
+    if apply_rescale:
+        volume = rescale_dicom_volume(volume, sorted_headers)
+
+    return [volume, dicom_series_affine(sorted_headers)]
+
+def dicom_series_2_nifti(folder_or_filepaths, output_path, series_instance_uid=None, threads=8, apply_rescale=True):
+
+    """ Converts a DICOM series into a NIfTI file, so that it can go through the
+        rest of qtim_tools like any other image.
+    """
+
+    volume, affine = load_dicom_series(folder_or_filepaths, series_instance_uid, threads, apply_rescale)
+    nib.save(nib.Nifti1Image(volume, affine), output_path)
+    return output_path
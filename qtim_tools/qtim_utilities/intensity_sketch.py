@@ -0,0 +1,230 @@
+""" Cohort-wide intensity references, built one volume at a time. Instead of
+    normalizing against a single reference image held in memory, every
+    volume in a cohort is summarized into a small sketch, and sketches from
+    different volumes (or different processes, or different machines) are
+    merged into one. Percentiles read from a sketch are within a chosen
+    relative error of the true values, however many voxels went into it.
+
+    The sketch buckets values on a logarithmic scale, in the manner of
+    DDSketch (Masson et al., 2019): a value x > 0 goes into bucket
+    ceil(log(x) / log(gamma)), with gamma = (1 + a) / (1 - a) for a relative
+    accuracy a, and negative values are bucketed by magnitude separately.
+    Each bucket stands in for its values with an estimate that is within a
+    of all of them. Exact count, mean, variance, minimum and maximum are
+    kept alongside the buckets.
+
+    Sketches are plain dictionaries, so they pickle and merge easily:
+    'relative_accuracy', 'positive' and 'negative' (bucket to count),
+    'zero_count', 'count', 'mean', 'm2' (sum of squared deviations), 'min',
+    and 'max'.
+"""
+
+from __future__ import division
+
+import numpy as np
+from multiprocessing.pool import Pool
+from functools import partial
+
+import nifti_util
+
+def create_intensity_sketch(relative_accuracy=.01):
+    return {'relative_accuracy': relative_accuracy, 'positive': {}, 'negative': {}, 'zero_count': 0, 'count': 0, 'mean': 0, 'm2': 0, 'min': np.inf, 'max': -np.inf}
+
+def sketch_gamma(sketch):
+    return (1 + sketch['relative_accuracy']) / (1 - sketch['relative_accuracy'])
+
+def add_bucket_counts(buckets, magnitudes, gamma):
+
+    if magnitudes.size == 0:
+        return
+
+    keys, counts = np.unique(np.ceil(np.log(magnitudes) / np.log(gamma)).astype(int), return_counts=True)
+    for key, count in zip(keys.tolist(), counts.tolist()):
+        buckets[key] = buckets.get(key, 0) + count
+
+def merge_moments(sketch, count, mean, m2):
+
+    """ Combines running count, mean and sum of squared deviations, using the
+        pairwise update of Chan et al., which stays accurate for large counts.
+    """
+
+    total = sketch['count'] + count
+    if total == 0:
+        return
+
+    delta = mean - sketch['mean']
+    sketch['m2'] += m2 + delta ** 2 * sketch['count'] * count / total
+    sketch['mean'] += delta * count / total
+    sketch['count'] = total
+
+def update_intensity_sketch(sketch, values):
+
+    """ Adds an array of intensities to a sketch in place, and returns it.
+        Non-finite values are ignored.
+    """
+
+    values = np.ravel(np.asarray(values, dtype=float))
+    values = values[np.isfinite(values)]
+
+    if values.size == 0:
+        return sketch
+
+    gamma = sketch_gamma(sketch)
+    add_bucket_counts(sketch['positive'], values[values > 0], gamma)
+    add_bucket_counts(sketch['negative'], -values[values < 0], gamma)
+    sketch['zero_count'] += int(np.sum(values == 0))
+
+    merge_moments(sketch, values.size, np.mean(values), np.sum((values - np.mean(values)) ** 2))
+    sketch['min'] = min(sketch['min'], np.min(values))
+    sketch['max'] = max(sketch['max'], np.max(values))
+
+    return sketch
+
+def merge_intensity_sketches(sketches):
+
+    """ Returns a new sketch combining a list of sketches, which must share the
+        same relative accuracy.
+    """
+
+    merged_sketch = create_intensity_sketch(sketches[0]['relative_accuracy'])
+
+    for sketch in sketches:
+
+        if sketch['relative_accuracy'] != merged_sketch['relative_accuracy']:
+            raise ValueError('Only sketches with the same relative accuracy can be merged.')
+
+        for sign in ['positive', 'negative']:
+            for key, count in sketch[sign].iteritems():
+                merged_sketch[sign][key] = merged_sketch[sign].get(key, 0) + count
+
+        merged_sketch['zero_count'] += sketch['zero_count']
+        merge_moments(merged_sketch, sketch['count'], sketch['mean'], sketch['m2'])
+        merged_sketch['min'] = min(merged_sketch['min'], sketch['min'])
+        merged_sketch['max'] = max(merged_sketch['max'], sketch['max'])
+
+    return merged_sketch
+
+def sketch_buckets(sketch):
+
+    """ Returns [values, counts] for every bucket in ascending order of value,
+        with each bucket's values estimated to within the sketch's accuracy.
+        Estimates are kept inside the exact minimum and maximum.
+    """
+
+    gamma = sketch_gamma(sketch)
+
+    negative_keys = sorted(sketch['negative'].keys(), reverse=True)
+    positive_keys = sorted(sketch['positive'].keys())
+
+    values = [-2 * gamma ** key / (gamma + 1) for key in negative_keys] + [0] * (sketch['zero_count'] > 0) + [2 * gamma ** key / (gamma + 1) for key in positive_keys]
+    counts = [sketch['negative'][key] for key in negative_keys] + [sketch['zero_count']] * (sketch['zero_count'] > 0) + [sketch['positive'][key] for key in positive_keys]
+
+    return [np.clip(np.array(values, dtype=float), sketch['min'], sketch['max']), np.array(counts, dtype=float)]
+
+def sketch_percentile(sketch, percentiles):
+
+    """ Like np.percentile with nearest-rank interpolation, for percentiles
+        between 0 and 100. Each result is within the sketch's relative accuracy
+        of the true intensity at that rank.
+    """
+
+    if sketch['count'] == 0:
+        raise ValueError('Cannot take percentiles of an empty sketch.')
+
+    values, counts = sketch_buckets(sketch)
+    cumulative_counts = np.cumsum(counts)
+
+    ranks = np.asarray(percentiles, dtype=float) / 100 * (sketch['count'] - 1)
+    bucket_indices = np.searchsorted(cumulative_counts, np.round(ranks), side='right')
+
+    results = values[np.clip(bucket_indices, 0, values.size - 1)]
+
+    # The lowest and highest ranks are known exactly.
+    results[np.round(ranks) == 0] = sketch['min']
+    results[np.round(ranks) == sketch['count'] - 1] = sketch['max']
+
+    return results
+
+def sketch_statistics(sketch, value_range=[]):
+
+    """ Returns a dictionary with 'count', 'mean', 'std', 'min' and 'max'. These
+        are exact for the whole sketch; if value_range is given as [low, high],
+        they are estimated from the buckets falling inside that range.
+    """
+
+    if value_range == []:
+        return {'count': sketch['count'], 'mean': sketch['mean'], 'std': np.sqrt(sketch['m2'] / sketch['count']), 'min': sketch['min'], 'max': sketch['max']}
+
+    values, counts = sketch_buckets(sketch)
+    in_range = (values >= value_range[0]) & (values <= value_range[1])
+    values, counts = values[in_range], counts[in_range]
+
+    if np.sum(counts) == 0:
+        raise ValueError('No intensities in the sketch fall within ' + str(value_range) + '.')
+
+    mean = np.sum(values * counts) / np.sum(counts)
+    std = np.sqrt(np.sum(counts * (values - mean) ** 2) / np.sum(counts))
+
+    return {'count': int(np.sum(counts)), 'mean': mean, 'std': std, 'min': np.min(values), 'max': np.max(values)}
+
+def create_intensity_reference(sketch, reference_norm_range=[.075, 1], reference_percentiles=[]):
+
+    """ Turns a cohort sketch into the intensity_reference dictionary taken by
+        nifti_util.coerce_levels. As with a
+        reference image in coerce_levels, only intensities between
+        reference_norm_range times the cohort maximum count towards the
+        reference; alternatively, give reference_percentiles as [low, high]
+        to use a percentile window instead.
+    """
+
+    if reference_percentiles != []:
+        value_range = sketch_percentile(sketch, reference_percentiles).tolist()
+    else:
+        value_range = [reference_norm_range[0] * sketch['max'], reference_norm_range[1] * sketch['max']]
+
+    return sketch_statistics(sketch, value_range)
+
+def sketch_image_file(imagepath, label_path='', mask_value=0, relative_accuracy=.01):
+
+    """ Sketches the intensities of one volume, inside its label-map if a
+        label_path is given and otherwise wherever it is not mask_value.
+    """
+
+    image_numpy = nifti_util.nifti_2_numpy(imagepath, dtype=None)
+
+    if label_path != '':
+        values = image_numpy[nifti_util.nifti_2_numpy(label_path, dtype=None) != 0]
+    else:
+        values = image_numpy[image_numpy != mask_value]
+
+    return update_intensity_sketch(create_intensity_sketch(relative_accuracy), values)
+
+def sketch_image_pair(image_pair, mask_value=0, relative_accuracy=.01):
+    return sketch_image_file(image_pair[0], image_pair[1], mask_value, relative_accuracy)
+
+def create_cohort_intensity_sketch(imagepaths, label_paths={}, mask_value=0, relative_accuracy=.01, processes=1):
+
+    """ Sketches every image in a cohort and merges the results. label_paths is a
+        dictionary from image path to label path, such as the label_images from
+        extract_features.generate_filename_list; images without an entry are
+        sketched wherever they are not mask_value. Each process loads one volume
+        at a time, and sketches are merged as they come in.
+    """
+
+    image_pairs = [[imagepath, label_paths.get(imagepath, '')] for imagepath in imagepaths]
+    sketcher = partial(sketch_image_pair, mask_value=mask_value, relative_accuracy=relative_accuracy)
+
+    cohort_sketch = create_intensity_sketch(relative_accuracy)
+
+    if processes > 1:
+        sketch_pool = Pool(processes)
+        try:
+            for image_sketch in sketch_pool.imap_unordered(sketcher, image_pairs):
+                cohort_sketch = merge_intensity_sketches([cohort_sketch, image_sketch])
+        finally:
+            sketch_pool.terminate()
+    else:
+        for image_pair in image_pairs:
+            cohort_sketch = merge_intensity_sketches([cohort_sketch, sketcher(image_pair)])
+
+    return cohort_sketch
@@ -0,0 +1,245 @@
+""" Reading parts of a NIfTI volume without loading all of it. For an
+    uncompressed .nii this is only a matter of seeking, but a .nii.gz has to
+    be decompressed from the start of the stream to reach any given byte,
+    which for a 4D DCE series can mean gigabytes of decompression to read a
+    single slice.
+
+    To avoid that, the gzip stream is decompressed once and the state of the
+    decompressor is saved every so often: how far into the compressed file it
+    was, how many bytes it had put out, and a copy of zlib's internal state
+    (mainly its 32KB window). Later reads start from the last saved point
+    before the bytes they need, rather than from the beginning of the file.
+    This is the approach of zlib's zran.c example. Python's zlib cannot
+    restart a stream from a bit offset, which is what zran.c does to store its
+    index on disk, so here the index lives in memory, cached by path and
+    checked against each file's modification time and size like the header
+    cache in nifti_util. Each saved point costs about 40KB, so the default
+    spacing of 16MB of decompressed data adds up to about 2.5MB of index per GB.
+
+    Slabs are given as ranges of z (the third dimension) and t (the fourth),
+    in the style of range(), and come back with only those slices.
+"""
+
+from __future__ import division
+
+import os
+import zlib
+import numpy as np
+import nibabel as nib
+
+gzip_index_cache = {}
+gzip_index_cache_size = 16
+
+def is_gzipped(filepath):
+    with open(filepath, 'rb') as readfile:
+        return readfile.read(2) == b'\x1f\x8b'
+
+def build_gzip_index(filepath, spacing=2**24, chunk_size=2**16):
+
+    """ Decompresses filepath once, discarding the output, and returns an index
+        with a saved point at least every 'spacing' bytes of decompressed data.
+        Each point is [uncompressed_offset, compressed_offset, decompressor]. Files
+        made of several gzip members, as some tools write, are handled as well.
+    """
+
+    file_stat = os.stat(filepath)
+    points = []
+    uncompressed_offset = 0
+    compressed_offset = 0
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    points += [[0, 0, decompressor.copy()]]
+
+    with open(filepath, 'rb') as readfile:
+        while True:
+            chunk = readfile.read(chunk_size)
+            if not chunk:
+                break
+
+            while chunk:
+                uncompressed_offset += len(decompressor.decompress(chunk))
+                chunk = decompressor.unused_data
+
+                # Leftover input means one member has ended and another begins here.
+                if chunk:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+            compressed_offset = readfile.tell()
+
+            if uncompressed_offset - points[-1][0] >= spacing:
+                points += [[uncompressed_offset, compressed_offset, decompressor.copy()]]
+
+    return {'filepath': os.path.abspath(filepath), 'mtime': file_stat.st_mtime, 'size': file_stat.st_size, 'uncompressed_size': uncompressed_offset, 'points': points}
+
+def get_gzip_index(filepath, spacing=2**24):
+
+    """ Returns the cached index for filepath, building it if it is missing or if
+        the file has changed since.
+    """
+
+    file_stat = os.stat(filepath)
+    index = gzip_index_cache.get(os.path.abspath(filepath))
+
+    if index is None or index['mtime'] != file_stat.st_mtime or index['size'] != file_stat.st_size:
+        if len(gzip_index_cache) >= gzip_index_cache_size:
+            gzip_index_cache.clear()
+        index = build_gzip_index(filepath, spacing)
+        gzip_index_cache[os.path.abspath(filepath)] = index
+
+    return index
+
+def clear_gzip_index_cache():
+    gzip_index_cache.clear()
+
+def read_gzip_ranges(filepath, ranges, index=None, chunk_size=2**16):
+
+    """ Returns the decompressed bytes for each [offset, length] in ranges. Ranges
+        are read in order of offset. A range that starts closer to where the last
+        one stopped than to a saved point continues decompressing from there, so
+        many small ranges spread through a file cost about one pass over it.
+    """
+
+    if index is None:
+        index = get_gzip_index(filepath)
+
+    point_offsets = [point[0] for point in index['points']]
+    results = [None] * len(ranges)
+
+    decompressor = None
+    position = 0
+    pending = b''
+
+    with open(filepath, 'rb') as readfile:
+
+        for range_idx in sorted(xrange(len(ranges)), key=lambda x: ranges[x][0]):
+
+            offset, length = ranges[range_idx]
+            point = index['points'][np.searchsorted(point_offsets, offset, side='right') - 1]
+
+            if decompressor is None or position > offset or point[0] > position:
+                position, compressed_offset, saved_decompressor = point
+                decompressor = saved_decompressor.copy()
+                readfile.seek(compressed_offset)
+                pending = b''
+
+            # pending holds decompressed bytes from position onwards that were not used yet.
+            output = [pending]
+            output_length = len(pending)
+
+            while position + output_length < offset + length:
+                chunk = readfile.read(chunk_size)
+                if not chunk:
+                    break
+                while chunk:
+                    decompressed = decompressor.decompress(chunk)
+                    output += [decompressed]
+                    output_length += len(decompressed)
+                    chunk = decompressor.unused_data
+                    if chunk:
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+            output = b''.join(output)
+
+            if position + len(output) < offset + length:
+                raise IOError('Tried to read past the end of ' + filepath + '.')
+
+            results[range_idx] = output[offset - position:offset - position + length]
+            pending = output[offset - position + length:]
+            position = offset + length
+
+    return results
+
+def read_file_ranges(filepath, ranges):
+
+    results = []
+    with open(filepath, 'rb') as readfile:
+        for offset, length in ranges:
+            readfile.seek(offset)
+            results += [readfile.read(length)]
+            if len(results[-1]) < length:
+                raise IOError('Tried to read past the end of ' + filepath + '.')
+    return results
+
+def normalize_range(index_range, size):
+
+    if index_range is None:
+        return [0, size]
+
+    start, stop = index_range
+    if start < 0 or stop > size or start >= stop:
+        raise ValueError('Range ' + str(index_range) + ' is out of bounds for a dimension of size ' + str(size) + '.')
+    return [int(start), int(stop)]
+
+def read_nifti_slab(filepath, z_range=None, t_range=None, apply_scaling=True, dtype=float, nifti_image=None):
+
+    """ Returns the voxels of a 3D or 4D volume with z in z_range and t in t_range,
+        given as [start, stop], in the same layout as the full array would have.
+        Only the bytes for those slices are read, through a gzip index for
+        compressed files. scl_slope and scl_inter are applied if apply_scaling is
+        set, and the result is cast to dtype unless dtype is None. Pass an
+        already loaded nibabel image as nifti_image to skip reading the header
+        again.
+    """
+
+    if nifti_image is None:
+        nifti_image = nib.load(filepath)
+
+    # nibabel moves the data offset and scaling out of the loaded header and
+    # into the image's array proxy, so they are read from there.
+    array_proxy = nifti_image.dataobj
+    shape = array_proxy.shape
+    if len(shape) > 4:
+        raise ValueError('Slabs can only be read from volumes with four or fewer dimensions.')
+
+    full_shape = tuple(shape) + (1,) * (4 - len(shape))
+    z_start, z_stop = normalize_range(z_range, full_shape[2])
+    t_start, t_stop = normalize_range(t_range, full_shape[3])
+
+    data_dtype = array_proxy.dtype
+    slice_bytes = full_shape[0] * full_shape[1] * data_dtype.itemsize
+    vox_offset = int(array_proxy.offset)
+
+    # Voxels are stored with x changing fastest, so each time point's z-slab is one
+    # contiguous run of bytes, and consecutive runs join up when all of z is read.
+    if z_start == 0 and z_stop == full_shape[2]:
+        ranges = [[vox_offset + slice_bytes * full_shape[2] * t_start, slice_bytes * full_shape[2] * (t_stop - t_start)]]
+    else:
+        ranges = [[vox_offset + slice_bytes * (full_shape[2] * t + z_start), slice_bytes * (z_stop - z_start)] for t in xrange(t_start, t_stop)]
+
+    if is_gzipped(filepath):
+        slab_bytes = read_gzip_ranges(filepath, ranges)
+    else:
+        slab_bytes = read_file_ranges(filepath, ranges)
+
+    slab_shape = (full_shape[0], full_shape[1], z_stop - z_start, t_stop - t_start)
+    slab = np.frombuffer(b''.join(slab_bytes), dtype=data_dtype).reshape(slab_shape, order='F')
+    slab = slab.reshape(slab_shape[:len(shape)], order='F')
+
+    if apply_scaling and (array_proxy.slope != 1 or array_proxy.inter != 0):
+        slab = slab * array_proxy.slope + array_proxy.inter
+
+    if dtype is not None:
+        slab = slab.astype(dtype)
+    else:
+        slab = np.array(slab)
+
+    return slab
+
+def iterate_nifti_slabs(filepath, slab_size=8, dim=2, apply_scaling=True, dtype=float):
+
+    """ Yields [index_range, slab] for consecutive slabs of slab_size slices along z
+        (dim=2) or t (dim=3), so a large compressed volume can be processed a piece
+        at a time, with the file decompressed about once overall.
+    """
+
+    nifti_image = nib.load(filepath)
+    size = (tuple(nifti_image.dataobj.shape) + (1, 1))[dim]
+
+    for start in xrange(0, size, slab_size):
+        index_range = [start, min(start + slab_size, size)]
+        if dim == 2:
+            yield [index_range, read_nifti_slab(filepath, z_range=index_range, apply_scaling=apply_scaling, dtype=dtype, nifti_image=nifti_image)]
+        elif dim == 3:
+            yield [index_range, read_nifti_slab(filepath, t_range=index_range, apply_scaling=apply_scaling, dtype=dtype, nifti_image=nifti_image)]
+        else:
+            raise ValueError('Slabs can only be taken along z (dim=2) or t (dim=3).')
@@ -6,10 +6,18 @@ import os
 from shutil import copy, move
 import matplotlib.pyplot as plt
 import glob
+import gzip
 from scipy import stats, signal, misc
 from scipy.ndimage.morphology import binary_fill_holes
+from scipy.ndimage import find_objects, binary_erosion
 import csv
 import fnmatch
+from multiprocessing.pool import Pool, ThreadPool
+from functools import partial
+
+import nifti_slab
+import dicom_util
+import dicom_catalog
 
 def copy_files(infolder, outfolder, name, duplicate=True):
 
@@ -31,90 +39,79 @@ def copy_files(infolder, outfolder, name, duplicate=True):
             else:
                 move(file, outfolder)
 
-def return_dicom_dictionary(filepath=[], folder=[], attributes_regex="*.dcm"):
+def return_dicom_dictionary(filepath=[], folder=[], attributes_regex="*.dcm", catalog=':memory:'):
 
-    """ This is currently broken, and overly-specific. Consider removing.
+    """ For a folder, catalogs every file matching attributes_regex (see
+        dicom_catalog) and returns a dictionary of identifiers per DICOM file.
+        Give catalog a filepath to keep the catalog on disk, so that calling
+        this again only reads files that have changed. For a single file,
+        returns its header.
     """
 
-    image_numpy = nib.load('C:/Users/azb22/Documents/Scripting/Breast_MRI_Challenge/ISPY_data/AllFiles/ISPY1_1098_19860919/ISPY1_1098_19860919_BreastTissue.nii.gz')
-    transform_matrix = image_numpy.affine
-
     if folder != []:
-        img_dicom_list = []
-        for root, dirnames, filenames in os.walk(folder):
-            for filename in fnmatch.filter(filenames, attributes_regex):
-                img_dicom_list.append(os.path.join(root, filename))
-
-        if img_dicom_list == []:
+        connection = dicom_catalog.connect_dicom_catalog(catalog)
+        dicom_catalog.update_dicom_catalog(folder, connection, file_regex=attributes_regex)
+        dicom_dictionary = dicom_catalog.query_dicom_catalog(connection)
+        connection.close()
+        if dicom_dictionary == []:
             print "No DICOM attributes returned. Folder is empty."
-        else:
-
-            attribute_list = np.zeros((1, 10), dtype=object)
-            temp_list = np.zeros((1, 10), dtype=object)
-            attribute_list[0,:] = ['filename','PatientName','date','center1', 'center2', 'center3', 'lx','ly','lz','type']
-            RadiusMatrix = np.zeros((3,3), dtype=float)
-
-            for filepath_idx, filepath in enumerate(img_dicom_list):
-                img_dicom = dicom.read_file(filepath)
-                try:
-                    # print img_dicom[0x117,0x1020][0][0x117,0x1043].value
-                    RadiusMatrix[0,:] = img_dicom[0x117,0x1020][0][0x117,0x1043].value[0:3]
-                    RadiusMatrix[1,:] = img_dicom[0x117,0x1020][0][0x117,0x1044].value[0:3]
-                    RadiusMatrix[2,:] = img_dicom[0x117,0x1020][0][0x117,0x1045].value[0:3]
-                    # print filepath
-                    temp_list[0, 3] = img_dicom[0x117,0x1020][0][0x117,0x1042].value[0]
-                    temp_list[0, 4] = img_dicom[0x117,0x1020][0][0x117,0x1042].value[1]
-                    temp_list[0, 5] = img_dicom[0x117,0x1020][0][0x117,0x1042].value[2]
-                    temp_list[0, 6] = np.max(abs(RadiusMatrix[:,0]))
-                    temp_list[0, 7] = np.max(abs(RadiusMatrix[:,1]))
-                    temp_list[0, 8] = np.max(abs(RadiusMatrix[:,2]))
-                    # print filepath
-                    temp_list[0, 9] = img_dicom[0x117,0x1020][0][0x117,0x1046].value
-                    temp_list[0, 2] = img_dicom.StudyDate
-                    temp_list[0, 1] = img_dicom.PatientID
-                    temp_list[0, 0] = filepath
-                    if [img_dicom.StudyDate, img_dicom.PatientID] not in attribute_list[:,1:3]:
-                        attribute_list = np.vstack((attribute_list, temp_list))
-                        # print temp_list
-                    # print ''
-                except:
-                    continue
-                if attribute_list[0, 7] == 'nan':
-                    # continue
-                    for i in xrange(attribute_list.shape[1]):
-                        print attribute_list[0, i]
-                    for i in xrange(2,6):
-                        col_vec = attribute_list[0, i][0:3]
-                        # col_vec[0]  = -col_vec[0]
-                        # col_vec[1] = -col_vec[1]
-                        # print np.round(nib.affines.apply_affine(transform_matrix, col_vec))
-                    # print col_vec.shape
-                    # for i in xrange(1,5):
-                        # transformed = nib.affines.apply_affine(np.linalg.inv(transform_matrix), np.reshape(attribute_list[0, i][0:3], (1,3)))
-                        # print transformed
-                        # image = image_numpy.get_data()
-
-                # fig = plt.figure()
-                # imgplot = plt.imshow(image[:,:,int(transformed[0][2])], interpolation='none', aspect='auto')
-                # plt.show()
-                
-                # print transform_matrix
-                # print attribute_list[0, 1]
-            with open('C:/Users/azb22/Documents/GitHub/QTIM_Pipelines/QTIM_Feature_Extraction_Pipeline/Test_Data/VOI_INFO_ISPY1.csv', 'wb') as writefile:
-                csvfile = csv.writer(writefile, delimiter=',')
-                for row in attribute_list:
-                    csvfile.writerow(row)
-
-        # print attribute_list
+        return dicom_dictionary
 
     elif filepath != []:
-        img_dicom = dicom.read_file(filepath) 
-        print img_dicom
+        return dicom_util.read_dicom_header(filepath)
 
     else:
         print "No DICOM attributes returned. Please provide a file or folder path."
         return
 
+# Headers and affines of files read so far, keyed by absolute path. Reference
+# images are read again and again (once per label, once per saved map), so a
+# cached entry is reused for as long as the file's modification time and size
+# are unchanged. Each process keeps its own cache.
+nifti_header_cache = {}
+nifti_header_cache_size = 1024
+
+def clear_nifti_header_cache():
+    nifti_header_cache.clear()
+
+def cache_nifti_header(filepath, nifti_image, file_stat=None):
+
+    if file_stat is None:
+        file_stat = os.stat(filepath)
+
+    if len(nifti_header_cache) >= nifti_header_cache_size:
+        nifti_header_cache.clear()
+
+    cached = [file_stat.st_mtime, file_stat.st_size, nifti_image.header.copy(), np.array(nifti_image.affine)]
+    nifti_header_cache[os.path.abspath(filepath)] = cached
+
+    return cached
+
+def cached_nifti_header(filepath):
+
+    """ Returns [header, affine] for filepath, loading the file only if it is not
+        cached or has changed on disk since it was.
+    """
+
+    file_stat = os.stat(filepath)
+    cached = nifti_header_cache.get(os.path.abspath(filepath))
+
+    if cached is None or cached[0] != file_stat.st_mtime or cached[1] != file_stat.st_size:
+        cached = cache_nifti_header(filepath, nib.load(filepath), file_stat)
+
+    return cached[2:]
+
+def get_nifti_header(filepath):
+
+    """ Returns a copy of a file's header, so changing it does not change
+        the cache.
+    """
+
+    return cached_nifti_header(filepath)[0].copy()
+
+def get_nifti_affine(filepath):
+    return np.copy(cached_nifti_header(filepath)[1])
+
 def return_nifti_attributes(filepath):
 
     """ For now, this just returns pixel dimensions, which are important
@@ -124,31 +121,116 @@ def return_nifti_attributes(filepath):
         return a dictionary.
     """
 
-    img_nifti = nib.load(filepath)
-    return img_nifti.header
+    return get_nifti_header(filepath)
+
+def load_nifti(filepath, dtype=float, apply_scaling=True, mmap=True, z_range=None, t_range=None):
+
+    """ Returns [image_numpy, header] from a single load, and caches the header
+        so that later calls to return_nifti_attributes or save_numpy_2_nifti
+        with the same file do not open it again.
+
+        With dtype=None, the array keeps its on-disk dtype, and uncompressed
+        .nii files are memory-mapped (copy-on-write) rather than read, so only
+        the parts of the volume that are used get read. That is a lot smaller
+        for, say, an int16 CT scan than a float64 copy of the whole thing; cast
+        just the ROI to float once it has been cropped. scl_slope and scl_inter
+        are applied if apply_scaling is set, which gives a float array for
+        scaled files. Without it, the raw stored values are returned.
+
+        z_range and t_range ([start, stop]) read only those slices of the
+        third and fourth dimensions, without decompressing the rest of a
+        .nii.gz; see nifti_slab.
+    """
+
+    file_stat = os.stat(filepath)
+    nifti_image = nib.load(filepath, mmap=('c' if mmap else False))
+    cache_nifti_header(filepath, nifti_image, file_stat)
+
+    if z_range is not None or t_range is not None:
+        image_numpy = nifti_slab.read_nifti_slab(filepath, z_range, t_range, apply_scaling, dtype, nifti_image)
+        return [image_numpy, nifti_image.header.copy()]
 
-def nifti_2_numpy(filepath):
+    if apply_scaling:
+        image_numpy = np.asanyarray(nifti_image.dataobj)
+    elif hasattr(nifti_image.dataobj, 'get_unscaled'):
+        image_numpy = nifti_image.dataobj.get_unscaled()
+    else:
+        image_numpy = np.asanyarray(nifti_image.dataobj)
+
+    if dtype is not None:
+        image_numpy = image_numpy.astype(dtype)
+
+    return [image_numpy, nifti_image.header.copy()]
+
+def nifti_2_numpy(filepath, dtype=float, apply_scaling=True, z_range=None, t_range=None):
 
     """ There are a lot of repetitive conversions in the current iteration
         of this program. Another option would be to always pass the nibabel
         numpy class, which contains image and attributes. But not everyone
         knows how to use that class, so it may be more difficult to troubleshoot.
+        See load_nifti for the other parameters.
+    """
+
+    return load_nifti(filepath, dtype, apply_scaling, z_range=z_range, t_range=t_range)[0]
+
+def save_numpy_2_nifti(image_numpy, reference_nifti_filepath, output_path, dtype=None, scale_integers=True, compression_level=None):
+
+    """ dtype sets the dtype written to disk, e.g. np.float32 for parameter maps
+        or np.uint8 for label-maps; by default it is whatever image_numpy is.
+        When float data are written to an integer dtype, nibabel picks
+        scl_slope and scl_inter to cover their range if scale_integers is set;
+        otherwise they are rounded and clipped to the dtype. compression_level
+        (1 to 9) sets the gzip level for .nii.gz outputs, trading speed for
+        size; by default nibabel's own level is used.
     """
 
-    img = nib.load(filepath).get_data().astype(float)
-    return img
+    output_nifti = nib.Nifti1Image(image_numpy, get_nifti_affine(reference_nifti_filepath))
 
-def save_numpy_2_nifti(image_numpy, reference_nifti_filepath, output_path):
-    nifti_image = nib.load(reference_nifti_filepath)
-    image_affine = nifti_image.affine
-    output_nifti = nib.Nifti1Image(image_numpy, image_affine)
-    nib.save(output_nifti, output_path)
+    if dtype is not None:
+        if np.dtype(dtype).kind in 'iu' and not scale_integers:
+            dtype_info = np.iinfo(dtype)
+            output_nifti = nib.Nifti1Image(np.clip(np.round(image_numpy), dtype_info.min, dtype_info.max).astype(dtype), output_nifti.affine)
+        output_nifti.set_data_dtype(dtype)
 
-def dcm_2_numpy(filepath):
+    if compression_level is not None and output_path.endswith('.gz'):
+        gzip_file = gzip.GzipFile(output_path, 'wb', compresslevel=compression_level)
+        try:
+            output_nifti.to_file_map({'image': nib.FileHolder(fileobj=gzip_file)})
+        finally:
+            gzip_file.close()
+    else:
+        nib.save(output_nifti, output_path)
 
-    # Maybe for the future...
+def save_numpy_2_nifti_batch(image_list, reference_nifti_filepath, output_paths, threads=4, **kwargs):
 
-    return
+    """ Saves several arrays against one reference image at once. zlib lets go
+        of the GIL while compressing, so writing .nii.gz outputs from a pool of
+        threads compresses them concurrently. Other keyword arguments are
+        passed on to save_numpy_2_nifti.
+    """
+
+    # Read the reference once up front, rather than once per thread.
+    get_nifti_affine(reference_nifti_filepath)
+
+    saver = partial(save_numpy_2_nifti_pair, reference_nifti_filepath=reference_nifti_filepath, **kwargs)
+
+    save_pool = ThreadPool(threads)
+    try:
+        save_pool.map(saver, zip(image_list, output_paths))
+    finally:
+        save_pool.terminate()
+
+def save_numpy_2_nifti_pair(image_pair, reference_nifti_filepath, **kwargs):
+    save_numpy_2_nifti(image_pair[0], reference_nifti_filepath, image_pair[1], **kwargs)
+
+def dcm_2_numpy(filepath, series_instance_uid=None, threads=8):
+
+    """ Loads a folder (or list of files) holding a DICOM series, in the same
+        [column, row, slice] layout as a converted NIfTI. Use
+        dicom_util.load_dicom_series to get its affine as well.
+    """
+
+    return dicom_util.load_dicom_series(filepath, series_instance_uid, threads)[0]
 
 def get_intensity_range(image_numpy, percentiles=[.25,.75]):
     intensity_range = [np.percentile(image_numpy, .25, interpolation="nearest"), np.percentile(image_numpy, .75, interpolation="nearest")]
@@ -188,65 +270,65 @@ def pad_nifti_image(image):
 
     return
 
-def mask_nifti(image_numpy, label_numpy, label_indices, mask_value=0):
-
-    masked_images = []
+def mask_nifti(image_numpy, label_numpy, label_indices, mask_value=0, dtype=None):
+    return list(iterate_masked_niftis(image_numpy, label_numpy, label_indices, mask_value, dtype))
 
-    for idx in label_indices[1:]:
-        masked_image = np.copy(image_numpy)
-        masked_image[label_numpy != idx] = mask_value
-        masked_image = truncate_image(masked_image, mask_value)
-        masked_images += [masked_image]
+def iterate_masked_niftis(image_numpy, label_numpy, label_indices, mask_value=0, dtype=None):
 
-    return masked_images
+    """ Like mask_nifti, but yields each masked and truncated label one at a time,
+        so that only one is in memory at once. Bounding boxes for every label are
+        found in one pass with find_objects, and each label is masked only within
+        its own box, so the work per label scales with the label, not the scan.
+        If dtype is given, each cropped label is cast to it, so that an image
+        loaded in its on-disk dtype is only ever cast a box at a time.
+    """
 
-def truncate_image(image_numpy, mask_value=0):
+    label_numpy = np.asarray(label_numpy)
+    if label_numpy.dtype.kind not in 'iu':
+        label_numpy = label_numpy.astype(int)
 
-    """ Filed To: This Is So Stupid
-        There are better ways online to do what I am attempting,
-        but so far I have not gotten any of them to work. In the meantime,
-        this long and probably ineffecient code will suffice. It is
-        meant to remove empty rows from images.
-    """
+    positive_indices = [idx for idx in label_indices[1:] if idx > 0]
+    if positive_indices:
+        label_boxes = find_objects(label_numpy, max_label=int(max(positive_indices)))
+    else:
+        label_boxes = []
 
-    dims = image_numpy.shape
-    truncate_range_x = [0,dims[0]]
-    truncate_range_y = [0,dims[1]]
-    truncate_range_z = [0,dims[2]]
-    start_flag = True
+    for idx in label_indices[1:]:
 
-    for x in xrange(dims[0]):
-        if (image_numpy[x,:,:] == mask_value).all():
-            if start_flag:
-                truncate_range_x[0] = x + 1
+        # find_objects only handles positive labels; anything else is masked over the whole image.
+        if idx > 0:
+            label_box = label_boxes[int(idx) - 1]
         else:
-            start_flag = False
-            truncate_range_x[1] = x + 1
+            label_box = tuple([slice(0, dim) for dim in image_numpy.shape])
 
-    start_flag = True
+        if label_box is None:
+            label_box = tuple([slice(0, 0) for dim in image_numpy.shape])
 
-    for y in xrange(dims[1]):
-        if (image_numpy[:,y,:] == mask_value).all():
-            if start_flag:
-                truncate_range_y[0] = y + 1
-        else:
-            start_flag = False
-            truncate_range_y[1] = y + 1
+        masked_image = np.array(image_numpy[label_box], dtype=dtype)
+        masked_image[label_numpy[label_box] != idx] = mask_value
 
-    start_flag = True
+        # Voxels inside the label can still equal mask_value, so truncate further.
+        yield truncate_image(masked_image, mask_value)
 
-    for z in xrange(dims[2]):
-        if (image_numpy[:,:,z] == mask_value).all():
-            if start_flag:
-                truncate_range_z[0] = z + 1
-        else:
-            start_flag = False
-            truncate_range_z[1] = z + 1
+def truncate_image(image_numpy, mask_value=0):
+
+    """ Removes rows, columns and slices at the edges of an image that only
+        contain mask_value. An image that is entirely mask_value comes back
+        with every dimension empty.
+    """
 
-    truncate_image_numpy = image_numpy[truncate_range_x[0]:truncate_range_x[1], truncate_range_y[0]:truncate_range_y[1], truncate_range_z[0]:truncate_range_z[1]]
+    unmasked = image_numpy != mask_value
 
+    truncate_ranges = []
+    for axis in xrange(image_numpy.ndim):
+        other_axes = tuple([other_axis for other_axis in xrange(image_numpy.ndim) if other_axis != axis])
+        occupied = np.flatnonzero(np.any(unmasked, axis=other_axes))
+        if occupied.size == 0:
+            truncate_ranges += [slice(image_numpy.shape[axis], image_numpy.shape[axis])]
+        else:
+            truncate_ranges += [slice(occupied[0], occupied[-1] + 1)]
 
-    return truncate_image_numpy
+    return image_numpy[tuple(truncate_ranges)]
 
 def assert_3D(image_numpy):
     if len(image_numpy.shape) > 3:
@@ -257,7 +339,120 @@ def assert_3D(image_numpy):
 
     return True
 
-def coerce_levels(image_numpy, levels=255, method="divide", reference_image = [], reference_norm_range = [.075, 1], mask_value=0, coerce_positive=True):
+def nearest_bin_indices(values, bins):
+
+    """ For each value, returns the index of the nearest bin in a sorted array of
+        bins. This gives the same answer as np.abs(bins - value).argmin() for every
+        value, ties and repeated bins included (the lowest index wins), but does it
+        with one searchsorted call instead of comparing every value to every bin.
+        Non-finite values get index 0, which is also what argmin gives them.
+    """
+
+    values = np.asarray(values, dtype=float)
+    bins = np.asarray(bins, dtype=float)
+
+    upper = np.clip(np.searchsorted(bins, values, side='left'), 1, bins.size - 1)
+    lower = upper - 1
+
+    if bins.size == 1:
+        nearest = np.zeros(values.shape, dtype=int)
+    else:
+        nearest = np.where(np.abs(bins[lower] - values) <= np.abs(bins[upper] - values), lower, upper)
+
+    # Move to the first of any run of identical bins, as argmin would.
+    nearest = np.searchsorted(bins, bins[nearest], side='left')
+    nearest[~np.isfinite(values)] = 0
+
+    return nearest
+
+def apply_bin_edges(values, bin_edges):
+
+    """ Returns levels from 1 to len(bin_edges) - 1 for an array of values, where
+        level i covers bin_edges[i-1] <= value < bin_edges[i]. Values below the
+        first edge or above the last are put in the first or last level.
+    """
+
+    return np.digitize(values, np.asarray(bin_edges)[1:-1]) + 1
+
+def build_level_lookup_table(bin_edges, max_table_size=2**20):
+
+    """ For integer-valued images, looking levels up in a table is quicker than
+        searching the bin edges for every voxel. The table covers every integer
+        between the first and last edge; integers outside of that range are
+        clipped to its ends, which fall in the first and last levels anyway.
+        The table depends only on the edges, so saving the edges is enough to
+        rebuild it exactly. Returns [] if the table would be too large.
+    """
+
+    table_start = int(np.floor(bin_edges[0]))
+    table_stop = int(np.ceil(bin_edges[-1]))
+
+    if table_stop - table_start + 1 > max_table_size:
+        return []
+
+    return [table_start, apply_bin_edges(np.arange(table_start, table_stop + 1), bin_edges)]
+
+def apply_level_lookup_table(values, level_lookup):
+    table_start, table = level_lookup
+    return table[np.clip(values.astype(np.int64) - table_start, 0, table.size - 1)]
+
+def compute_cohort_bin_edges(imagepaths, label_paths={}, levels=255, bin_width=None, mask_value=0):
+
+    """ Computes one set of bin edges for a whole cohort, so that every image is
+        quantized the same way. Intensities are taken from inside each image's
+        label-map if label_paths (a dictionary from image path to label path)
+        has one, and from every voxel not equal to mask_value otherwise. If
+        bin_width is given, edges are spaced bin_width apart starting from a
+        multiple of bin_width, and the number of levels follows from the cohort's
+        intensity range; otherwise 'levels' equal-width bins span that range.
+    """
+
+    cohort_min = np.inf
+    cohort_max = -np.inf
+
+    for imagepath in imagepaths:
+
+        image_numpy = nifti_2_numpy(imagepath, dtype=None)
+
+        if imagepath in label_paths:
+            values = image_numpy[nifti_2_numpy(label_paths[imagepath], dtype=None) != 0]
+        else:
+            values = image_numpy[image_numpy != mask_value]
+
+        if values.size > 0:
+            cohort_min = min(cohort_min, np.min(values))
+            cohort_max = max(cohort_max, np.max(values))
+
+    if not np.isfinite(cohort_min):
+        raise ValueError('No intensities were found to compute bin edges from.')
+
+    if bin_width is not None:
+        edge_start = np.floor(cohort_min / bin_width) * bin_width
+        bin_count = int(np.floor((cohort_max - edge_start) / bin_width)) + 1
+        return edge_start + bin_width * np.arange(bin_count + 1)
+    else:
+        return np.linspace(cohort_min, cohort_max, levels + 1)
+
+def save_bin_edges(bin_edges, filepath):
+
+    """ Edges are written to a temporary file and then renamed into place, so that
+        another process (e.g. another shard) never reads a half-written table.
+    """
+
+    temporary_filepath = filepath + '.' + str(os.getpid()) + '.tmp'
+    np.savetxt(temporary_filepath, np.asarray(bin_edges), fmt='%.17g', delimiter=',')
+
+    try:
+        os.rename(temporary_filepath, filepath)
+    except OSError:
+        # Windows will not rename over an existing file.
+        os.remove(filepath)
+        os.rename(temporary_filepath, filepath)
+
+def load_bin_edges(filepath):
+    return np.atleast_1d(np.loadtxt(filepath, delimiter=','))
+
+def coerce_levels(image_numpy, levels=255, method="divide", reference_image = [], reference_norm_range = [.075, 1], mask_value=0, coerce_positive=True, bin_width=25, bin_edges=[], level_lookup=[], intensity_reference={}):
 
     """ In volumes with huge outliers, the divide method will
         likely result in many zero values. This happens in practice
@@ -270,23 +465,64 @@ def coerce_levels(image_numpy, levels=255, method="divide", reference_image = []
         may be better to clean these up in the future. I have also built-in
         the coerce-positive function into this function. The other one
         was not working for mysterious reasons.
+
+        image_numpy is quantized in place and returned. reference_image is
+        left untouched. When intensities are shifted to be positive, "divide"
+        shifts only the maximum taken from it, while "z_score" works on a
+        shifted temporary copy so its masking matches the shifted image exactly.
+
+        Two methods keep the number of levels fixed across a cohort instead of
+        rescaling each image. "fixed_width" puts bin_width intensity units in
+        each level, counting from the lowest intensity in the ROI, and clips at
+        'levels'. "reference_edges" quantizes against precomputed bin_edges (see
+        compute_cohort_bin_edges), giving len(bin_edges) - 1 levels; pass a table
+        from build_level_lookup_table as level_lookup to speed this up for
+        integer-typed images. Neither method shifts intensities to be positive.
+
+        intensity_reference, from intensity_sketch.create_intensity_reference,
+        stands in for reference_image with statistics gathered over a whole
+        cohort: "divide" scales by its maximum, and "z_score" uses its mean and
+        standard deviation, with bins spanning its minimum to maximum.
     """
 
+    if method in ["fixed_width", "reference_edges"]:
+        unmasked = image_numpy != mask_value
+        values = image_numpy[unmasked]
+
+        if values.size > 0:
+            if method == "fixed_width":
+                quantized_values = np.floor(values / bin_width) - np.floor(np.min(values) / bin_width) + 1
+                image_numpy[unmasked] = np.clip(quantized_values, 1, levels)
+            elif level_lookup != [] and image_numpy.dtype.kind in 'iu':
+                image_numpy[unmasked] = apply_level_lookup_table(values, level_lookup)
+            else:
+                image_numpy[unmasked] = apply_bin_edges(values, bin_edges)
+
+        image_numpy[image_numpy == mask_value] = 0
+        return image_numpy
+
+    # The reference image gets the same shift as image_numpy. It is applied to a
+    # copy where needed, never to the caller's array.
+    reference_shift = 0
+
     if np.min(image_numpy) < 0 and coerce_positive:
-        reference_image -= np.min(image_numpy)
-        image_numpy[image_numpy != mask_value] -= np.min(image_numpy)
+        image_min = np.min(image_numpy)
+        reference_shift = image_min
+        if intensity_reference:
+            intensity_reference = dict(intensity_reference, mean=intensity_reference['mean'] - image_min, min=intensity_reference['min'] - image_min, max=intensity_reference['max'] - image_min)
+        image_numpy[image_numpy != mask_value] -= image_min
 
     levels -= 1
+    unmasked = image_numpy != mask_value
+
     if method == "divide":
-        if reference_image == []:
+        if intensity_reference:
+            image_max = intensity_reference['max']
+        elif reference_image == []:
             image_max = np.max(image_numpy)
         else:
-            image_max = np.max(reference_image)
-        for x in xrange(image_numpy.shape[0]):
-            for y in xrange(image_numpy.shape[1]):
-                for z in xrange(image_numpy.shape[2]):
-                    if image_numpy[x,y,z] != mask_value:
-                        image_numpy[x,y,z] = np.round((image_numpy[x,y,z] / image_max) * levels) + 1
+            image_max = np.max(reference_image) - reference_shift
+        image_numpy[unmasked] = np.round((image_numpy[unmasked] / image_max) * levels) + 1
 
     """ Another method is to bin values based on their z-score. I provide
         two options: within-ROI normalization, and whole-image normalization.
@@ -302,8 +538,13 @@ def coerce_levels(image_numpy, levels=255, method="divide", reference_image = []
 
         # check_image(image_numpy, mode="maximal_slice", mask_value=mask_value)
 
+        if intensity_reference:
+            masked_image_numpy = np.ma.masked_equal(image_numpy, mask_value)
+            z_image_numpy = (masked_image_numpy - intensity_reference['mean']) / intensity_reference['std']
+            bins = np.linspace((intensity_reference['min'] - intensity_reference['mean']) / intensity_reference['std'], (intensity_reference['max'] - intensity_reference['mean']) / intensity_reference['std'], levels)
+
         ## Note that this is a bad way to check this variable.
-        if reference_image == []:
+        elif reference_image == []:
             masked_image_numpy = np.ma.masked_equal(image_numpy, mask_value)
             z_image_numpy = stats.zscore(masked_image_numpy, axis=None)
 
@@ -322,6 +563,9 @@ def coerce_levels(image_numpy, levels=255, method="divide", reference_image = []
             # bins = distribution.ppf(pp)
             # print bins
         else:
+            if reference_shift != 0:
+                reference_image = reference_image - reference_shift
+
             masked_reference_image = np.ma.masked_equal(reference_image, mask_value)
             masked_reference_image = np.ma.masked_less(masked_reference_image, reference_norm_range[0]*np.max(reference_image))
             masked_reference_image = np.ma.masked_greater(masked_reference_image, reference_norm_range[1]*np.max(reference_image))
@@ -344,11 +588,7 @@ def coerce_levels(image_numpy, levels=255, method="divide", reference_image = []
             image_range = [np.min(z_reference_image), np.max(z_reference_image)]
             bins = np.linspace(image_range[0], image_range[1], levels)
 
-        for x in xrange(image_numpy.shape[0]):
-            for y in xrange(image_numpy.shape[1]):
-                for z in xrange(image_numpy.shape[2]):
-                    if image_numpy[x,y,z] != mask_value:
-                        image_numpy[x,y,z] = (np.abs(bins-z_image_numpy[x,y,z])).argmin() + 1
+        image_numpy[unmasked] = nearest_bin_indices(np.ma.getdata(z_image_numpy)[unmasked], bins) + 1
 
         # check_image(image_numpy, mode="maximal_slice", mask_value=mask_value)
     image_numpy[image_numpy == mask_value] = 0
@@ -368,62 +608,61 @@ def remove_islands():
     return
 
 def erode_label(image_numpy, iterations=2, mask_value=0):
+
     """ For each iteration, removes all voxels not completely surrounded by
-        other voxels. This might be a bit of an aggressive erosion. Also I
-        would bet it is incredibly ineffecient. Also custom erosions in
-        multiple dimensions look a little bit messy.
+        other voxels. This might be a bit of an aggressive erosion. Erosion
+        can be different in each dimension, so iterations can be a list like
+        [x, y, z] as well as a single number. Iteration i erodes along every
+        axis with more than i iterations, using a cross-shaped structuring
+        element over just those axes; voxels at the edge of the image count
+        as bordering empty space. Only the label's bounding box is eroded,
+        and erosion stops early if the label disappears. image_numpy is
+        modified in place and returned.
     """
 
-    iterations = np.copy(iterations)
-
-    if isinstance(iterations, list):
-        if len(iterations) != 3:
-            print 'The erosion parameter does not have enough dimensions (3). Using the first value in the eroison parameter.'
+    if np.ndim(iterations) == 0:
+        iterations = [iterations] * image_numpy.ndim
     else:
-        iterations == [iterations, iterations, iterations]
+        iterations = list(iterations)
+        if len(iterations) != image_numpy.ndim:
+            print 'The erosion parameter does not have enough dimensions (' + str(image_numpy.ndim) + '). Using the first value in the eroison parameter.'
+            iterations = [iterations[0]] * image_numpy.ndim
 
-    for i in xrange(max(iterations)):
+    if max(iterations) <= 0:
+        return image_numpy
 
-        kernel_center = 0
-        edges_kernel = np.zeros((3,3,3),dtype=float)
-        
-        if iterations[2] > 0:
-            edges_kernel[1,1,0] = -1
-            edges_kernel[1,1,2] = -1
-            iterations[2] -= 1
-            kernel_center += 2
-
-        if iterations[1] > 0:
-            edges_kernel[1,0,1] = -1
-            edges_kernel[1,2,1] = -1
-            iterations[1] -= 1
-            kernel_center += 2
-
-        if iterations[0] > 0:
-            edges_kernel[0,1,1] = -1
-            edges_kernel[2,1,1] = -1
-            iterations[0] -= 1
-            kernel_center += 2
-
-        edges_kernel[1,1,1] = kernel_center
-
-        label_numpy = np.copy(image_numpy)
-        label_numpy[label_numpy != mask_value] = 1
-        label_numpy[label_numpy == mask_value] = 0
-
-        edge_image = signal.convolve(label_numpy, edges_kernel, mode='same')
-        # check_image(edge_image, mode="maximal_slice")
-        edge_image[edge_image < 0] = -1
-        # check_image(edge_image, mode="maximal_slice")
-        edge_image[np.where((edge_image <= kernel_center) & (edge_image > 0))] = -1
-        # check_image(edge_image, mode="maximal_slice")
-        edge_image[edge_image == 0] = 1
-        # check_image(edge_image, mode="maximal_slice")
-        edge_image[edge_image == -1] = 0
-        # check_image(edge_image, mode="maximal_slice")
-        image_numpy[edge_image == 0] = mask_value
-        # check_image(image_numpy, mode="maximal_slice")
+    label_mask = image_numpy != mask_value
+    label_box = find_objects(label_mask.astype(int))
+
+    if label_box == []:
+        return image_numpy
+
+    label_box = label_box[0]
+    eroded_mask = label_mask[label_box]
+
+    # Iterations that erode along the same axes are run together.
+    iteration = 0
+    while iteration < max(iterations):
+
+        eroded_axes = [axis for axis in xrange(image_numpy.ndim) if iterations[axis] > iteration]
+        repeats = min([iterations[axis] for axis in eroded_axes]) - iteration
+
+        structure = np.zeros([3] * image_numpy.ndim, dtype=bool)
+        structure[tuple([1] * image_numpy.ndim)] = True
+        for axis in eroded_axes:
+            for offset in [0, 2]:
+                neighbor = [1] * image_numpy.ndim
+                neighbor[axis] = offset
+                structure[tuple(neighbor)] = True
+
+        eroded_mask = binary_erosion(eroded_mask, structure=structure, iterations=repeats, border_value=0)
+        iteration += repeats
+
+        if not eroded_mask.any():
+            break
 
+    cropped_image = image_numpy[label_box]
+    cropped_image[~eroded_mask] = mask_value
 
     return image_numpy
 
@@ -649,34 +888,42 @@ def create_mosaic(image_numpy, label_numpy=[], generate_outline=True, mask_value
 
 def generate_label_outlines(label_numpy, dim=2, mask_value=0):
 
-    # Will not work if someone uses 0 or <0 for a label.
-    # Also this is super slow.
-        
-    edges_kernel = np.zeros((3,3,3),dtype=float)
-    edges_kernel[1,1,1] = 4
+    """ Returns a volume where each label's outline keeps its label value and
+        everything else is 0. A voxel is on an outline if any of its four
+        neighbors within the plane perpendicular to dim has a different label,
+        or lies off the edge of the image. All labels are outlined at once by
+        comparing the volume with shifted copies of itself. Labels equal to 0
+        or mask_value are not outlined.
+    """
 
-    if dim != 2:
-        edges_kernel[1,1,0] = -1
-        edges_kernel[1,1,2] = -1
+    outline_mask = np.zeros(label_numpy.shape, dtype=bool)
 
-    if dim != 1:
-        edges_kernel[1,0,1] = -1
-        edges_kernel[1,2,1] = -1
+    for axis in xrange(label_numpy.ndim):
 
-    if dim != 0:
-        edges_kernel[0,1,1] = -1
-        edges_kernel[2,1,1] = -1
-    
-    outline_label_numpy = np.zeros_like(label_numpy)
+        if axis == dim:
+            continue
+
+        lower = [slice(None)] * label_numpy.ndim
+        upper = [slice(None)] * label_numpy.ndim
+        lower[axis] = slice(None, -1)
+        upper[axis] = slice(1, None)
+        lower, upper = tuple(lower), tuple(upper)
+
+        label_changes = label_numpy[lower] != label_numpy[upper]
 
-    for label_number in np.unique(label_numpy):
-        if label_number != mask_value:
-            sublabel_numpy = np.copy(label_numpy)
-            sublabel_numpy[sublabel_numpy != label_number] = 0
-            edge_image = signal.convolve(sublabel_numpy, edges_kernel, mode='same')
-            edge_image[sublabel_numpy != label_number] = 0
-            edge_image[edge_image != 0] = label_number
-            outline_label_numpy += edge_image
+        # Voxels on the first and last planes along this axis border the image edge.
+        edge = [slice(None)] * label_numpy.ndim
+        for edge_index in [0, -1]:
+            edge[axis] = edge_index
+            outline_mask[tuple(edge)] = True
+
+        outline_mask[lower] |= label_changes
+        outline_mask[upper] |= label_changes
+
+    outline_mask &= (label_numpy != mask_value) & (label_numpy != 0)
+
+    outline_label_numpy = np.zeros_like(label_numpy)
+    outline_label_numpy[outline_mask] = label_numpy[outline_mask]
 
     return outline_label_numpy
 
@@ -703,60 +950,108 @@ def assert_nD(array, ndim, arg_name='image'):
     if not array.ndim in ndim:
         raise ValueError(msg % (arg_name, '-or-'.join([str(n) for n in ndim])))
 
-def fill_in_convex_outline(filepath, output_file, outline_lower_threshold=[], outline_upper_threshold=[], outline_color=[], output_label_num=1, reference_nifti=[]):
+def outline_match_mask(image_numpy, outline_lower_threshold=[], outline_upper_threshold=[], outline_color=[]):
+
+    """ Returns a boolean [row, column] mask of pixels strictly between the
+        lower and upper thresholds in every channel, or, failing that, exactly
+        equal to outline_color. Returns [] if neither is given.
+    """
 
     outline_upper_threshold = np.array(outline_upper_threshold)
     outline_lower_threshold = np.array(outline_lower_threshold)
+    outline_color = np.array(outline_color)
+
+    if outline_upper_threshold.size > 0 and outline_lower_threshold.size > 0:
+        match = (image_numpy > outline_lower_threshold) & (image_numpy < outline_upper_threshold)
+    elif outline_color.size > 0:
+        match = image_numpy == outline_color
+    else:
+        return []
+
+    if match.ndim == 3:
+        match = np.all(match, axis=2)
+
+    return match
+
+def fill_outline_rows(outline_mask):
+
+    """ Fills each row between alternating runs of outline pixels: the gap
+        after the first run is filled if a second run follows, the gap after
+        the second is not, the gap after the third is, and so on. Runs are
+        numbered with a cumulative count of run starts along each row, so
+        every row is filled at once.
+    """
+
+    run_starts = np.copy(outline_mask)
+    run_starts[:, 1:] &= ~outline_mask[:, :-1]
+
+    run_number = np.cumsum(run_starts, axis=1)
+    total_runs = run_number[:, -1:]
+
+    return outline_mask | (~outline_mask & (run_number % 2 == 1) & (run_number < total_runs))
+
+def fill_in_convex_outline(filepath, output_file, outline_lower_threshold=[], outline_upper_threshold=[], outline_color=[], output_label_num=1, reference_nifti=[]):
+
+    """ Turns an outline drawn onto a screenshot into a filled label-map. Outline
+        pixels are found by threshold or color, spans between them are filled
+        row by row, and any holes left are filled afterwards.
+    """
 
     if filepath.endswith('.nii') or filepath.endswith('nii.gz'):
         return
 
     else:
         image_file = misc.imread(filepath)
-        label_file = np.zeros_like(image_file)
-        # print image_file.shape
-
-        for row in xrange(image_file.shape[0]):
-            row_section = 0
-            fill_index = 0
-            for col in xrange(image_file.shape[1]):
-                match = False
-                pixel = image_file[row, col, ...]
-                
-                if outline_upper_threshold != [] and outline_lower_threshold != []:
-                    if all(pixel > outline_lower_threshold) and all(pixel < outline_upper_threshold):
-                        match = True
-                elif outline_color != []:
-                    if (pixel == outline_color):
-                        match = True
-                else:
-                    print 'Error. Please provide a valid outline color or threshold.'
-                    return
-
-                if match:
-                    label_file[row, col, ...] = output_label_num                    
-                    if row_section == 0:
-                        row_section = 1
-                    if row_section == 2:
-                        row_section = 3
-                        label_file[row, fill_index:col, ...] = output_label_num
-                else:
-                    if row_section == 1:
-                        row_section = 2
-                        fill_index = col
-                    if row_section == 3:
-                        row_section = 0
-
-                # label_file[row, col, ...] = pixel
-
-        label_file = binary_fill_holes(label_file[:,:,0]).astype(label_file.dtype)
-        # label_file = label_file[:,:,0]
+
+        outline_mask = outline_match_mask(image_file, outline_lower_threshold, outline_upper_threshold, outline_color)
+        if isinstance(outline_mask, list):
+            print 'Error. Please provide a valid outline color or threshold.'
+            return
+
+        label_file = binary_fill_holes(fill_outline_rows(outline_mask)).astype(image_file.dtype)
 
         if reference_nifti == []:
             misc.imsave(output_file, label_file)
         else:
             save_numpy_2_nifti(label_file, reference_nifti, output_file)
 
+def fill_in_convex_outline_pair(file_pair, **kwargs):
+    fill_in_convex_outline(file_pair[0], file_pair[1], **kwargs)
+    return file_pair[1]
+
+def fill_in_convex_outlines(input_folder, output_folder, file_regex='*.png', output_suffix='-label', processes=4, **kwargs):
+
+    """ Runs fill_in_convex_outline on every matching image in input_folder
+        in parallel, saving each result to output_folder with output_suffix
+        added to its name. Other keyword arguments (thresholds, color,
+        reference_nifti) are passed on to fill_in_convex_outline.
+    """
+
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    file_pairs = []
+    for filepath in sorted(glob.glob(os.path.join(input_folder, file_regex))):
+        split_filename = os.path.splitext(os.path.basename(filepath))
+        if kwargs.get('reference_nifti', []) == []:
+            output_file = os.path.join(output_folder, split_filename[0] + output_suffix + split_filename[1])
+        else:
+            output_file = os.path.join(output_folder, split_filename[0] + output_suffix + '.nii.gz')
+        file_pairs += [[filepath, output_file]]
+
+    filler = partial(fill_in_convex_outline_pair, **kwargs)
+
+    if processes > 1:
+        fill_pool = Pool(processes)
+        try:
+            output_files = fill_pool.map(filler, file_pairs)
+        finally:
+            fill_pool.terminate()
+    else:
+        output_files = map(filler, file_pairs)
+
+    return output_files
+
 def replace_slice(input_nifti, output_file, input_nifti_slice, slice_num):
 
     input_numpy = nifti_2_numpy(input_nifti)
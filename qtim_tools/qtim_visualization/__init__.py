@@ -0,0 +1 @@
+import qc_mosaic
\ No newline at end of file
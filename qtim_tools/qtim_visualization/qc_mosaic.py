@@ -0,0 +1,214 @@
+""" Quality-control mosaics for whole cohorts. nifti_util.create_mosaic builds
+    a matplotlib figure for every image, which is fine for one image but
+    slow for hundreds. Here, slices are tiled into a mosaic with a single
+    reshape, intensities and labels are colored through lookup tables, and
+    the result is written straight to a PNG, with images spread across a
+    pool of processes.
+"""
+
+from __future__ import division
+
+import os
+import numpy as np
+from matplotlib import cm
+from scipy import misc
+from multiprocessing.pool import Pool
+from functools import partial
+
+from qtim_tools.qtim_utilities import nifti_util
+from qtim_tools.qtim_features import image_manifest
+
+def select_mosaic_slices(image_numpy, label_numpy=[], dim=2, label_buffer=5, step=1):
+
+    """ Returns the slice indices along dim to show. With a label-map, these
+        are every labeled slice plus label_buffer slices on either side;
+        without one, every step-th slice.
+    """
+
+    slice_count = image_numpy.shape[dim]
+
+    if isinstance(label_numpy, list):
+        return np.arange(0, slice_count, step)
+
+    other_axes = tuple([axis for axis in xrange(label_numpy.ndim) if axis != dim])
+    labeled_slices = np.flatnonzero(np.any(label_numpy != 0, axis=other_axes))
+
+    if labeled_slices.size == 0:
+        return np.arange(0, slice_count, step)
+
+    selected_slices = np.zeros(slice_count, dtype=bool)
+    for labeled_slice in labeled_slices:
+        selected_slices[max(labeled_slice - label_buffer, 0):labeled_slice + label_buffer + 1] = True
+
+    return np.flatnonzero(selected_slices)[::step]
+
+def orient_slices(slice_stack, rotate_90=3, flip=True):
+
+    """ Rotates each slice of a [slice, row, column] stack by 90 degrees
+        rotate_90 times, as np.rot90 would, and then flips it left to right.
+    """
+
+    for rotation in xrange(rotate_90 % 4):
+        slice_stack = np.swapaxes(slice_stack, 1, 2)[:, ::-1, :]
+
+    if flip:
+        slice_stack = slice_stack[:, :, ::-1]
+
+    return slice_stack
+
+def tile_slices(volume_numpy, slice_indices, dim=2, cols=8, rotate_90=3, flip=True, fill_value=0):
+
+    """ Lays out the chosen slices of a volume in rows of cols slices, filling
+        leftover tiles in the last row with fill_value.
+    """
+
+    slice_stack = np.rollaxis(np.take(volume_numpy, slice_indices, axis=dim), dim, 0)
+    slice_stack = orient_slices(slice_stack, rotate_90, flip)
+
+    slice_count, slice_height, slice_width = slice_stack.shape
+    rows = int(np.ceil(slice_count / cols))
+
+    padded_stack = np.empty((rows * cols, slice_height, slice_width), dtype=slice_stack.dtype)
+    padded_stack[:slice_count] = slice_stack
+    padded_stack[slice_count:] = fill_value
+
+    return padded_stack.reshape(rows, cols, slice_height, slice_width).transpose(0, 2, 1, 3).reshape(rows * slice_height, cols * slice_width)
+
+def colormap_lookup_table(colormap='gray', entries=256):
+    return (getattr(cm, colormap)(np.arange(entries))[:, :3] * 255).astype(np.uint8)
+
+def window_indices(image_numpy, window, entries=256):
+
+    """ Maps intensities within window ([low, high]) onto lookup table
+        indices, clipping anything outside it.
+    """
+
+    if window[1] > window[0]:
+        scaled_image = (image_numpy - window[0]) * ((entries - 1) / (window[1] - window[0]))
+    else:
+        scaled_image = np.zeros(image_numpy.shape)
+
+    return np.clip(np.round(scaled_image), 0, entries - 1).astype(np.uint8)
+
+def color_mosaic(image_mosaic, label_mosaic=[], window=[], label_range=[], image_colormap='gray', label_colormap='jet'):
+
+    """ Returns an RGB uint8 mosaic. The image is windowed to window (its full
+        intensity range by default) and labels are drawn opaquely over it,
+        colored across label_range.
+    """
+
+    if window == []:
+        window = [np.min(image_mosaic), np.max(image_mosaic)]
+
+    rgb_mosaic = colormap_lookup_table(image_colormap)[window_indices(image_mosaic, window)]
+
+    if not isinstance(label_mosaic, list):
+
+        if label_range == []:
+            label_range = [np.min(label_mosaic), np.max(label_mosaic)]
+
+        labeled = label_mosaic != 0
+        rgb_mosaic[labeled] = colormap_lookup_table(label_colormap)[window_indices(label_mosaic[labeled], label_range)]
+
+    return rgb_mosaic
+
+def render_qc_mosaic(imagepath, label_path='', outfile='', dim=2, cols=8, step=1, label_buffer=5, rotate_90=3, flip=True, generate_outline=True, mask_value=0, window=[]):
+
+    """ Renders one image, with its label-map outlined on top if label_path is
+        given, and writes it to outfile as a PNG if outfile is given. Returns the
+        RGB mosaic.
+    """
+
+    image_numpy = nifti_util.nifti_2_numpy(imagepath)
+
+    if label_path != '':
+        label_numpy = nifti_util.nifti_2_numpy(label_path)
+        if generate_outline:
+            label_numpy = nifti_util.generate_label_outlines(label_numpy, dim, mask_value)
+        slice_indices = select_mosaic_slices(image_numpy, label_numpy, dim, label_buffer, step)
+        label_range = [np.min(label_numpy), np.max(label_numpy)]
+        label_mosaic = tile_slices(label_numpy, slice_indices, dim, cols, rotate_90, flip)
+    else:
+        slice_indices = select_mosaic_slices(image_numpy, dim=dim, step=step)
+        label_range = []
+        label_mosaic = []
+
+    if window == []:
+        window = [np.min(image_numpy), np.max(image_numpy)]
+
+    rgb_mosaic = color_mosaic(tile_slices(image_numpy, slice_indices, dim, cols, rotate_90, flip), label_mosaic, window, label_range)
+
+    if outfile != '':
+        misc.imsave(outfile, rgb_mosaic)
+
+    return rgb_mosaic
+
+def qc_mosaic_name(imagepath, root_folder=''):
+
+    """ Names a mosaic after its image. With a root_folder, the image's folders
+        below the root are joined into the name as well, so images with the same
+        name in different subfolders of a cohort do not overwrite each other.
+    """
+
+    image_name = str.split(os.path.basename(imagepath), '.')[0]
+
+    if root_folder != '':
+        relative_folder = os.path.dirname(os.path.relpath(os.path.abspath(imagepath), os.path.abspath(root_folder)))
+        if relative_folder not in ['', os.curdir]:
+            image_name = '_'.join([folder for folder in str.split(relative_folder, os.sep) if folder != ''] + [image_name])
+
+    return image_name + '.png'
+
+def render_qc_mosaic_pair(image_pair, output_folder, root_folder='', **kwargs):
+
+    """ Pool worker for render_qc_mosaics. Failures are reported rather than
+        raised, so one bad image does not stop a whole cohort.
+    """
+
+    imagepath, label_path = image_pair
+    outfile = os.path.join(output_folder, qc_mosaic_name(imagepath, root_folder))
+
+    try:
+        render_qc_mosaic(imagepath, label_path, outfile, **kwargs)
+    except Exception as error:
+        return [imagepath, 'failure to make mosaic: ' + str(error)]
+
+    return [imagepath, outfile]
+
+def render_qc_mosaics(imagepaths, output_folder, label_paths={}, processes=4, root_folder='', **kwargs):
+
+    """ Renders a QC mosaic for every image into output_folder, named after the
+        image (and its subfolders below root_folder, if given). label_paths maps
+        image paths to label-map paths. Other keyword arguments are passed on to
+        render_qc_mosaic. Returns [imagepath, result] pairs, where result is the
+        PNG path or a failure message.
+    """
+
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    image_pairs = [[imagepath, label_paths.get(imagepath, '')] for imagepath in imagepaths]
+    renderer = partial(render_qc_mosaic_pair, output_folder=output_folder, root_folder=root_folder, **kwargs)
+
+    if processes > 1:
+        render_pool = Pool(processes)
+        try:
+            results = render_pool.map(renderer, image_pairs)
+        finally:
+            render_pool.terminate()
+    else:
+        results = map(renderer, image_pairs)
+
+    for imagepath, result in results:
+        print imagepath + ': ' + result
+
+    return results
+
+def render_qc_folder(folder, output_folder, label_suffix='-label', recursive=False, processes=4, **kwargs):
+
+    """ Renders QC mosaics for every image in a folder, paired with label-maps
+        the same way extract_features pairs them.
+    """
+
+    manifest = image_manifest.build_image_manifest(folder, label_suffix, recursive)
+    return render_qc_mosaics(manifest['imagepaths'], output_folder, manifest['label_paths'], processes, folder, **kwargs)